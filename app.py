@@ -1,11 +1,33 @@
 import os
+import tempfile
+import time
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+import click
+from flask import (Flask, render_template, request, flash, redirect, session,
+                   g, jsonify, abort)
 from flask_debugtoolbar import DebugToolbarExtension
+from sqlalchemy import select
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 
 from forms import UserAddForm, LoginForm, MessageForm, EditUserForm
-from models import db, connect_db, User, Message
+from models import db, connect_db, User, Message, Follows, Likes
+import author_cache
+import compression
+import database
+import fragments
+import http_cache
+import images
+import instrumentation
+import migrations
+import passwords
+import purge
+import search
+import streaming
+import timeline
+import viewer_cache
+from pagination import (parse_id_cursor, parse_score_cursor, score_cursor,
+                        split_page)
 
 CURR_USER_KEY = "curr_user"
 
@@ -20,9 +42,139 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+# Connection pooling, per process (see database.py): connections kept open,
+# extra ones allowed under load, seconds to wait for one, seconds before
+# one is replaced, whether to check one before use, and the longest a
+# statement may run (0 for no limit).
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 5))
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+app.config['DB_POOL_TIMEOUT'] = float(os.environ.get('DB_POOL_TIMEOUT', 5))
+app.config['DB_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+app.config['DB_POOL_PRE_PING'] = (
+    os.environ.get('DB_POOL_PRE_PING', '1') != '0')
+app.config['DB_STATEMENT_TIMEOUT_MS'] = int(
+    os.environ.get('DB_STATEMENT_TIMEOUT_MS', 10000))
+
+# Optional read replica for read-only pages, and how long someone reads
+# from the primary after writing, so they see their own changes.
+app.config['DATABASE_REPLICA_URL'] = os.environ.get('DATABASE_REPLICA_URL')
+app.config['REPLICA_STICKY_SECONDS'] = float(
+    os.environ.get('REPLICA_STICKY_SECONDS', 5))
+
+# Home timelines are precomputed (see timeline.py): how many entries each
+# one keeps, and how many followers an author can have before their
+# messages are pulled at read time instead of pushed to every follower.
+app.config['TIMELINE_MAX_LENGTH'] = int(
+    os.environ.get('TIMELINE_MAX_LENGTH', timeline.DEFAULT_MAX_LENGTH))
+app.config['TIMELINE_FANOUT_LIMIT'] = int(
+    os.environ.get('TIMELINE_FANOUT_LIMIT', timeline.DEFAULT_FANOUT_LIMIT))
+
+# Or 'pull': merge home timelines at read time from cached lists of each
+# author's newest messages (see author_cache.py), without fan-out.
+app.config['TIMELINE_ENGINE'] = os.environ.get(
+    'TIMELINE_ENGINE', timeline.DEFAULT_ENGINE)
+app.config['AUTHOR_CACHE_BACKEND'] = os.environ.get(
+    'AUTHOR_CACHE_BACKEND', 'local')
+app.config['AUTHOR_CACHE_URL'] = os.environ.get('AUTHOR_CACHE_URL')
+app.config['AUTHOR_CACHE_TTL'] = int(os.environ.get('AUTHOR_CACHE_TTL', 3600))
+app.config['AUTHOR_CACHE_SIZE'] = int(
+    os.environ.get('AUTHOR_CACHE_SIZE', 10000))
+app.config['AUTHOR_CACHE_LENGTH'] = int(
+    os.environ.get('AUTHOR_CACHE_LENGTH', author_cache.DEFAULT_LENGTH))
+
+# Password hashing (see passwords.py): bcrypt work factor, size of the
+# process pool that runs it (0 runs it inline), how many operations may
+# wait for the pool before new ones get a 503, and how long to wait.
+app.config['BCRYPT_LOG_ROUNDS'] = int(
+    os.environ.get('BCRYPT_LOG_ROUNDS', passwords.DEFAULT_LOG_ROUNDS))
+app.config['PASSWORD_HASH_WORKERS'] = int(
+    os.environ.get('PASSWORD_HASH_WORKERS', 2))
+app.config['PASSWORD_HASH_MAX_PENDING'] = int(
+    os.environ.get('PASSWORD_HASH_MAX_PENDING', 8))
+app.config['PASSWORD_HASH_TIMEOUT'] = float(
+    os.environ.get('PASSWORD_HASH_TIMEOUT', 5))
+
+# Page sizes for cursor-paginated lists (see pagination.py)
+app.config['MESSAGES_PER_PAGE'] = 100
+app.config['USERS_PER_PAGE'] = 60
+
+# Cache of the logged-in user, their follows and likes (see viewer_cache.py)
+app.config['VIEWER_CACHE_BACKEND'] = os.environ.get(
+    'VIEWER_CACHE_BACKEND', 'local')
+app.config['VIEWER_CACHE_URL'] = os.environ.get('VIEWER_CACHE_URL')
+app.config['VIEWER_CACHE_TTL'] = int(os.environ.get('VIEWER_CACHE_TTL', 60))
+app.config['VIEWER_CACHE_SIZE'] = int(
+    os.environ.get('VIEWER_CACHE_SIZE', 1024))
+
+# Cached HTML of message and user cards (see fragments.py)
+app.config['FRAGMENT_CACHE_SIZE'] = int(
+    os.environ.get('FRAGMENT_CACHE_SIZE', 10000))
+app.config['FRAGMENT_CACHE_TTL'] = int(
+    os.environ.get('FRAGMENT_CACHE_TTL', 3600))
+
+# Per-request SQL instrumentation (see instrumentation.py): requests over
+# these limits get logged, as do statements repeated more than
+# SQL_REPEATED_STATEMENT_LIMIT times in one request (likely N+1 queries).
+app.config['SLOW_REQUEST_MS'] = float(
+    os.environ.get('SLOW_REQUEST_MS', 500))
+app.config['SLOW_REQUEST_QUERIES'] = int(
+    os.environ.get('SLOW_REQUEST_QUERIES', 30))
+app.config['SQL_REPEATED_STATEMENT_LIMIT'] = int(
+    os.environ.get('SQL_REPEATED_STATEMENT_LIMIT', 10))
+
+# Streamed rendering of timelines, profiles and follow lists, off unless
+# STREAM_PAGES=1: bytes in the first chunk sent (the page's head), in
+# each later one, and rows fetched at a time (see streaming.py).
+app.config['STREAM_PAGES'] = os.environ.get('STREAM_PAGES', '0') != '0'
+app.config['STREAM_FIRST_CHUNK_SIZE'] = int(
+    os.environ.get('STREAM_FIRST_CHUNK_SIZE', 1024))
+app.config['STREAM_CHUNK_SIZE'] = int(
+    os.environ.get('STREAM_CHUNK_SIZE', 16384))
+app.config['STREAM_BATCH_SIZE'] = int(
+    os.environ.get('STREAM_BATCH_SIZE', 20))
+
+# Brotli/gzip compression of text responses of at least COMPRESS_MIN_SIZE
+# bytes, and of every streamed page (see compression.py)
+app.config['COMPRESS_RESPONSES'] = (
+    os.environ.get('COMPRESS_RESPONSES', '1') != '0')
+app.config['COMPRESS_MIN_SIZE'] = int(
+    os.environ.get('COMPRESS_MIN_SIZE', 1024))
+app.config['COMPRESS_GZIP_LEVEL'] = int(
+    os.environ.get('COMPRESS_GZIP_LEVEL', 6))
+app.config['COMPRESS_BROTLI_QUALITY'] = int(
+    os.environ.get('COMPRESS_BROTLI_QUALITY', 4))
+
+# Resized copies of users' images (see images.py): where they're kept, how
+# much disk they may use, the largest original fetched and how long to
+# wait for it, URL schemes it may be fetched with, and how long to wait
+# before trying an image that failed again.
+app.config['IMAGE_CACHE_DIR'] = os.environ.get(
+    'IMAGE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'warbler-images'))
+app.config['IMAGE_CACHE_MAX_BYTES'] = int(
+    os.environ.get('IMAGE_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+app.config['IMAGE_MAX_BYTES'] = int(
+    os.environ.get('IMAGE_MAX_BYTES', 10 * 1024 * 1024))
+app.config['IMAGE_FETCH_TIMEOUT'] = float(
+    os.environ.get('IMAGE_FETCH_TIMEOUT', 5))
+app.config['IMAGE_ORIGIN_SCHEMES'] = set(
+    os.environ.get('IMAGE_ORIGIN_SCHEMES', 'http,https').split(','))
+app.config['IMAGE_FAILURE_TTL'] = int(
+    os.environ.get('IMAGE_FAILURE_TTL', 300))
+
+# before the toolbar, so responses are compressed after it edits them
+compression.init_app(app)
 toolbar = DebugToolbarExtension(app)
 
+database.init_app(app)
 connect_db(app)
+viewer_cache.init_app(app)
+author_cache.init_app(app)
+passwords.init_app(app)
+instrumentation.init_app(app, db.Model)
+fragments.init_app(app)
+http_cache.init_app(app)
+images.init_app(app)
 
 
 ##############################################################################
@@ -31,13 +183,40 @@ connect_db(app)
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    Also adds the ids of the users they follow and the id of their latest
+    like, all from the viewer cache when possible.
+    """
+
+    viewer = None
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        viewer = viewer_cache.load_viewer(session[CURR_USER_KEY])
 
-    else:
-        g.user = None
+    g.user, g.following_ids, g.last_like_id = viewer or (None, set(), None)
+
+
+def active_user_or_404(user_id):
+    """The user with `user_id`; 404 if there's none or it was deleted."""
+
+    user = User.query.get(user_id)
+    if user is None or user.deactivated:
+        abort(404)
+
+    return user
+
+
+def viewer_following_ids(users):
+    """Ids among `users` that the logged-in user follows (none if anon)."""
+
+    return {user.id for user in users} & g.following_ids
+
+
+def viewer_liked_ids(messages):
+    """Ids among `messages` that the logged-in user likes (none if anon)."""
+
+    return g.user.liked_ids(messages) if g.user else set()
 
 
 def do_login(user):
@@ -99,6 +278,8 @@ def login():
                                  form.password.data)
 
         if user:
+            # saves the password if authenticate rehashed it
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -122,40 +303,157 @@ def logout():
 # General user routes:
 
 @app.route('/users')
+@database.read_only
 def list_users():
-    """Page with listing of users.
+    """Page with listing of users, newest first.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by username, bio or
+    location (best matches first, limited to the top results), or a
+    'before' param (a user id) to show the page after that user.
     """
 
-    search = request.args.get('q')
+    term = request.args.get('q')
+    next_cursor = None
+
+    if term:
+        users = search.search_users(term)
 
-    if not search:
-        users = User.query.all()
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        query = User.query.filter_by(deactivated=False)
+        before = parse_id_cursor(request.args.get('before'))
 
-    return render_template('users/index.html', users=users)
+        if before:
+            query = query.filter(User.id < before)
 
+        per_page = app.config['USERS_PER_PAGE']
+        users = query.order_by(User.id.desc()).limit(per_page + 1).all()
+        users, has_more = split_page(users, per_page)
+        next_cursor = users[-1].id if has_more else None
 
-@app.route('/users/<int:user_id>')
-def users_show(user_id):
-    """Show user profile."""
+    return render_template('users/index.html',
+                           users=users,
+                           search=term,
+                           next_cursor=next_cursor,
+                           following_ids=viewer_following_ids(users))
+
+
+@app.route('/users/autocomplete')
+def autocomplete_users():
+    """JSON list of users whose username starts with the 'q' param."""
 
-    user = User.query.get_or_404(user_id)
+    prefix = request.args.get('q', '')
+    users = search.autocomplete_users(prefix) if prefix else []
+
+    return jsonify([{'id': user.id,
+                     'username': user.username,
+                     'image_url': user.image_url}
+                    for user in users])
+
+
+def user_messages_query(user_id, before=None):
+    """Query of a user's messages older than `before`, newest first."""
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    query = (Message.query
+             .filter(Message.user_id == user_id)
+             .order_by(Message.id.desc()))
+
+    if before:
+        query = query.filter(Message.id < before)
+
+    return query
+
+
+def user_messages_page(user_id, before=None):
+    """A page of a user's messages older than the `before` cursor.
+
+    Returns (messages, cursor of the next page or None).
+    """
+
+    query = user_messages_query(user_id, before)
+    per_page = app.config['MESSAGES_PER_PAGE']
+    messages, has_more = split_page(query.limit(per_page + 1).all(), per_page)
+    next_cursor = messages[-1].id if has_more else None
+
+    return messages, next_cursor
+
+
+@app.route('/users/<int:user_id>')
+@database.read_only
+def users_show(user_id):
+    """Show user profile.
+
+    Takes an optional 'before' cursor param to show older messages.
+    """
+
+    user = active_user_or_404(user_id)
+    before = parse_id_cursor(request.args.get('before'))
+
+    # the ids and like counts of the page's messages change with anything
+    # shown about them but their (versioned) cards, so the page can be
+    # validated without loading the messages themselves
+    per_page = app.config['MESSAGES_PER_PAGE']
+    stamps = (user_messages_query(user_id, before)
+              .with_entities(Message.id, Message.likes_count)
+              .limit(per_page + 1)
+              .all())
+
+    def render():
+        page, has_more = split_page(stamps, per_page)
+        next_cursor = page[-1].id if has_more else None
+
+        # the stamps stand in for the messages when looking up likes, so
+        # a streamed page can render cards as their rows arrive
+        messages = streaming.rows(user_messages_query(user_id, before)
+                                  .limit(per_page))
+
+        return streaming.render('users/show.html',
+                                user=user,
+                                messages=messages,
+                                likes=viewer_liked_ids(page),
+                                next_cursor=next_cursor,
+                                following_ids=viewer_following_ids([user]))
+
+    return http_cache.conditional(
+        ('users_show', user.id, user.version, user.messages_count,
+         user.following_count, user.followers_count, user.likes_count,
+         [tuple(stamp) for stamp in stamps], http_cache.viewer_stamp()),
+        render)
+
+
+def follows_page(user_id, followers, before=None):
+    """A page of the users following `user_id` (if `followers`) or followed
+    by them, newest accounts first, after the `before` cursor (a user id).
+
+    Returns (users, cursor of the next page or None).
+    """
+
+    if followers:
+        this, other = Follows.user_being_followed_id, Follows.user_following_id
+    else:
+        this, other = Follows.user_following_id, Follows.user_being_followed_id
+
+    # ordering on the follows column, not users.id, lets the index on
+    # (this, other) serve the page
+    query = (User.query
+             .filter_by(deactivated=False)
+             .join(Follows, other == User.id)
+             .filter(this == user_id)
+             .order_by(other.desc()))
+
+    if before:
+        query = query.filter(other < before)
+
+    per_page = app.config['USERS_PER_PAGE']
+    users, has_more = split_page(query.limit(per_page + 1).all(), per_page)
+    next_cursor = users[-1].id if has_more else None
+
+    return users, next_cursor
 
 
 @app.route('/users/<int:user_id>/following')
+@database.read_only
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -163,11 +461,19 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = active_user_or_404(user_id)
+    before = parse_id_cursor(request.args.get('before'))
+    users, next_cursor = follows_page(user_id, False, before)
+
+    return streaming.render('users/following.html',
+                            user=user,
+                            users=users,
+                            next_cursor=next_cursor,
+                            following_ids=viewer_following_ids(users + [user]))
 
 
 @app.route('/users/<int:user_id>/followers')
+@database.read_only
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -175,22 +481,88 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = active_user_or_404(user_id)
+    before = parse_id_cursor(request.args.get('before'))
+    users, next_cursor = follows_page(user_id, True, before)
+
+    return streaming.render('users/followers.html',
+                            user=user,
+                            users=users,
+                            next_cursor=next_cursor,
+                            following_ids=viewer_following_ids(users + [user]))
 
 @app.route('/users/<int:user_id>/likes')
 def show_likes(user_id):
-    """Show list of messages this user has liked."""
+    """Show list of messages this user has liked, most recently liked first.
+
+    Takes an optional 'before' cursor param (a like id) for older likes.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    likes = [msg.id for msg in g.user.likes]
-    user = User.query.get_or_404(user_id)
+    user = active_user_or_404(user_id)
+    before = parse_id_cursor(request.args.get('before'))
+
+    query = (db.session
+             .query(Message, Likes.id)
+             .join(Likes, Likes.message_id == Message.id)
+             .join(User, User.id == Message.user_id)
+             .filter(Likes.user_id == user_id,
+                     User.deactivated.is_(False))
+             .options(joinedload(Message.user))
+             .order_by(Likes.id.desc()))
+
+    if before:
+        query = query.filter(Likes.id < before)
+
+    per_page = app.config['MESSAGES_PER_PAGE']
+    rows, has_more = split_page(query.limit(per_page + 1).all(), per_page)
+    messages = [msg for msg, like_id in rows]
+    next_cursor = rows[-1][1] if has_more else None
+
     return render_template('users/likes.html',
                            user=user,
-                           likes=likes)
+                           messages=messages,
+                           likes=viewer_liked_ids(messages),
+                           next_cursor=next_cursor,
+                           following_ids=viewer_following_ids([user]))
+
+
+def set_following(followed_user, following):
+    """Make the logged-in user follow `followed_user`, or stop following.
+
+    Does nothing if that's already the case; returns whether it changed.
+    """
+
+    if following:
+        changed = Follows.add(g.user.id, followed_user.id)
+    else:
+        changed = Follows.remove(g.user.id, followed_user.id)
+
+    if not changed:
+        return False
+
+    delta = 1 if following else -1
+
+    push = timeline.engine() == 'push'
+
+    if following:
+        if push:
+            timeline.add_author(g.user.id, followed_user.id)
+        g.following_ids.add(followed_user.id)
+    else:
+        if push:
+            timeline.remove_author(g.user.id, followed_user.id)
+        g.following_ids.discard(followed_user.id)
+
+    User.adjust_counts(g.user.id, following_count=delta)
+    User.adjust_counts(followed_user.id, followers_count=delta)
+    db.session.commit()
+    viewer_cache.invalidate(g.user.id, followed_user.id)
+
+    return True
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -201,9 +573,8 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+    followed_user = active_user_or_404(follow_id)
+    set_following(followed_user, True)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -216,9 +587,8 @@ def stop_following(follow_id):
         flash("Access unauthorized. ", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+    followed_user = active_user_or_404(follow_id)
+    set_following(followed_user, False)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -251,6 +621,7 @@ def profile():
             user.bio = bio
 
             db.session.commit()
+            viewer_cache.invalidate(user.id)
 
             return redirect(f'/users/{user.id}')
         else:
@@ -269,9 +640,9 @@ def delete_user():
         return redirect("/")
 
     do_logout()
-    
-    db.session.delete(g.user)
-    db.session.commit()
+
+    # hidden at once; its rows are removed by `flask purge-accounts`
+    purge.deactivate(g.user)
 
     return redirect("/signup")
 
@@ -293,21 +664,72 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        # not g.user.messages.append(), which loads all their messages
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        db.session.add(msg)
+        db.session.flush()
+        User.adjust_counts(g.user.id, messages_count=1)
+        if timeline.engine() == 'push':
+            timeline.fan_out(msg)
+        search.index_message(msg)
         db.session.commit()
+        viewer_cache.invalidate(g.user.id)
+        author_cache.add(msg)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
+@app.route('/messages/search')
+def messages_search():
+    """Search messages by their text.
+
+    Takes the search in the 'q' param; results are best matches first,
+    with a 'before' cursor param for the next page.
+    """
+
+    term = request.args.get('q', '').strip()
+    before = parse_score_cursor(request.args.get('before'))
+    results = []
+    next_cursor = None
+
+    if term:
+        per_page = app.config['MESSAGES_PER_PAGE']
+        results = search.search_messages(term, per_page + 1, before)
+        results, has_more = split_page(results, per_page)
+
+        if has_more:
+            msg, score = results[-1]
+            next_cursor = score_cursor(score, msg.id)
+
+    messages = [msg for msg, score in results]
+
+    return render_template('messages/search.html',
+                           term=term,
+                           messages=messages,
+                           likes=viewer_liked_ids(messages),
+                           next_cursor=next_cursor)
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@database.read_only
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg)
+    msg = Message.query.get_or_404(message_id)
+    if msg.user.deactivated:
+        abort(404)
+
+    def render():
+        return render_template('messages/show.html',
+                               message=msg,
+                               following_ids=viewer_following_ids([msg.user]))
+
+    return http_cache.conditional(
+        ('messages_show', msg.id, msg.version, msg.user.version,
+         http_cache.viewer_stamp()),
+        render)
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -319,12 +741,43 @@ def messages_destroy(message_id):
         return redirect("/")
 
     msg = Message.query.get(message_id)
+
+    likers = select([Likes.user_id]).where(Likes.message_id == msg.id)
+    User.adjust_counts(likers, likes_count=-1)
+    User.adjust_counts(msg.user_id, messages_count=-1)
+    search.unindex_message(msg)
+
     db.session.delete(msg)
     db.session.commit()
+    viewer_cache.invalidate(msg.user_id)
+    author_cache.invalidate(msg.user_id)
 
     return redirect(f"/users/{g.user.id}")
 
 
+def set_liked(message, liked):
+    """Make the logged-in user like `message`, or stop liking it.
+
+    Does nothing if that's already the case; returns whether it changed.
+    """
+
+    if liked:
+        changed = Likes.add(g.user.id, message.id)
+    else:
+        changed = Likes.remove(g.user.id, message.id)
+
+    if not changed:
+        return False
+
+    delta = 1 if liked else -1
+    User.adjust_counts(g.user.id, likes_count=delta)
+    Message.adjust_counts(message.id, likes_count=delta)
+    db.session.commit()
+    viewer_cache.invalidate(g.user.id)
+
+    return True
+
+
 @app.route('/messages/<int:message_id>/like', methods=["POST"])
 def messages_likes(message_id):
     """ Adding this message to the likes of a specific user"""
@@ -334,61 +787,363 @@ def messages_likes(message_id):
         return redirect("/")
 
     message = Message.query.get_or_404(message_id)
+    if message.user.deactivated:
+        abort(404)
 
-    if message not in g.user.likes:
-        g.user.likes.append(message)
+    # unlike it if it was liked, else like it: no need to look it up first
+    set_liked(message, False) or set_liked(message, True)
 
-    else:
-        g.user.likes.remove(message)
+    return redirect("/")
 
-    db.session.commit()
 
-    return redirect("/")
+##############################################################################
+# Images
+
+
+@app.route('/img/<size>/<int:user_id>')
+@database.read_only
+def user_image(size, user_id):
+    """A user's avatar or header image, resized to `size` and cached."""
+
+    if size not in images.SIZES:
+        abort(404)
+
+    user = active_user_or_404(user_id)
+    return images.send_image(images.source_url(user, size), size)
+
+
+##############################################################################
+# JSON API
+#
+# Compact payloads for clients that don't want whole pages: messages carry
+# their author's id, and each author appears once in a "users" map. Lists
+# are cursor paginated: pass a response's "next" back as ?before=. Message
+# ids (and so message cursors) are sent as strings: at 64 bits they're
+# too big for JavaScript numbers to hold exactly.
+
+# most user ids one request may ask about
+API_MAX_IDS = 100
+
+
+def api_error(status, message):
+    """A JSON error response."""
+
+    return jsonify(error=message), status
+
+
+def user_json(user):
+    """What the API shows of a user, including whether the viewer follows."""
+
+    return {
+        'id': user.id,
+        'username': user.username,
+        'image_url': user.image_url,
+        'header_image_url': user.header_image_url,
+        'bio': user.bio,
+        'location': user.location,
+        'messages': user.messages_count,
+        'following': user.following_count,
+        'followers': user.followers_count,
+        'likes': user.likes_count,
+        'followed': user.id in g.following_ids,
+    }
+
+
+def messages_json(messages, next_cursor):
+    """A page of messages, their authors and the next page's cursor."""
+
+    liked_ids = viewer_liked_ids(messages)
+
+    return {
+        'messages': [{
+            'id': str(msg.id),
+            'text': msg.text,
+            'timestamp': msg.timestamp.isoformat(),
+            'user_id': msg.user_id,
+            'likes': msg.likes_count,
+            'liked': msg.id in liked_ids,
+        } for msg in messages],
+        'users': {str(msg.user_id): user_json(msg.user) for msg in messages},
+        'next': str(next_cursor) if next_cursor else None,
+    }
+
+
+@app.route('/api/v1/relationships')
+def api_relationships():
+    """Whether the logged-in user follows, and is followed by, each user.
+
+    Takes up to API_MAX_IDS user ids as ?ids=1,2,3; answers for all of
+    them with one query.
+    """
+
+    if not g.user:
+        return api_error(401, "Log in first.")
+
+    try:
+        ids = [int(id) for id in request.args.get('ids', '').split(',') if id]
+    except ValueError:
+        return api_error(400, "ids must be comma separated user ids.")
+
+    if len(ids) > API_MAX_IDS:
+        return api_error(400, f"At most {API_MAX_IDS} ids at a time.")
+
+    follower_ids = g.user.follower_ids(ids)
+
+    return jsonify(relationships={
+        str(id): {'following': id in g.following_ids,
+                  'followed_by': id in follower_ids}
+        for id in ids})
+
+
+@app.route('/api/v1/timeline')
+def api_timeline():
+    """The logged-in user's home timeline."""
+
+    if not g.user:
+        return api_error(401, "Log in first.")
+
+    before = parse_id_cursor(request.args.get('before'))
+    return jsonify(messages_json(*home_timeline_page(before)))
+
+
+@app.route('/api/v1/users/<int:user_id>')
+def api_user(user_id):
+    """A user's profile and a page of their messages."""
+
+    user = User.query.get(user_id)
+    if user is None or user.deactivated:
+        return api_error(404, "No such user.")
+
+    before = parse_id_cursor(request.args.get('before'))
+    payload = messages_json(*user_messages_page(user_id, before))
+    payload['user'] = user_json(user)
+
+    return jsonify(payload)
+
+
+@app.route('/api/v1/messages/<int:message_id>/like',
+           methods=['POST', 'DELETE'])
+def api_like(message_id):
+    """Like (POST) or stop liking (DELETE) a message.
+
+    Repeating either is harmless. Answers with the new state and the
+    message's number of likes.
+    """
+
+    if not g.user:
+        return api_error(401, "Log in first.")
+
+    message = Message.query.get(message_id)
+    if message is None or message.user.deactivated:
+        return api_error(404, "No such message.")
+
+    liked = request.method == 'POST'
+    set_liked(message, liked)
+
+    return jsonify(liked=liked, likes=message.likes_count)
+
+
+@app.route('/api/v1/users/<int:user_id>/follow', methods=['POST', 'DELETE'])
+def api_follow(user_id):
+    """Follow (POST) or stop following (DELETE) a user.
+
+    Repeating either is harmless. Answers with the new state and the
+    user's number of followers.
+    """
+
+    if not g.user:
+        return api_error(401, "Log in first.")
+
+    user = User.query.get(user_id)
+    if user is None or user.deactivated:
+        return api_error(404, "No such user.")
+
+    set_following(user, request.method == 'POST')
+
+    return jsonify(following=user.id in g.following_ids,
+                   followers=user.followers_count)
 
 
 ##############################################################################
 # Homepage and error pages
 
 
+@app.errorhandler(passwords.HashingBusy)
+def hashing_busy(error):
+    """Shed load when password hashing is saturated."""
+
+    return "Too busy, please try again shortly.", 503, {'Retry-After': '1'}
+
+
+def home_timeline_page(before=None):
+    """A page of the logged-in user's home timeline.
+
+    Returns (messages, cursor of the next page or None).
+    """
+
+    per_page = app.config['MESSAGES_PER_PAGE']
+
+    if timeline.engine() == 'pull':
+        messages = author_cache.home_timeline(g.following_ids | {g.user.id},
+                                              limit=per_page + 1,
+                                              before=before)
+    else:
+        messages = timeline.home_timeline(g.user.id,
+                                          limit=per_page + 1,
+                                          before=before)
+    messages, has_more = split_page(messages, per_page)
+    next_cursor = messages[-1].id if has_more else None
+
+    return messages, next_cursor
+
+
 @app.route('/')
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: 100 most recent messages of followed_users, older pages
+      via the 'before' cursor param
     """
 
     if g.user:
-        likes = [msg.id for msg in g.user.likes]
-        following_id = [user.id for user in g.user.following]
-        following_id.append(g.user.id)
-
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_id))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-
-        return render_template('home.html', messages=messages, likes=likes)
+        before = parse_id_cursor(request.args.get('before'))
+        messages, next_cursor = home_timeline_page(before)
+
+        def render():
+            return streaming.render('home.html',
+                                    messages=messages,
+                                    likes=viewer_liked_ids(messages),
+                                    next_cursor=next_cursor)
+
+        return http_cache.conditional(
+            ('homepage', [(msg.id, msg.version, msg.user.version,
+                           msg.likes_count)
+                          for msg in messages],
+             next_cursor, http_cache.viewer_stamp()),
+            render)
 
     else:
         return render_template('home-anon.html')
 
 
+@app.route('/metrics')
+def metrics():
+    """Request and SQL metrics, in Prometheus text format.
+
+    Only answers requests from this machine, for a local scraper.
+    """
+
+    if request.remote_addr not in ('127.0.0.1', '::1'):
+        abort(404)
+
+    return (instrumentation.render_metrics(), 200,
+            {'Content-Type': 'text/plain; version=0.0.4'})
+
+
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# Maintenance commands
+
+
+@app.cli.command('migrate')
+def migrate():
+    """Apply any schema migrations not yet applied to the database."""
+
+    def progress(version, name):
+        click.echo(f"Applying migration {version}: {name}")
+
+    if not migrations.upgrade(db.engine, progress=progress):
+        click.echo("Database is up to date")
+
 
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
+@app.cli.command('check-indexes')
+def check_indexes():
+    """Check that the hot query paths are planned with their indexes."""
 
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+    missing = migrations.check_indexes()
+
+    for description, index in missing:
+        click.echo(f"{description}: not using {index}", err=True)
+
+    if missing:
+        raise SystemExit(1)
+
+    click.echo("All hot query paths use their indexes")
+
+
+@app.cli.command('rebuild-timelines')
+@click.option('--batch-size', default=1000,
+              help='Number of users rebuilt per transaction.')
+def rebuild_timelines(batch_size):
+    """Backfill every home timeline from the messages/follows tables."""
+
+    def progress(done, total):
+        click.echo(f"Rebuilt timelines for {done}/{total} user ids")
+
+    timeline.rebuild(batch_size=batch_size, progress=progress)
+
+
+@app.cli.command('trim-timelines')
+@click.option('--batch-size', default=1000,
+              help='Number of users trimmed per transaction.')
+@click.option('--every', type=float,
+              help='Keep running, trimming this often (seconds).')
+def trim_timelines(batch_size, every):
+    """Cut home timelines back to TIMELINE_MAX_LENGTH entries."""
+
+    while True:
+        removed = timeline.trim_all(batch_size=batch_size)
+        click.echo(f"Trimmed {removed} timeline entries")
+
+        if not every:
+            return
+
+        db.session.remove()
+        time.sleep(every)
+
+
+@app.cli.command('reindex-messages')
+@click.option('--batch-size', default=10000,
+              help='Number of messages indexed per transaction.')
+def reindex_messages(batch_size):
+    """Build the full-text search index for messages not yet indexed."""
+
+    def progress(done):
+        click.echo(f"Indexed {done} messages")
+
+    search.reindex_messages(batch_size=batch_size, progress=progress)
+
+
+@app.cli.command('purge-accounts')
+@click.option('--batch-size', default=1000,
+              help='Number of rows deleted per transaction.')
+@click.option('--every', type=float,
+              help='Keep running, checking for deleted accounts this often '
+                   '(seconds).')
+def purge_accounts(batch_size, every):
+    """Remove the rows of deleted accounts, in batches."""
+
+    def progress(job):
+        click.echo(f"Purging user {job.user_id}: {job.stage}, "
+                   f"{job.rows_deleted} rows deleted")
+
+    while True:
+        purged = purge.purge(batch_size=batch_size, progress=progress)
+        if purged:
+            click.echo(f"Purged {purged} accounts")
+
+        if not every:
+            return
+
+        db.session.remove()
+        time.sleep(every)
+
+
+@app.cli.command('reconcile-counts')
+def reconcile_counts():
+    """Recompute every user's and message's counters."""
+
+    User.reconcile_counts()
+    Message.reconcile_counts()
+    db.session.commit()
+    click.echo("Recomputed user and message counters")
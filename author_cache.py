@@ -0,0 +1,220 @@
+"""Pull-model home timelines, from per-author caches of recent messages.
+
+The alternative to fan-out on write (timeline.py): nothing is written per
+follower when someone posts. Instead each author's newest
+AUTHOR_CACHE_LENGTH message ids are cached, and a home timeline is a
+k-way merge of the lists of everyone the viewer follows, stopping once
+it has a page. Posting costs the same however many followers the author
+has; reading costs one cache lookup per followed author.
+
+Message ids are time-ordered (see snowflake.py), so merging id lists
+newest-first is merging by time. Authors missing from the cache are
+loaded in one query, and so are those whose cached list runs out
+before a deep page (a `before` cursor past what's cached).
+
+Routes keep the lists current: `add()` after a message is posted,
+`invalidate()` after one is deleted. Both drop the author's list rather
+than edit it, by changing the author's version: a list is stored with
+the version read before it was loaded from the database, and is only
+used while that is still the current one. So a reader that loads a
+list just before a post commits, and stores it just after, stores a
+list that's already out of date, not one that hides the post for
+AUTHOR_CACHE_TTL.
+
+The cache backend is chosen like the viewer cache's (see
+viewer_cache.py), by AUTHOR_CACHE_BACKEND; with more than one worker,
+use 'redis' so every worker sees every post.
+
+TIMELINE_ENGINE picks this ('pull') or fan-out on write ('push') for the
+homepage, so `bench.py --timeline-engine` can compare the two.
+"""
+
+import heapq
+import uuid
+from itertools import islice
+
+from flask import current_app
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload
+
+from models import db, Message, User
+from viewer_cache import LRUCache, SharedCache
+
+DEFAULT_LENGTH = 200
+
+
+def make_cache(config):
+    """Build the cache described by the app's AUTHOR_CACHE_* settings."""
+
+    backend = config.get('AUTHOR_CACHE_BACKEND', 'local')
+    ttl = config.get('AUTHOR_CACHE_TTL', 3600)
+
+    if backend == 'redis':
+        # only needed for the shared backend, so not a hard requirement
+        import redis
+
+        client = redis.Redis.from_url(config['AUTHOR_CACHE_URL'])
+        return SharedCache(client, ttl=ttl, prefix='warbler:author:')
+
+    if backend == 'local':
+        return LRUCache(max_size=config.get('AUTHOR_CACHE_SIZE', 10000),
+                        ttl=ttl)
+
+    raise ValueError(f"Unknown AUTHOR_CACHE_BACKEND: {backend}")
+
+
+def init_app(app):
+    """Attach an author cache to `app`."""
+
+    app.extensions['author_cache'] = make_cache(app.config)
+
+
+def get_cache():
+    """The author cache of the current app."""
+
+    return current_app.extensions['author_cache']
+
+
+def length():
+    """Number of message ids cached for each author."""
+
+    return current_app.config.get('AUTHOR_CACHE_LENGTH', DEFAULT_LENGTH)
+
+
+def _load_ids(author_ids, limit, before=None):
+    """{author id: their newest `limit` message ids}, in one query.
+
+    `before`, if given, is a message id; only older messages count.
+    Deactivated authors have none.
+    """
+
+    position = (func.row_number()
+                .over(partition_by=Message.user_id,
+                      order_by=Message.id.desc())
+                .label('position'))
+
+    ranked = (db.session
+              .query(Message.user_id, Message.id, position)
+              .join(User, User.id == Message.user_id)
+              .filter(Message.user_id.in_(author_ids),
+                      User.deactivated.is_(False)))
+
+    if before:
+        ranked = ranked.filter(Message.id < before)
+
+    ranked = ranked.subquery()
+
+    rows = (db.session
+            .query(ranked.c.user_id, ranked.c.id)
+            .filter(ranked.c.position <= limit)
+            .order_by(ranked.c.user_id, ranked.c.id.desc()))
+
+    ids = {author_id: [] for author_id in author_ids}
+    for author_id, id in rows:
+        ids[author_id].append(id)
+
+    return ids
+
+
+def _version_key(author_id):
+    return f'{author_id}:version'
+
+
+def recent_ids(author_ids):
+    """{author id: newest message ids, newest first} for `author_ids`.
+
+    Authors missing from the cache, or whose list is out of date, are
+    loaded and cached.
+    """
+
+    author_ids = list(author_ids)
+    cache = get_cache()
+
+    values = cache.get_many([str(id) for id in author_ids] +
+                            [_version_key(id) for id in author_ids])
+    entries = dict(zip(author_ids, values[:len(author_ids)]))
+    versions = dict(zip(author_ids, values[len(author_ids):]))
+
+    found = {}
+    missing = []
+
+    for author_id in author_ids:
+        entry = entries[author_id]
+        version = versions[author_id]
+
+        if entry is not None and version is not None and entry[0] == version:
+            found[author_id] = entry[1]
+            continue
+
+        # the version must be read (or made) before the list is loaded
+        if version is None:
+            version = invalidate(author_id)
+            versions[author_id] = version
+        missing.append(author_id)
+
+    if missing:
+        for author_id, ids in _load_ids(missing, length()).items():
+            cache.set(str(author_id), [versions[author_id], ids])
+            found[author_id] = ids
+
+    return {author_id: found[author_id] for author_id in author_ids}
+
+
+def add(msg):
+    """Drop the author's list after they post a message (just committed).
+
+    They're loaded again when next needed.
+    """
+
+    invalidate(msg.user_id)
+
+
+def invalidate(author_id):
+    """Drop `author_id`'s list after they post or delete a message, or
+    their account is deleted; returns their new version.
+
+    (Dropping one id would make a full list look like all of the
+    author's messages.)
+    """
+
+    version = uuid.uuid4().hex
+    get_cache().set(_version_key(author_id), version)
+    return version
+
+
+def home_timeline(author_ids, limit=100, before=None):
+    """Return the newest `limit` messages by `author_ids`.
+
+    `author_ids` is everyone the viewer follows, plus the viewer. `before`
+    is an optional message id; only messages older than it are returned.
+    """
+
+    full = length()
+    streams = []
+    deeper = []
+
+    for author_id, ids in recent_ids(author_ids).items():
+        older = [id for id in ids if id < before] if before else ids
+
+        # a full list may be hiding older messages this page needs
+        if len(ids) >= full and len(older) < limit:
+            deeper.append(author_id)
+        else:
+            streams.append(older)
+
+    if deeper:
+        streams.extend(_load_ids(deeper, limit, before).values())
+
+    ids = list(islice(heapq.merge(*streams, reverse=True), limit))
+    if not ids:
+        return []
+
+    messages = (Message
+                .query
+                .filter(Message.id.in_(ids))
+                .options(joinedload(Message.user))
+                .all())
+    by_id = {msg.id: msg for msg in messages}
+
+    # ids of messages deleted since they were cached drop out here
+    return [by_id[id] for id in ids if id in by_id]
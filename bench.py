@@ -0,0 +1,346 @@
+"""Benchmark Warbler's routes against seeded databases.
+
+Run it like:
+
+    python bench.py [--sizes 1000,100000,1000000] [--requests 200]
+                    [--database-url URL ...] [--output bench.json]
+                    [--compare old-bench.json] [--timeline-engine pull]
+
+For each size (number of messages) this generates a data set with
+generator/create_csvs.py, seeds the database with it (see seed.py), then
+drives the main routes through the Flask test client as randomly chosen
+logged-in users. For every route it reports p50/p95/p99 latency and the
+SQL statements run and ORM rows loaded per request, and writes it all to
+a JSON file; pass an earlier file as --compare to see what changed.
+Inputs are the same for the same --seed, so to compare the two ways of
+building home timelines (see author_cache.py), run once with
+--timeline-engine push and once with pull, comparing the second to the
+first.
+
+Without --database-url it runs against a scratch SQLite file, and against
+a local Postgres database, warbler-bench, if one can be reached. Each
+database is benchmarked in its own process, since the app binds to its
+database when imported. THE DATABASES ARE WIPED.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from random import Random
+
+DEFAULT_DATABASES = [
+    'sqlite:///' + os.path.join(tempfile.gettempdir(), 'warbler-bench.db'),
+    'postgresql:///warbler-bench',
+]
+
+# exit status of a run whose database can't be reached
+UNAVAILABLE = 3
+
+GENERATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'generator', 'create_csvs.py')
+
+
+def data_set(size):
+    """Generator arguments for a data set of `size` messages."""
+
+    users = max(100, size // 10)
+    return {
+        'users': users,
+        'messages': size,
+        'follows': users * 20,
+        'likes': size // 2,
+    }
+
+
+def percentile(timings, percent):
+    """Nearest-rank percentile of a sorted list of timings."""
+
+    index = max(0, -(-len(timings) * percent // 100) - 1)
+    return timings[int(index)]
+
+
+##############################################################################
+# Measuring one database (runs in its own process)
+
+
+class Counters:
+    """SQL statements and ORM rows loaded, counted via SQLAlchemy events."""
+
+    def __init__(self, engine, model):
+        from sqlalchemy import event
+
+        self.queries = 0
+        self.rows = 0
+
+        event.listen(engine, 'before_cursor_execute', self.on_execute)
+        event.listen(model, 'load', self.on_load, propagate=True)
+
+    def on_execute(self, *args):
+        self.queries += 1
+
+    def on_load(self, *args):
+        self.rows += 1
+
+    def reset(self):
+        self.queries = self.rows = 0
+
+
+def routes(rng, users, message_ids):
+    """(route name, method, url, form) for one request to each route."""
+
+    user_id = rng.randint(1, users)
+    message_id = rng.choice(message_ids)
+
+    return [
+        ('homepage', 'GET', '/', None),
+        ('users_show', 'GET', f'/users/{user_id}', None),
+        ('list_users', 'GET', '/users', None),
+        ('list_users_search', 'GET',
+         f'/users?q={rng.choice("aeiou")}{rng.choice("nrst")}', None),
+        ('show_following', 'GET', f'/users/{user_id}/following', None),
+        ('show_likes', 'GET', f'/users/{user_id}/likes', None),
+        ('messages_add', 'POST', '/messages/new',
+         {'text': 'Benchmarking warbles.'}),
+        ('messages_likes', 'POST', f'/messages/{message_id}/like', None),
+    ]
+
+
+def measure(client, counters, rng, sizes, message_ids, requests, warmup):
+    """Time `requests` calls of every route as random logged-in users."""
+
+    from app import CURR_USER_KEY
+
+    samples = {}
+
+    for number in range(warmup + requests):
+        viewer = rng.randint(1, sizes['users'])
+
+        for name, method, url, form in routes(rng, sizes['users'],
+                                              message_ids):
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = viewer
+
+            counters.reset()
+            started = time.perf_counter()
+            resp = client.open(url, method=method, data=form)
+            elapsed = time.perf_counter() - started
+
+            if resp.status_code >= 400:
+                raise RuntimeError(f"{method} {url}: {resp.status_code}")
+
+            if number >= warmup:
+                samples.setdefault(name, []).append(
+                    (elapsed, counters.queries, counters.rows))
+
+    return samples
+
+
+def summarize(samples):
+    """Latency percentiles (ms) and mean SQL/rows for each route."""
+
+    results = {}
+
+    for name, route_samples in samples.items():
+        timings = sorted(elapsed * 1000 for elapsed, _, _ in route_samples)
+        count = len(route_samples)
+
+        results[name] = {
+            'requests': count,
+            'p50_ms': round(percentile(timings, 50), 3),
+            'p95_ms': round(percentile(timings, 95), 3),
+            'p99_ms': round(percentile(timings, 99), 3),
+            'mean_ms': round(sum(timings) / count, 3),
+            'queries': round(sum(q for _, q, _ in route_samples) / count, 2),
+            'max_queries': max(q for _, q, _ in route_samples),
+            'rows': round(sum(r for _, _, r in route_samples) / count, 2),
+        }
+
+    return results
+
+
+def run_database(args, database_url):
+    """Benchmark every size against `database_url`; returns the results."""
+
+    # the app connects to DATABASE_URL when it's imported
+    os.environ['DATABASE_URL'] = database_url
+
+    from sqlalchemy.exc import OperationalError
+
+    from app import app
+    from models import db, Message
+    import author_cache
+    import seed
+    import viewer_cache
+
+    try:
+        db.engine.connect().close()
+    except OperationalError:
+        print(f"{database_url} is not available, skipping", file=sys.stderr)
+        sys.exit(UNAVAILABLE)
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['DEBUG_TB_ENABLED'] = False
+    app.config['TIMELINE_ENGINE'] = args.timeline_engine
+
+    counters = Counters(db.engine, db.Model)
+    results = []
+
+    for size in args.sizes:
+        sizes = data_set(size)
+
+        with tempfile.TemporaryDirectory() as data_dir:
+            print(f"{db.engine.dialect.name}, {size} messages: generating",
+                  flush=True)
+            subprocess.run(
+                [sys.executable, GENERATOR, '--out-dir', data_dir,
+                 '--seed', str(args.seed)] +
+                [f'--{option}={value}' for option, value in sizes.items()],
+                check=True, stdout=subprocess.DEVNULL)
+
+            seed.seed(data_dir, log=lambda line: None)
+
+        # forget the previous data set's users and messages
+        viewer_cache.init_app(app)
+        author_cache.init_app(app)
+
+        # message ids are time-based (see snowflake.py), not 1..size
+        with app.app_context():
+            message_ids = [id for (id,) in (db.session
+                                            .query(Message.id)
+                                            .order_by(Message.id))]
+
+        print(f"{db.engine.dialect.name}, {size} messages: measuring",
+              flush=True)
+        samples = measure(app.test_client(), counters,
+                          Random(args.seed), sizes, message_ids,
+                          args.requests, args.warmup)
+
+        for name, summary in summarize(samples).items():
+            results.append(dict(database=db.engine.dialect.name, size=size,
+                                route=name, **summary))
+
+    return results
+
+
+##############################################################################
+# Putting runs together
+
+
+def run_children(args, database_urls):
+    """Benchmark each database in a child process and gather results."""
+
+    results = []
+
+    for database_url in database_urls:
+        with tempfile.NamedTemporaryFile(suffix='.json') as output:
+            child = subprocess.run(
+                [sys.executable, os.path.abspath(__file__),
+                 '--database-url', database_url,
+                 '--sizes', ','.join(str(size) for size in args.sizes),
+                 '--requests', str(args.requests),
+                 '--warmup', str(args.warmup),
+                 '--seed', str(args.seed),
+                 '--timeline-engine', args.timeline_engine,
+                 '--output', output.name])
+
+            if child.returncode == UNAVAILABLE:
+                continue
+            if child.returncode:
+                sys.exit(child.returncode)
+
+            results.extend(json.load(output)['results'])
+
+    return results
+
+
+def git_commit():
+    """The commit being benchmarked, if we're in a git checkout."""
+
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results, baseline=None):
+    """Print a table of results, with changes against `baseline`."""
+
+    previous = {(result['database'], result['size'], result['route']): result
+                for result in (baseline or {}).get('results', [])}
+
+    print(f"{'database':<10} {'size':>8} {'route':<18} {'p50':>8} "
+          f"{'p95':>8} {'p99':>8} {'queries':>8} {'rows':>8}")
+
+    for result in results:
+        line = (f"{result['database']:<10} {result['size']:>8} "
+                f"{result['route']:<18} {result['p50_ms']:>8.2f} "
+                f"{result['p95_ms']:>8.2f} {result['p99_ms']:>8.2f} "
+                f"{result['queries']:>8.1f} {result['rows']:>8.1f}")
+
+        old = previous.get(
+            (result['database'], result['size'], result['route']))
+        if old:
+            change = (result['p95_ms'] / old['p95_ms'] - 1) * 100
+            line += (f"  p95 {change:+.0f}%, queries "
+                     f"{result['queries'] - old['queries']:+.1f}")
+
+        print(line)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1000',
+                        type=lambda sizes: [int(size) for size in
+                                            sizes.split(',')],
+                        help='comma-separated numbers of messages')
+    parser.add_argument('--requests', type=int, default=100,
+                        help='measured requests per route and size')
+    parser.add_argument('--warmup', type=int, default=5,
+                        help='unmeasured requests per route first')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeline-engine', choices=['push', 'pull'],
+                        default='push',
+                        help='how home timelines are built')
+    parser.add_argument('--database-url', action='append',
+                        help='database to benchmark (repeatable)')
+    parser.add_argument('--output', default='bench.json')
+    parser.add_argument('--compare', help='earlier --output to compare with')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    database_urls = args.database_url or DEFAULT_DATABASES
+
+    if len(database_urls) == 1:
+        results = run_database(args, database_urls[0])
+    else:
+        results = run_children(args, database_urls)
+
+    with open(args.output, 'w') as output:
+        json.dump({
+            'commit': git_commit(),
+            'created': datetime.utcnow().isoformat(),
+            'sizes': args.sizes,
+            'requests': args.requests,
+            'timeline_engine': args.timeline_engine,
+            'results': results,
+        }, output, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as compare:
+            baseline = json.load(compare)
+
+    report(results, baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+"""Response compression for Warbler.
+
+An after_request hook compresses text responses (pages, JSON, CSS) with
+brotli or gzip, whichever the client prefers of those it accepts. Brotli
+needs the `brotli` package (see requirements.txt); should it be missing,
+a warning is logged at startup and responses are only ever gzipped.
+
+- Bodies under COMPRESS_MIN_SIZE bytes are sent as they are, since
+  compressing them saves less than it costs.
+- Streamed responses (see streaming.py) have no size up front, so they
+  are always compressed. Each chunk is flushed through the compressor,
+  so it still reaches the client as soon as it's rendered.
+- COMPRESS_GZIP_LEVEL and COMPRESS_BROTLI_QUALITY trade CPU for size.
+  The defaults suit pages compressed on every request.
+
+Compressed responses carry `Vary: Accept-Encoding`. A strong ETag
+becomes weak, since the compressed bytes differ from the uncompressed
+ones; `http_cache.conditional()` compares ETags weakly, so either form
+validates.
+
+Files served straight from disk are left alone.
+"""
+
+import zlib
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:  # required; init_app() warns if it's missing
+    brotli = None
+
+COMPRESSIBLE_TYPES = {
+    'application/javascript',
+    'application/json',
+    'image/svg+xml',
+    'text/css',
+    'text/html',
+    'text/javascript',
+    'text/plain',
+}
+
+
+class _Gzip:
+    def __init__(self, config):
+        # wbits 31: a gzip header and trailer around the deflate stream
+        self.compressor = zlib.compressobj(config['COMPRESS_GZIP_LEVEL'],
+                                           zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+class _Brotli:
+    def __init__(self, config):
+        self.compressor = brotli.Compressor(
+            mode=brotli.MODE_TEXT,
+            quality=config['COMPRESS_BROTLI_QUALITY'])
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+ENCODINGS = {'br': _Brotli, 'gzip': _Gzip}
+
+
+def _offered():
+    return ['br', 'gzip'] if brotli else ['gzip']
+
+
+def _compressible(resp):
+    return (request.method != 'HEAD'
+            and resp.status_code == 200
+            and not resp.direct_passthrough
+            and 'Content-Encoding' not in resp.headers
+            and resp.mimetype in COMPRESSIBLE_TYPES
+            and 'no-transform' not in resp.headers.get('Cache-Control', ''))
+
+
+def _stream(body, compressor):
+    """Compress the chunks of a streamed `body`, flushing after each."""
+
+    for chunk in body:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+
+        data = compressor.compress(chunk) + compressor.flush()
+        if data:
+            yield data
+
+    yield compressor.finish()
+
+
+def compress_response(resp):
+    """after_request hook: compress `resp` if it's worth it."""
+
+    config = current_app.config
+
+    if not config['COMPRESS_RESPONSES'] or not _compressible(resp):
+        return resp
+
+    resp.vary.add('Accept-Encoding')
+
+    if not resp.is_streamed:
+        if resp.calculate_content_length() < config['COMPRESS_MIN_SIZE']:
+            return resp
+
+    encoding = request.accept_encodings.best_match(_offered())
+    if encoding is None:
+        return resp
+
+    compressor = ENCODINGS[encoding](config)
+
+    if resp.is_streamed:
+        resp.response = _stream(resp.response, compressor)
+        resp.headers.pop('Content-Length', None)
+    else:
+        resp.set_data(compressor.compress(resp.get_data())
+                      + compressor.finish())
+
+    resp.headers['Content-Encoding'] = encoding
+
+    tag, weak = resp.get_etag()
+    if tag and not weak:
+        resp.set_etag(tag, weak=True)
+
+    return resp
+
+
+def init_app(app):
+    """Compress `app`'s responses.
+
+    Call before registering other after_request hooks: Flask runs them in
+    reverse, so this one runs last and sees their changes.
+    """
+
+    app.after_request(compress_response)
+
+    if brotli is None:
+        app.logger.warning("brotli is not installed: responses will be "
+                           "gzipped only")
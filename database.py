@@ -0,0 +1,202 @@
+"""Database engines for Warbler: pooling, fork safety and read replicas.
+
+Pooling: `engine_options()` turns the DB_POOL_* settings into options for
+every engine (see app.py): how many connections each process keeps, how
+many more it may open under load, how long a request waits for one, how
+old one may get before it's replaced, whether it's checked before use,
+and a per-statement timeout so one runaway query can't hold a
+connection forever.
+
+Forking: a connection opened before `fork()` (say, by a gunicorn master
+with preload_app) would be shared by parent and child, and closing it in
+either one breaks it for both. After a fork the child swaps in fresh,
+empty pools and keeps the inherited ones alive but untouched, so their
+connections are never used or closed from the wrong process.
+
+SQLite (tests and development) is told to enforce foreign keys, so its
+ON DELETE CASCADEs work as they do on Postgres.
+
+Replicas: with DATABASE_REPLICA_URL set, views wrapped in `@read_only`
+run their queries against the replica, while flushes and everything
+else go to the primary. Someone who has just written something reads
+from the primary for REPLICA_STICKY_SECONDS, so they see their own
+changes despite replication lag.
+"""
+
+import functools
+import os
+import time
+import weakref
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import event, orm
+from sqlalchemy.pool import QueuePool
+
+REPLICA = 'replica'
+
+# session key: time until which this user's reads go to the primary
+PRIMARY_UNTIL_KEY = 'db_primary_until'
+
+# every engine created, for resetting their pools after fork()
+_engines = weakref.WeakSet()
+
+# pools inherited across fork(): kept referenced, so that their
+# connections are never closed from this process
+_inherited_pools = []
+
+
+##############################################################################
+# Engines
+
+
+def engine_options(config):
+    """SQLAlchemy create_engine() options from the DB_POOL_* settings."""
+
+    url = config['SQLALCHEMY_DATABASE_URI']
+
+    # sqlite connects without a queue pool; none of these apply
+    if url.startswith('sqlite'):
+        return {}
+
+    options = {
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+    }
+
+    timeout = config['DB_STATEMENT_TIMEOUT_MS']
+    if timeout:
+        options['connect_args'] = {
+            'options': f'-c statement_timeout={timeout}'}
+
+    return options
+
+
+class RoutingSession(SignallingSession):
+    """A session that reads from the replica inside `@read_only` views."""
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and _use_replica(self.app):
+            return self.db.get_engine(self.app, bind=REPLICA)
+
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with replica routing and fork-safe engines."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super().create_engine(sa_url, engine_opts)
+        _engines.add(engine)
+
+        if engine.dialect.name == 'sqlite':
+            event.listen(engine, 'connect', _enforce_foreign_keys)
+
+        return engine
+
+
+def _enforce_foreign_keys(dbapi_connection, connection_record):
+    """Turn on SQLite's foreign keys (and cascades), off by default."""
+
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA foreign_keys=ON')
+    cursor.close()
+
+
+def _replace_inherited_pools():
+    """In a forked child, give every engine a fresh pool."""
+
+    for engine in list(_engines):
+        _inherited_pools.append(engine.pool)
+        engine.pool = engine.pool.recreate()
+
+
+os.register_at_fork(after_in_child=_replace_inherited_pools)
+
+
+##############################################################################
+# Read replicas
+
+
+def read_only(view):
+    """Decorate a view whose queries may be answered by the replica."""
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        g.db_read_only = True
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+def _use_replica(app):
+    return (has_request_context()
+            and g.get('db_read_only', False)
+            and REPLICA in app.config['SQLALCHEMY_BINDS']
+            and session.get(PRIMARY_UNTIL_KEY, 0) <= time.time())
+
+
+def _stick_to_primary(response):
+    """after_request hook: send this user's reads to the primary a while."""
+
+    if (request.method not in ('GET', 'HEAD', 'OPTIONS')
+            and response.status_code < 400
+            and REPLICA in current_app.config['SQLALCHEMY_BINDS']):
+        session[PRIMARY_UNTIL_KEY] = (
+            time.time() + current_app.config['REPLICA_STICKY_SECONDS'])
+
+    return response
+
+
+##############################################################################
+# Metrics
+
+
+def pool_stats(db, app):
+    """{bind: {stat: value}} for each queue-pooled engine of `app`."""
+
+    binds = [(None, 'primary')]
+    if REPLICA in app.config['SQLALCHEMY_BINDS']:
+        binds.append((REPLICA, REPLICA))
+
+    stats = {}
+
+    for bind, name in binds:
+        pool = db.get_engine(app, bind=bind).pool
+
+        if isinstance(pool, QueuePool):
+            stats[name] = {
+                'size': pool.size(),
+                'checked_out': pool.checkedout(),
+                'idle': pool.checkedin(),
+                'overflow': max(pool.overflow(), 0),
+            }
+
+    return stats
+
+
+##############################################################################
+# Setup
+
+
+def init_app(app):
+    """Configure `app`'s engines; call before connect_db()."""
+
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
+
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    if app.config['DATABASE_REPLICA_URL']:
+        binds[REPLICA] = app.config['DATABASE_REPLICA_URL']
+    app.config['SQLALCHEMY_BINDS'] = binds
+
+    app.after_request(_stick_to_primary)
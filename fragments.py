@@ -0,0 +1,115 @@
+"""Cached HTML fragments for message and user cards.
+
+Timelines, profiles and user lists render the same cards over and over,
+and most of a card (avatar, username, text, timestamp, bio) changes only
+when its user or message does. Each card's HTML is cached per process,
+keyed by the object's id and stored with the versions it was rendered
+from; the `version` columns of `User` and `Message` are bumped whenever
+they change (see models.py), so a stale card is simply rendered again.
+
+What depends on the viewer (like and follow buttons) isn't cached: the
+calling template passes it in a `{% call %}` block, which is rendered on
+every request and stitched into the card's slot:
+
+    {% call message_card(msg) %}
+      ...like button...
+    {% endcall %}
+
+FRAGMENT_CACHE_SIZE caps the number of cards kept (0 turns caching off);
+FRAGMENT_CACHE_TTL is how long one is kept, in seconds.
+"""
+
+from flask import current_app
+from markupsafe import Markup
+from sqlalchemy import event
+
+from models import Message, User
+from viewer_cache import LRUCache
+
+# where the viewer's part goes in a card; an HTML comment, so a card
+# rendered without a `call` block is still valid
+SLOT = '<!-- viewer -->'
+
+
+class FragmentCache:
+    """Cards rendered in this process, with the versions they show."""
+
+    def __init__(self):
+        self.cache = None
+
+    def configure(self, config):
+        size = config.get('FRAGMENT_CACHE_SIZE', 10000)
+        self.cache = (LRUCache(max_size=size,
+                               ttl=config.get('FRAGMENT_CACHE_TTL', 3600))
+                      if size else None)
+
+    def render(self, key, versions, template, **context):
+        """HTML of `template` for `key`, re-rendered if `versions` moved."""
+
+        entry = self.cache.get(key) if self.cache else None
+
+        if entry and entry[0] == versions:
+            return entry[1]
+
+        html = current_app.jinja_env.get_template(template).render(**context)
+
+        if self.cache:
+            self.cache.set(key, (versions, html))
+
+        return html
+
+    def forget(self, key):
+        if self.cache:
+            self.cache.delete(key)
+
+
+fragments = FragmentCache()
+
+
+def _stitch(html, caller):
+    """Put what the viewer sees (the `call` block, if any) into the slot."""
+
+    return Markup(html.replace(SLOT, caller() if caller else ''))
+
+
+def message_card(message, caller=None):
+    """A message's timeline card; shows its author too."""
+
+    html = fragments.render(f'message:{message.id}',
+                            (message.version, message.user.version),
+                            'messages/_card.html', message=message,
+                            slot=Markup(SLOT))
+    return _stitch(html, caller)
+
+
+def user_card(user, caller=None):
+    """A user's card, as shown in user lists."""
+
+    html = fragments.render(f'user:{user.id}', (user.version,),
+                            'users/_card.html', user=user, slot=Markup(SLOT))
+    return _stitch(html, caller)
+
+
+def _forget_reused_id(prefix):
+    """Listener dropping the card of a newly inserted row's id.
+
+    Postgres never reuses ids, but other databases may hand a deleted
+    row's id to a new row with the same version.
+    """
+
+    def forget(mapper, connection, target):
+        fragments.forget(f'{prefix}:{target.id}')
+
+    return forget
+
+
+event.listen(Message, 'after_insert', _forget_reused_id('message'))
+event.listen(User, 'after_insert', _forget_reused_id('user'))
+
+
+def init_app(app):
+    """Make the card helpers available to `app`'s templates."""
+
+    fragments.configure(app.config)
+    app.jinja_env.globals.update(message_card=message_card,
+                                 user_card=user_card)
@@ -2,27 +2,61 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, e.g. for load testing:
+
+    python generator/create_csvs.py --users 1000000 --messages 10000000 \\
+        --follows 20000000 --likes 5000000 --out-dir /tmp/warbler-data
+
+Everything is derived from --seed, so the same arguments always produce
+the same files, however many --workers generate them. No network access
+is needed.
+
+Rows are generated in chunks on a process pool and streamed to disk, so
+memory use doesn't grow with the data set. Follows and messages are
+skewed toward a few popular/prolific users with a power law (see
+`popular_id`), instead of sampling from every possible pair of users.
+
+Message ids are time-ordered like the app's (see snowflake.py): the nth
+message is posted at `message_time(n)`, spread evenly over two years, and
+its id is made from that time and n, so likes can refer to message n
+without keeping a list of ids.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
-from faker import Faker
-from helpers import get_random_datetime
+import os
+import shutil
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from math import gcd
+from random import Random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from snowflake import make_id
 
 MAX_WARBLER_LENGTH = 140
 
-USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
-MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
+USERS_CSV_HEADERS = ['id', 'email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
+MESSAGES_CSV_HEADERS = ['id', 'text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
 NUM_FOLLWERS = 5000
+NUM_LIKES = 0
+
+CHUNK_SIZE = 100000
+
+# hash of "password", so every generated user can log in
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-fake = Faker()
+# timestamps are spread over the two years before this, so output doesn't
+# depend on when the generator runs
+START_TIME = datetime(2018, 1, 1)
+END_TIME = datetime(2020, 1, 1)
 
 # Generate random profile image URLs to use for users
 
@@ -32,46 +66,317 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
-
 header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
+    "/static/images/warbler-hero.jpg",
+    "/static/images/signed-out-home.jpg",
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+WORDS = """
+    able about account act add after again against age agent air all also
+    always among analysis animal answer any appear apply area argue arm around
+    art article artist ask attack attention audience author avoid away baby
+    back bad bag ball bank bar base beat beautiful become bed before begin
+    behind believe best better between beyond big bill bird black blood blue
+    board body book born both box boy break bring brother budget build
+    business buy call camera campaign capital car card care career carry case
+    cat catch cause cell center central century certain chair challenge
+    chance change character charge check child choice choose church citizen
+    city civil claim class clear close coach cold collection college color
+    come common community company compare computer concern condition
+    conference consider contain continue control cost could country couple
+    course court cover create crime cultural culture cup current customer cut
+    dark data daughter day dead deal death debate decade decide decision deep
+    defense degree democrat describe design despite detail determine develop
+    die difference different difficult dinner direction director discover
+    discuss disease doctor dog door down draw dream drive drop drug during
+    each early east easy eat economic edge education effect effort eight
+    either election else employee end energy enjoy enough enter entire
+    environment especially establish even evening event ever every evidence
+    exactly example executive exist expect experience expert explain eye face
+    fact factor fail fall family far fast father fear federal feel field
+    fight figure fill film final finally financial find fine finger finish
+    fire firm first fish five floor fly focus follow food foot force foreign
+    forget form former forward four free friend front full fund future game
+    garden gas general generation girl give glass goal good government great
+    green ground group grow growth guess gun guy hair half hand hang happen
+    happy hard have head health hear heart heat heavy help here herself high
+    history hit hold home hope hospital hot hotel hour house huge human
+    hundred husband idea identify image imagine impact important improve
+    include increase indeed indicate industry information inside instead
+    interest international interview investment issue item itself job join
+    just keep key kid kill kind kitchen know land language large last late
+    later laugh law lawyer lay lead leader learn least leave left leg legal
+    less letter level lie life light like likely line list listen little
+    live local long look lose loss lot love low machine magazine main
+    maintain major majority make manage management manager many market
+    marriage material matter maybe mean measure media medical meet meeting
+    member memory mention message method middle might military million mind
+    minute miss mission model modern moment money month more morning most
+    mother mouth move movement movie much music must myself name nation
+    national natural nature near nearly necessary need network never new news
+    newspaper next nice night none north note nothing notice number occur
+    off offer office officer official often oil old once one only onto open
+    operation opportunity option order organization other others outside own
+    owner page pain painting paper parent part participant particular partner
+    party pass past patient pattern pay peace people per perform performance
+    perhaps period person personal phone physical pick picture piece place
+    plan plant play player point police policy political politics poor
+    popular population position positive possible power practice prepare
+    present president pressure pretty prevent price private probably problem
+    process produce product production professional professor program
+    project property protect prove provide public pull purpose push put
+    quality question quickly quite race radio raise range rate rather reach
+    read ready real reality realize really reason receive recent recently
+    recognize record red reduce reflect region relate remain remember remove
+    report represent require research resource respond response rest result
+    return reveal rich right rise risk road rock role room rule run safe same
+    save say scene school science scientist score sea season seat second
+    section security see seek seem sell send senior sense series serious
+    serve service set seven several shake share shoot short shot should
+    shoulder show side sign significant similar simple simply since sing
+    single sister sit site situation six size skill skin small smile social
+    society soldier some somebody someone something sometimes son song soon
+    sort sound source south southern space speak special specific speech
+    spend sport spring staff stage stand standard star start state statement
+    station stay step still stock stop store story strategy street strong
+    structure student study stuff style subject success successful such
+    suddenly suffer suggest summer support sure surface system table take
+    talk task tax teach teacher team technology television tell ten tend term
+    test than thank that their them themselves then theory there these they
+    thing think third this those though thought thousand threat three through
+    throughout throw thus time today together tonight too top total tough
+    toward town trade traditional training travel treat treatment tree trial
+    trip trouble true truth try turn two type under understand unit until
+    upon use usually value various very victim view violence visit voice vote
+    wait walk wall want war watch water way weapon wear week weight well west
+    western what whatever when where whether which while white whole whom
+    whose why wide wife will win wind window wish with within without woman
+    wonder word work worker world worry would write writer wrong yard yeah
+    year yes yet you young your yourself
+""".split()
+
+CITIES = """
+    Springfield Riverside Franklin Greenville Bristol Clinton Fairview Salem
+    Madison Georgetown Arlington Ashland Burlington Manchester Oxford Jackson
+    Milton Newport Centerville Dover Hudson Kingston Marion Vernon
+""".split()
+
+
+##############################################################################
+# Helpers
+
+
+def popular_id(rng, n, skew, stride):
+    """Pick an id in 1..n, biased toward a few very popular ids.
+
+    `rng.random() ** skew` piles up near 0, so low ranks are picked far
+    more often than high ones: the rank density falls off as a power law.
+    Multiplying the rank by `stride` (coprime with n) scatters the popular
+    ranks across the id space instead of making ids 1, 2, 3... the stars.
+    """
+
+    rank = int(n * rng.random() ** skew)
+    return (rank * stride) % n + 1
+
+
+def coprime_stride(n):
+    """A large stride that is coprime with `n`, for `popular_id`."""
+
+    stride = 7919
+    while gcd(stride, n) != 1:
+        stride += 2
+    return stride
+
+
+def sentence(rng, max_length):
+    """A random sentence of up to `max_length` characters."""
+
+    words = [rng.choice(WORDS) for _ in range(rng.randint(4, 20))]
+    text = ' '.join(words).capitalize() + '.'
+    return text[:max_length]
+
+
+def message_time(args, number):
+    """When message `number` (1..args.messages) was posted.
+
+    Messages are evenly spaced, each nudged by a deterministic jitter of
+    up to half the spacing so they don't look machine-made.
+    """
+
+    spacing = (END_TIME - START_TIME) / args.messages
+    jitter = (number * 2654435761 % 1000) / 2000
+
+    return START_TIME + spacing * (number - 1 + jitter)
+
+
+def message_id(args, number):
+    """The time-ordered id of message `number`."""
+
+    return make_id(message_time(args, number), number)
+
+
+def chunk_rng(seed, table, chunk):
+    """Random generator for one chunk; independent of worker scheduling."""
+
+    return Random(f"{seed}:{table}:{chunk}")
+
+
+def share(total, parts, index):
+    """The `index`th of `parts` near-equal shares of `total`."""
+
+    return total // parts + (1 if index < total % parts else 0)
+
+
+##############################################################################
+# Chunk generators: each returns the rows of one chunk
+
+
+def users_chunk(args, chunk, first_id, count):
+    rng = chunk_rng(args.seed, 'users', chunk)
+
+    for id in range(first_id, first_id + count):
+        yield [
+            id,
+            f"user{id}@example.com",
+            f"{rng.choice(WORDS)}{id}",
+            rng.choice(image_urls),
+            PASSWORD,
+            sentence(rng, 100),
+            rng.choice(header_image_urls),
+            rng.choice(CITIES),
+        ]
+
+
+def messages_chunk(args, chunk, first_id, count):
+    rng = chunk_rng(args.seed, 'messages', chunk)
+    stride = coprime_stride(args.users)
+
+    for number in range(first_id, first_id + count):
+        yield [
+            message_id(args, number),
+            sentence(rng, MAX_WARBLER_LENGTH),
+            message_time(args, number),
+            popular_id(rng, args.users, args.skew, stride),
+        ]
+
+
+def _pick_distinct(rng, n, count, skew, stride, exclude):
+    """`count` distinct popularity-biased ids in 1..n, none in `exclude`."""
+
+    count = min(count, n - len(exclude))
+
+    if count > n // 2:
+        # dense: a plain sample is cheaper than rejecting repeats
+        candidates = [id for id in range(1, n + 1) if id not in exclude]
+        return rng.sample(candidates, count)
+
+    picked = set()
+    while len(picked) < count:
+        id = popular_id(rng, n, skew, stride)
+        if id not in exclude:
+            picked.add(id)
+
+    return sorted(picked)
+
+
+def follows_chunk(args, chunk, first_follower, count):
+    rng = chunk_rng(args.seed, 'follows', chunk)
+    stride = coprime_stride(args.users)
+
+    for follower in range(first_follower, first_follower + count):
+        degree = share(args.follows, args.users, follower - 1)
+        for followed in _pick_distinct(rng, args.users, degree, args.skew,
+                                       stride, exclude={follower}):
+            yield [followed, follower]
+
+
+def likes_chunk(args, chunk, first_user, count):
+    rng = chunk_rng(args.seed, 'likes', chunk)
+    stride = coprime_stride(args.messages)
+
+    for user in range(first_user, first_user + count):
+        degree = share(args.likes, args.users, user - 1)
+        for message in _pick_distinct(rng, args.messages, degree, args.skew,
+                                      stride, exclude=set()):
+            yield [user, message_id(args, message)]
+
+
+TABLES = [
+    # (file name, headers, chunk generator, rows split into chunks)
+    ('users.csv', USERS_CSV_HEADERS, users_chunk, 'users'),
+    ('messages.csv', MESSAGES_CSV_HEADERS, messages_chunk, 'messages'),
+    ('follows.csv', FOLLOWS_CSV_HEADERS, follows_chunk, 'users'),
+    ('likes.csv', LIKES_CSV_HEADERS, likes_chunk, 'users'),
+]
+
+
+##############################################################################
+# Writing files
+
+
+def write_chunk(args, generate, chunk, first, count, path):
+    """Write one chunk's rows to `path`; runs in a worker process."""
+
+    with open(path, 'w', newline='') as part:
+        csv.writer(part).writerows(generate(args, chunk, first, count))
+
+    return path
+
+
+def write_table(executor, args, name, headers, generate, split_on):
+    """Generate one CSV in chunks on `executor`, then join the parts."""
+
+    total = getattr(args, split_on)
+    path = os.path.join(args.out_dir, name)
+
+    futures = [
+        executor.submit(write_chunk, args, generate, chunk, first,
+                        min(args.chunk_size, total - first + 1),
+                        f"{path}.part{chunk:06d}")
+        for chunk, first in enumerate(range(1, total + 1, args.chunk_size))
+    ]
+
+    with open(path, 'w', newline='') as out:
+        csv.writer(out).writerow(headers)
+
+        for future in futures:
+            part_path = future.result()
+            with open(part_path, newline='') as part:
+                shutil.copyfileobj(part, out)
+            os.remove(part_path)
+
+    print(f"Wrote {path}", flush=True)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Generate Warbler CSVs for seeding and load tests.")
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLWERS)
+    parser.add_argument('--likes', type=int, default=NUM_LIKES)
+    parser.add_argument('--seed', type=int, default=0,
+                        help='same seed, same data')
+    parser.add_argument('--skew', type=float, default=3.0,
+                        help='power-law skew of follows/messages/likes; '
+                             '1 is uniform')
+    parser.add_argument('--out-dir', default='generator')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help='users or messages per work unit')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for name, headers, generate, split_on in TABLES:
+            if name == 'likes.csv' and not args.likes:
+                continue
+            write_table(executor, args, name, headers, generate, split_on)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Gunicorn settings for Warbler; read automatically by `gunicorn app:app`.
+
+Two serving modes, picked with WORKER_CLASS:
+
+- sync (the default): one request at a time per worker process, so a
+  worker is idle while it waits on the database. Size WEB_CONCURRENCY
+  at about 2-4 workers per CPU.
+
+- gevent: each worker runs requests in greenlets, and psycopg2 is made
+  cooperative with psycogreen, so while one request waits on Postgres
+  the worker serves others. A few workers per machine (WEB_CONCURRENCY
+  of about one per CPU) can each keep WORKER_CONNECTIONS requests in
+  flight. Needs `pip install gevent psycogreen`.
+
+  Requests in flight per worker are also capped by the database
+  connection pool, since each one holds a connection while it queries;
+  keep DB_POOL_SIZE + DB_MAX_OVERFLOW (see app.py) about as large as
+  the requests you expect to overlap, and the total across workers
+  under the server's max_connections.
+  CPU-heavy work doesn't yield, which is why password hashing already
+  runs in its own process pool (see passwords.py).
+
+Settings, all from the environment:
+
+    WORKER_CLASS        sync or gevent (default sync)
+    WEB_CONCURRENCY     worker processes (default 2 per CPU for sync,
+                        1 per CPU for gevent)
+    WORKER_CONNECTIONS  greenlets per gevent worker (default 100)
+    PORT                port to listen on (default 8000)
+    WORKER_TIMEOUT      seconds before a stuck worker is restarted
+                        (default 30)
+    SNOWFLAKE_WORKER_ID_BASE
+                        first snowflake worker id of this machine's
+                        workers (default 0); see below
+
+Every worker gets its own snowflake worker id (see snowflake.py): the
+base plus the worker's slot, 0 to WEB_CONCURRENCY - 1, which a restarted
+worker takes over from the one it replaces. With several machines, give
+each a base at least WEB_CONCURRENCY above the last one's, so no two
+processes anywhere share an id.
+
+Compare the two with loadtest.py, e.g.:
+
+    WORKER_CLASS=sync gunicorn app:app &
+    python loadtest.py --url http://127.0.0.1:8000 --concurrency 50
+    WORKER_CLASS=gevent gunicorn app:app &
+    python loadtest.py --url http://127.0.0.1:8000 --concurrency 50
+"""
+
+import multiprocessing
+import os
+import sys
+
+worker_class = os.environ.get('WORKER_CLASS', 'sync')
+
+workers = int(os.environ.get(
+    'WEB_CONCURRENCY',
+    multiprocessing.cpu_count() * (1 if worker_class == 'gevent' else 2)))
+
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 100))
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+
+timeout = int(os.environ.get('WORKER_TIMEOUT', 30))
+
+worker_id_base = int(os.environ.get('SNOWFLAKE_WORKER_ID_BASE', 0))
+
+
+def pre_fork(server, worker):
+    """Give the worker about to start the lowest slot no live worker has."""
+
+    taken = {getattr(live, 'slot', None) for live in server.WORKERS.values()}
+    worker.slot = min(slot for slot in range(len(taken) + 1)
+                      if slot not in taken)
+
+
+def post_fork(server, worker):
+    """Set the worker's snowflake worker id from its slot, and let psycopg2
+    yield to other greenlets while it waits on Postgres.
+    """
+
+    os.environ['SNOWFLAKE_WORKER_ID'] = str(worker_id_base + worker.slot)
+
+    # with preload_app the module is already loaded, with a random id
+    if 'snowflake' in sys.modules:
+        sys.modules['snowflake'].reset()
+
+    if worker_class == 'gevent':
+        from psycogreen.gevent import patch_psycopg
+
+        patch_psycopg()
@@ -0,0 +1,183 @@
+"""HTTP caching for Warbler.
+
+Static files: `url_for('static', ...)` links to content-hashed file names
+(style.css becomes style.<hash>.css), and those are served with a
+year-long, immutable max-age; a new deploy changes the hash, and so the
+URL. Un-hashed URLs still work, with Flask's shorter default max-age.
+
+Pages: routes whose content can be summed up cheaply pass a few version
+stamps to `conditional()`, which answers a matching If-None-Match with a
+304 before anything is rendered. Pages that depend on the viewer include
+`viewer_stamp()` in their ETag and are marked private, so only the
+viewer's own browser keeps them. Anything else gets `no-cache`: it may be
+stored, but is checked with the server before each use.
+"""
+
+import hashlib
+import os
+import re
+
+from flask import (current_app, g, make_response, request, send_from_directory,
+                   session)
+
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+
+# style.0123456789ab.css -> style.css
+_HASHED_NAME = re.compile(
+    r'^(?P<stem>.+)\.(?P<hash>[0-9a-f]{12})(?P<extension>\.[^./]+)$')
+
+# {static filename: (modification time, content hash)}
+_static_hashes = {}
+
+
+##############################################################################
+# Static files
+
+
+def static_hash(filename):
+    """Hash of a static file's content, or None if there is no such file."""
+
+    path = os.path.join(current_app.static_folder, filename)
+
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+
+    cached = _static_hashes.get(filename)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    with open(path, 'rb') as static_file:
+        digest = hashlib.md5(static_file.read()).hexdigest()[:12]
+
+    _static_hashes[filename] = (mtime, digest)
+    return digest
+
+
+def _hash_static_urls(endpoint, values):
+    """url_defaults hook: link static files by their hashed names."""
+
+    if endpoint != 'static' or 'filename' not in values:
+        return
+
+    digest = static_hash(values['filename'])
+    if digest:
+        stem, extension = os.path.splitext(values['filename'])
+        values['filename'] = f'{stem}.{digest}{extension}'
+
+
+def send_static(filename):
+    """Serve a static file by its plain or hashed name.
+
+    A hashed name matching the file's current content is cached for a
+    year; anything else gets the default max-age, so a page from an older
+    deploy still finds its assets without pinning the new content.
+    """
+
+    match = _HASHED_NAME.match(filename)
+
+    if match:
+        plain = match['stem'] + match['extension']
+        current = static_hash(plain)
+
+        if current == match['hash']:
+            resp = send_from_directory(current_app.static_folder, plain,
+                                       cache_timeout=STATIC_MAX_AGE)
+            resp.headers['Cache-Control'] = (
+                f'public, max-age={STATIC_MAX_AGE}, immutable')
+            return resp
+
+        if current:
+            filename = plain
+
+    return current_app.send_static_file(filename)
+
+
+##############################################################################
+# Pages
+
+
+def _template_digest(app):
+    """Hash of every template, so a deploy that changes them changes ETags."""
+
+    digest = hashlib.md5()
+
+    for folder, _, files in sorted(os.walk(os.path.join(app.root_path,
+                                                        app.template_folder))):
+        for name in sorted(files):
+            with open(os.path.join(folder, name), 'rb') as template:
+                digest.update(template.read())
+
+    return digest.hexdigest()
+
+
+def viewer_stamp():
+    """What a page can depend on about the logged-in user.
+
+    Their row, counters, who they follow (hashing the id set is cheap,
+    since it's already loaded in `g`) and their latest like, which with
+    likes_count stands in for what they like.
+    """
+
+    if not g.user:
+        return None
+
+    user = g.user
+    return (user.id, user.version, user.messages_count,
+            user.following_count, user.followers_count, user.likes_count,
+            hash(frozenset(g.following_ids)), g.last_like_id)
+
+
+def etag(*parts):
+    """A strong ETag summing up `parts` and the deployed templates."""
+
+    digest = hashlib.sha1(current_app.extensions['http_cache'].encode())
+    digest.update(repr(parts).encode())
+    return digest.hexdigest()
+
+
+def conditional(parts, render):
+    """Respond to a GET whose content is determined by `parts`.
+
+    Answers 304 Not Modified if the client's copy is current; otherwise
+    calls `render()` for the body. Pages with flashed messages are neither
+    validated nor stored, as the flash shows only once.
+    """
+
+    if session.get('_flashes'):
+        resp = make_response(render())
+        resp.headers['Cache-Control'] = 'no-store'
+        return resp
+
+    tag = etag(*parts)
+
+    # weakly, as compression.py weakens the ETags of compressed responses
+    if request.if_none_match.contains_weak(tag):
+        resp = current_app.response_class(status=304)
+    else:
+        resp = make_response(render())
+
+    resp.set_etag(tag)
+    resp.headers['Cache-Control'] = (
+        'private, no-cache' if g.user else 'public, no-cache')
+    return resp
+
+
+def default_cache_policy(resp):
+    """after_request hook: revalidate responses no route set a policy for."""
+
+    if 'Cache-Control' not in resp.headers:
+        resp.headers['Cache-Control'] = (
+            'private, no-cache' if g.get('user') else 'no-cache')
+
+    return resp
+
+
+def init_app(app):
+    """Serve hashed static files and set default cache headers on `app`."""
+
+    app.extensions['http_cache'] = _template_digest(app)
+    app.url_defaults(_hash_static_urls)
+    app.view_functions['static'] = send_static
+    app.after_request(default_cache_policy)
@@ -0,0 +1,390 @@
+"""Resized, locally cached user images for Warbler.
+
+Users' avatars and header images are links to wherever they uploaded
+them, often full-size photos. Cards show them a few dozen pixels wide,
+so rather than hot-linking the originals, templates link
+`/img/<size>/<user id>` (see `image_url()`), and that route:
+
+- fetches the user's image once (http(s) URLs, or files under /static),
+- resizes and crops it to one of SIZES (twice the CSS size, for
+  high-density screens),
+- stores the result in an on-disk cache, and
+- serves it with a year-long, immutable max-age.
+
+The link carries a hash of the image's source URL (`?v=`), so a user
+changing their picture changes the link; a link with an old hash still
+works, but is only cached briefly.
+
+The cache is content-addressed: resized images are stored under the hash
+of their bytes, and a small ref file maps (size, source URL) to that
+hash. Users sharing an image, like everyone on the default avatar, share
+one file, and the hash is the ETag. Once the images pass
+IMAGE_CACHE_MAX_BYTES, the least recently served are deleted; every
+hit touches its file's modification time, so that's what eviction goes
+by. The cache is plain files, so every worker on a machine shares it.
+
+Resizing needs Pillow (see requirements.txt). Should it be missing, a
+warning is logged at startup and images are still fetched once and
+served from the cache, but at their original size.
+
+Only hosts on the public internet are fetched from: a URL (or a
+redirect) naming a loopback, private or link-local address, say the
+cloud metadata service or /metrics, is refused, since the request would
+come from inside the network.
+
+An image that can't be fetched, or isn't a PNG, JPEG, GIF or WebP,
+redirects to its source URL (as the page used to link it), and isn't
+tried again for IMAGE_FAILURE_TTL seconds.
+"""
+
+import hashlib
+import io
+import ipaddress
+import os
+import socket
+import tempfile
+import urllib.parse
+import urllib.request
+
+from flask import current_app, redirect, request, send_file, url_for
+from werkzeug.security import safe_join
+
+from models import User
+from viewer_cache import LRUCache
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # required; init_app() warns if it's missing
+    Image = None
+
+MAX_AGE = 365 * 24 * 60 * 60
+
+# name: (User column, width, height)
+SIZES = {
+    'thumb': ('image_url', 96, 96),          # timeline and nav avatars
+    'avatar': ('image_url', 140, 140),       # user card avatars
+    'header': ('header_image_url', 700, 252),  # user card headers
+}
+
+# leading bytes: (mimetype, file extension)
+_SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', ('image/png', '.png')),
+    (b'\xff\xd8\xff', ('image/jpeg', '.jpg')),
+    (b'GIF87a', ('image/gif', '.gif')),
+    (b'GIF89a', ('image/gif', '.gif')),
+]
+
+_MIMETYPES = {extension: mimetype
+              for _, (mimetype, extension) in _SIGNATURES}
+_MIMETYPES['.webp'] = 'image/webp'
+
+
+class ImageError(Exception):
+    """An image couldn't be fetched, or isn't an image we serve."""
+
+
+def image_type(data):
+    """(mimetype, extension) of image bytes `data`, or None if unknown."""
+
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp', '.webp'
+
+    for signature, found in _SIGNATURES:
+        if data.startswith(signature):
+            return found
+
+    return None
+
+
+##############################################################################
+# The on-disk cache
+
+
+class ImageCache:
+    """Content-addressed image files, evicted least recently used first."""
+
+    def __init__(self, directory, max_bytes):
+        self.objects = os.path.join(directory, 'objects')
+        self.refs = os.path.join(directory, 'refs')
+        self.max_bytes = max_bytes
+
+        os.makedirs(self.objects, exist_ok=True)
+        os.makedirs(self.refs, exist_ok=True)
+
+    @staticmethod
+    def _ref_name(key):
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def _write(self, path, data):
+        """Write `data` to `path` all at once, for concurrent readers."""
+
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as temp_file:
+            temp_file.write(data)
+        os.replace(temp, path)
+
+    def get(self, key):
+        """Path of the image stored for `key`, or None; marks it used."""
+
+        ref = os.path.join(self.refs, self._ref_name(key))
+
+        try:
+            with open(ref) as ref_file:
+                name = ref_file.read()
+            path = os.path.join(self.objects, name)
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+
+        return path
+
+    def put(self, key, data, extension):
+        """Store image bytes `data` for `key`; returns their path."""
+
+        name = hashlib.sha256(data).hexdigest() + extension
+        path = os.path.join(self.objects, name)
+
+        if os.path.exists(path):
+            os.utime(path)
+        else:
+            self._write(path, data)
+            self.evict(keep=path)
+
+        self._write(os.path.join(self.refs, self._ref_name(key)),
+                    name.encode())
+        return path
+
+    def evict(self, keep=None):
+        """Delete the least recently used images until under max_bytes.
+
+        The image at `keep`, just stored, stays even if that's too much.
+        Refs to deleted images are left behind, and read as misses.
+        """
+
+        entries = []
+        for entry in os.scandir(self.objects):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:  # evicted by another worker
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+##############################################################################
+# Fetching and resizing
+
+
+def check_public(url):
+    """Raise ImageError unless `url` is http(s) on a public host.
+
+    Every address the host resolves to must be globally routable.
+    """
+
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ImageError(f"Unsupported image URL: {url}")
+
+    try:
+        addresses = socket.getaddrinfo(parts.hostname, parts.port or None,
+                                       proto=socket.IPPROTO_TCP)
+    except (OSError, ValueError) as error:  # gaierror is an OSError
+        raise ImageError(f"Couldn't resolve {url}: {error}") from error
+
+    for *_, sockaddr in addresses:
+        address = ipaddress.ip_address(sockaddr[0].split('%')[0])
+        if not address.is_global:
+            raise ImageError(f"Not a public address ({address}): {url}")
+
+
+class _PublicRedirectHandler(urllib.request.HTTPRedirectHandler):
+    """Follow redirects only to public hosts."""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        check_public(newurl)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+_opener = urllib.request.build_opener(_PublicRedirectHandler)
+
+
+def fetch(url):
+    """The bytes of the image at `url`.
+
+    Paths under /static are read from the app's static folder; other URLs
+    must use one of IMAGE_ORIGIN_SCHEMES, and http(s) ones a public host
+    (see `check_public()`), as must every redirect.
+    """
+
+    config = current_app.config
+    max_bytes = config['IMAGE_MAX_BYTES']
+    scheme = urllib.parse.urlsplit(url).scheme
+
+    try:
+        if url.startswith('/static/'):
+            path = safe_join(current_app.static_folder,
+                             url[len('/static/'):].split('?')[0])
+            if path is None:
+                raise ImageError(f"Bad static path: {url}")
+            with open(path, 'rb') as image_file:
+                data = image_file.read(max_bytes + 1)
+
+        elif scheme in config['IMAGE_ORIGIN_SCHEMES']:
+            if scheme in ('http', 'https'):
+                check_public(url)
+            fetch_request = urllib.request.Request(
+                url, headers={'User-Agent': 'Warbler image proxy'})
+            with _opener.open(
+                    fetch_request,
+                    timeout=config['IMAGE_FETCH_TIMEOUT']) as response:
+                data = response.read(max_bytes + 1)
+
+        else:
+            raise ImageError(f"Unsupported image URL: {url}")
+
+    except (OSError, ValueError) as error:  # URLError is an OSError
+        raise ImageError(f"Couldn't fetch {url}: {error}") from error
+
+    if len(data) > max_bytes:
+        raise ImageError(f"Image over {max_bytes} bytes: {url}")
+
+    if image_type(data) is None:
+        raise ImageError(f"Not an image: {url}")
+
+    return data
+
+
+def resize(data, width, height):
+    """Image bytes `data` cropped and scaled to `width` x `height`.
+
+    Returns (bytes, extension). PNG for images with transparency, JPEG
+    otherwise; the original bytes if Pillow isn't installed.
+    """
+
+    if Image is None:
+        return data, image_type(data)[1]
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            # JPEGs can decode at a fraction of their size, much faster
+            image.draft('RGB', (width * 2, height * 2))
+            image = ImageOps.exif_transpose(image)
+            resized = ImageOps.fit(image, (width, height), Image.LANCZOS)
+    except (OSError, ValueError, Image.DecompressionBombError) as error:
+        raise ImageError(f"Unreadable image: {error}") from error
+
+    out = io.BytesIO()
+
+    if resized.mode in ('RGBA', 'LA') or 'transparency' in resized.info:
+        resized.convert('RGBA').save(out, 'PNG', optimize=True)
+        return out.getvalue(), '.png'
+
+    resized.convert('RGB').save(out, 'JPEG', quality=85, optimize=True,
+                                progressive=True)
+    return out.getvalue(), '.jpg'
+
+
+##############################################################################
+# Serving
+
+
+def url_version(url):
+    """Short hash of a source URL, to put in links to its resized image."""
+
+    return hashlib.sha1(url.encode()).hexdigest()[:10]
+
+
+def source_url(user, size):
+    """URL of the image of `user`'s that `size` is a size of."""
+
+    column = SIZES[size][0]
+    return getattr(user, column) or getattr(User, column).default.arg
+
+
+def image_url(user, size):
+    """Link to `user`'s image resized to `size` (a key of SIZES)."""
+
+    return url_for('user_image', size=size, user_id=user.id,
+                   v=url_version(source_url(user, size)))
+
+
+def _cached_image(url, size):
+    """Path of `url` resized to `size`, fetching it if it isn't cached."""
+
+    cache = current_app.extensions['image_cache']
+    key = f'{size}\n{url}'
+
+    path = cache.get(key)
+    if path is None:
+        _, width, height = SIZES[size]
+        data, extension = resize(fetch(url), width, height)
+        path = cache.put(key, data, extension)
+
+    return path
+
+
+def send_image(url, size):
+    """Respond with the image at `url`, resized to `size`.
+
+    Cached for a year if the request's `v` matches `url`, as a link from
+    `image_url()` to the current image does; briefly otherwise.
+    """
+
+    failures = current_app.extensions['image_failures']
+
+    if failures.get(url):
+        path = None
+    else:
+        try:
+            path = _cached_image(url, size)
+        except ImageError as error:
+            current_app.logger.warning("%s", error)
+            failures.set(url, True)
+            path = None
+
+    if path is None:
+        resp = redirect(url)
+        resp.headers['Cache-Control'] = (
+            f"public, max-age={current_app.config['IMAGE_FAILURE_TTL']}")
+        return resp
+
+    name = os.path.basename(path)
+    resp = send_file(open(path, 'rb'),
+                     mimetype=_MIMETYPES[os.path.splitext(name)[1]],
+                     add_etags=False)
+
+    if request.args.get('v') == url_version(url):
+        resp.headers['Cache-Control'] = f'public, max-age={MAX_AGE}, immutable'
+    else:
+        resp.headers['Cache-Control'] = 'public, no-cache'
+
+    resp.set_etag(os.path.splitext(name)[0])
+    return resp.make_conditional(request)
+
+
+def init_app(app):
+    """Give `app` an image cache, and `image_url()` in templates."""
+
+    config = app.config
+    app.extensions['image_cache'] = ImageCache(config['IMAGE_CACHE_DIR'],
+                                               config['IMAGE_CACHE_MAX_BYTES'])
+    app.extensions['image_failures'] = LRUCache(
+        max_size=1024, ttl=config['IMAGE_FAILURE_TTL'])
+    app.jinja_env.globals.update(image_url=image_url)
+
+    if Image is None:
+        app.logger.warning("Pillow is not installed: user images will be "
+                           "served at full size, not resized")
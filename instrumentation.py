@@ -0,0 +1,307 @@
+"""Per-request SQL instrumentation for Warbler.
+
+Always on, and cheap enough for production: SQLAlchemy engine events
+time every statement run while handling a request, and mapper load
+events count the rows loaded into models. When the request ends its
+totals are added to per-route counters, and it is logged if it was slow,
+ran too many statements, or repeated one statement shape often enough
+to look like an N+1 query:
+
+- SLOW_REQUEST_MS: log requests that took longer than this
+- SLOW_REQUEST_QUERIES: log requests that ran more statements than this
+- SQL_REPEATED_STATEMENT_LIMIT: log statement shapes run more often
+  than this in one request
+
+The counters, and the slowest statements seen for each route, are
+served in Prometheus text format by `render_metrics()`.
+"""
+
+import re
+import threading
+import time
+from collections import Counter
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import database
+import passwords
+
+# slowest statements remembered per route
+SLOWEST_KEPT = 5
+
+_PLACEHOLDER = re.compile(r"%\(\w+\)s|:\w+|\b\d+\b")
+_PLACEHOLDER_LIST = re.compile(r"\?(\s*,\s*\?)+")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def statement_shape(statement):
+    """`statement` with its literals and bind parameters blanked out.
+
+    Statements that differ only in their values, or in the length of an
+    IN list, have the same shape.
+    """
+
+    shape = _PLACEHOLDER.sub('?', statement)
+    shape = _PLACEHOLDER_LIST.sub('?', shape)
+    return _WHITESPACE.sub(' ', shape).strip()
+
+
+class RequestStats:
+    """SQL run while handling one request."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0
+        self.rows = 0
+        self.shapes = Counter()
+        self.slowest = []
+
+    def add_statement(self, statement, seconds):
+        shape = statement_shape(statement)
+
+        self.queries += 1
+        self.db_seconds += seconds
+        self.shapes[shape] += 1
+        _keep_slowest(self.slowest, seconds, shape)
+
+    def repeated(self, limit):
+        """(shape, count) of statement shapes run more than `limit` times."""
+
+        return [(shape, count) for shape, count in self.shapes.items()
+                if count > limit]
+
+
+def _keep_slowest(slowest, seconds, shape):
+    """Add a run of `shape` to `slowest`, a short list of (seconds, shape).
+
+    Only the slowest run of each shape is kept, slowest shapes first.
+    """
+
+    for index, (kept_seconds, kept_shape) in enumerate(slowest):
+        if kept_shape == shape:
+            if kept_seconds >= seconds:
+                return
+            del slowest[index]
+            break
+
+    slowest.append((seconds, shape))
+    slowest.sort(reverse=True)
+    del slowest[SLOWEST_KEPT:]
+
+
+class RouteStats:
+    """Totals for every request to one route."""
+
+    def __init__(self):
+        self.requests = 0
+        self.seconds = 0
+        self.queries = 0
+        self.db_seconds = 0
+        self.rows = 0
+        self.slow_requests = 0
+        self.repeated_statements = 0
+        self.slowest = []
+
+
+class Metrics:
+    """Per-route totals, shared by every thread of the process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}
+
+    def record(self, route, seconds, stats, slow, repeated):
+        with self.lock:
+            totals = self.routes.setdefault(route, RouteStats())
+            totals.requests += 1
+            totals.seconds += seconds
+            totals.queries += stats.queries
+            totals.db_seconds += stats.db_seconds
+            totals.rows += stats.rows
+            totals.slow_requests += slow
+            totals.repeated_statements += len(repeated)
+
+            for statement_seconds, shape in stats.slowest:
+                _keep_slowest(totals.slowest, statement_seconds, shape)
+
+    def snapshot(self):
+        """{route: RouteStats} copies, safe to read without the lock."""
+
+        with self.lock:
+            copies = {}
+            for route, totals in self.routes.items():
+                copy = RouteStats()
+                copy.__dict__.update(totals.__dict__,
+                                     slowest=list(totals.slowest))
+                copies[route] = copy
+            return copies
+
+
+##############################################################################
+# Hooks
+
+
+def _request_stats():
+    """Stats of the request being handled, or None outside a request."""
+
+    if has_request_context():
+        return g.get('sql_stats')
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    seconds = time.perf_counter() - conn.info['query_started'].pop()
+    stats = _request_stats()
+
+    if stats is not None:
+        stats.add_statement(statement, seconds)
+
+
+def _handle_error(context):
+    # the statement failed, so _after_cursor_execute won't pop its start
+    if context.connection is not None and context.cursor is not None:
+        context.connection.info.get('query_started', [None]).pop()
+
+
+def _on_load(target, context):
+    stats = _request_stats()
+
+    if stats is not None:
+        stats.rows += 1
+
+
+def _start_request():
+    g.sql_stats = RequestStats()
+
+
+def _finish_request(error=None):
+    stats = g.pop('sql_stats', None)
+    if stats is None:
+        return
+
+    config = current_app.config
+    route = request.endpoint or 'unmatched'
+    seconds = time.perf_counter() - stats.started
+
+    slow = (seconds * 1000 > config['SLOW_REQUEST_MS']
+            or stats.queries > config['SLOW_REQUEST_QUERIES'])
+    repeated = stats.repeated(config['SQL_REPEATED_STATEMENT_LIMIT'])
+
+    if slow:
+        current_app.logger.warning(
+            "Slow request to %s (%s): %.0f ms, %d statements taking "
+            "%.0f ms, %d rows loaded", route, request.full_path,
+            seconds * 1000, stats.queries, stats.db_seconds * 1000,
+            stats.rows)
+
+    for shape, count in repeated:
+        current_app.logger.warning(
+            "Possible N+1 query in %s (%s): ran %d times: %s", route,
+            request.full_path, count, shape)
+
+    current_app.extensions['instrumentation'].record(
+        route, seconds, stats, slow, repeated)
+
+
+def init_app(app, model):
+    """Instrument `app`'s requests and the SQL they run.
+
+    `model` is the declarative base whose loads count as rows.
+    """
+
+    app.extensions['instrumentation'] = Metrics()
+
+    if not event.contains(Engine, 'before_cursor_execute',
+                          _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+        event.listen(model, 'load', _on_load, propagate=True)
+
+    app.before_request(_start_request)
+    app.teardown_request(_finish_request)
+
+
+##############################################################################
+# Prometheus exposition
+
+
+def _escape(value):
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _metric(lines, name, kind, help, samples):
+    """Append one metric family, given [(labels dict, value)]."""
+
+    lines.append(f"# HELP {name} {help}")
+    lines.append(f"# TYPE {name} {kind}")
+
+    for labels, value in samples:
+        label_text = ','.join(f'{key}="{_escape(str(label))}"'
+                              for key, label in labels.items())
+        lines.append(f"{name}{{{label_text}}} {value}" if label_text
+                     else f"{name} {value}")
+
+
+def render_metrics():
+    """Current metrics of this process in Prometheus text format."""
+
+    routes = current_app.extensions['instrumentation'].snapshot()
+    lines = []
+
+    def per_route(name, help, attribute, kind='counter'):
+        _metric(lines, name, kind, help,
+                [({'route': route}, getattr(totals, attribute))
+                 for route, totals in sorted(routes.items())])
+
+    per_route('warbler_requests_total', 'Requests handled.', 'requests')
+    per_route('warbler_request_seconds_total',
+              'Time spent handling requests.', 'seconds')
+    per_route('warbler_db_queries_total',
+              'SQL statements run by requests.', 'queries')
+    per_route('warbler_db_seconds_total',
+              'Time spent running SQL statements.', 'db_seconds')
+    per_route('warbler_db_rows_total',
+              'Rows loaded into models.', 'rows')
+    per_route('warbler_slow_requests_total',
+              'Requests over the time or statement thresholds.',
+              'slow_requests')
+    per_route('warbler_repeated_statements_total',
+              'Statement shapes repeated past the N+1 threshold.',
+              'repeated_statements')
+
+    _metric(lines, 'warbler_db_slowest_statement_seconds', 'gauge',
+            'Slowest statements seen, per route.',
+            [({'route': route, 'statement': shape}, seconds)
+             for route, totals in sorted(routes.items())
+             for seconds, shape in totals.slowest])
+
+    for key, value in passwords.pool.stats().items():
+        if key == 'pending':
+            _metric(lines, 'warbler_password_hash_pending', 'gauge',
+                    'Password hashing operations waiting.', [({}, value)])
+        else:
+            _metric(lines, f'warbler_password_hash_{key}_total', 'counter',
+                    f'Password hashing operations {key}.', [({}, value)])
+
+    db = current_app.extensions['sqlalchemy'].db
+    pools = database.pool_stats(db, current_app)
+
+    for key, help in (('size', 'Connections the pool keeps open.'),
+                      ('checked_out', 'Connections in use.'),
+                      ('idle', 'Open connections waiting in the pool.'),
+                      ('overflow', 'Connections opened beyond the size.')):
+        _metric(lines, f'warbler_db_pool_{key}', 'gauge', help,
+                [({'database': name}, stats[key])
+                 for name, stats in sorted(pools.items())])
+
+    return '\n'.join(lines) + '\n'
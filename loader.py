@@ -0,0 +1,232 @@
+"""Bulk loading of CSV data into Warbler's tables.
+
+CSV files are streamed in chunks of `chunk_size` rows, so memory stays
+bounded however large the files are. On Postgres each chunk goes in with
+`COPY ... FROM STDIN`; elsewhere (SQLite) with a batched executemany.
+Each chunk is committed on its own, and secondary indexes are dropped
+before the load and rebuilt once at the end, which is much cheaper than
+maintaining them row by row.
+
+Tables are loaded in dependency order. Once users exist, messages and
+follows load in parallel; likes follow once messages are in.
+
+Message ids are time-ordered (see snowflake.py). A messages CSV without
+an id column gets ids made from each row's timestamp and row number, so
+the loaded messages sort by time whatever order the file is in.
+"""
+
+import csv
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import islice
+
+from sqlalchemy import DateTime, Integer, text
+
+from models import Follows, Likes, Message, User
+import search
+import snowflake
+
+DEFAULT_CHUNK_SIZE = 10000
+
+# (model, CSV file name) in the order they must load; each inner list can
+# load in parallel once the previous ones are done
+LOAD_STAGES = [
+    [(User, 'users.csv')],
+    [(Message, 'messages.csv'), (Follows, 'follows.csv')],
+    [(Likes, 'likes.csv')],
+]
+
+# indexes created outside the models, by raw DDL, on Postgres only
+POSTGRES_EXTRA_INDEXES = {
+    'users': ([f'ix_users_{column}_trgm'
+               for column in search.USER_SEARCH_COLUMNS],
+              search.TRIGRAM_INDEX_DDL[1:]),
+    'messages': (['ix_messages_search_vector'],
+                 [search.MESSAGE_INDEX_DDL]),
+}
+
+
+def _is_postgres(engine):
+    return engine.dialect.name == 'postgresql'
+
+
+def _chunks(reader, chunk_size):
+    """Yield lists of up to `chunk_size` rows from `reader`."""
+
+    while True:
+        chunk = list(islice(reader, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _converter(column):
+    """Turn a CSV string into a value for `column` (executemany path)."""
+
+    if isinstance(column.type, DateTime):
+        return datetime.fromisoformat
+    if isinstance(column.type, Integer):
+        return int
+    return str
+
+
+def _with_message_ids(rows, timestamp_index, first_number):
+    """Prefix each messages CSV row with an id made from its timestamp.
+
+    Row numbers fill the id's low bits, so rows sharing a millisecond
+    still get different ids.
+    """
+
+    return [[snowflake.make_id(
+                datetime.fromisoformat(row[timestamp_index]), number)] + row
+            for number, row in enumerate(rows, first_number)]
+
+
+def _copy_chunk(engine, table, columns, rows):
+    """Load `rows` into `table` with a single COPY."""
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+
+    connection = engine.raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.copy_expert(
+                f"COPY {table.name} ({', '.join(columns)}) "
+                f"FROM STDIN WITH (FORMAT csv)",
+                buffer)
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def _insert_chunk(engine, table, columns, rows):
+    """Load `rows` into `table` with one executemany."""
+
+    converters = [_converter(table.c[column]) for column in columns]
+
+    values = [{column: convert(value) if value != '' else None
+               for column, convert, value in zip(columns, converters, row)}
+              for row in rows]
+
+    with engine.begin() as connection:
+        connection.execute(table.insert(), values)
+
+
+def load_csv(engine, model, path, chunk_size=DEFAULT_CHUNK_SIZE,
+             progress=None):
+    """Stream the CSV at `path` into `model`'s table.
+
+    The CSV's header names the columns. `progress`, if given, is called
+    with (table name, rows loaded so far) after each chunk. Returns the
+    number of rows loaded.
+    """
+
+    table = model.__table__
+    load_chunk = _copy_chunk if _is_postgres(engine) else _insert_chunk
+    loaded = 0
+
+    with open(path, newline='') as csv_file:
+        reader = csv.reader(csv_file)
+        columns = next(reader)
+
+        make_ids = table is Message.__table__ and 'id' not in columns
+        if make_ids:
+            timestamp_index = columns.index('timestamp')
+            columns = ['id'] + columns
+
+        for rows in _chunks(reader, chunk_size):
+            if make_ids:
+                rows = _with_message_ids(rows, timestamp_index, loaded)
+            load_chunk(engine, table, columns, rows)
+            loaded += len(rows)
+
+            if progress:
+                progress(table.name, loaded)
+
+    return loaded
+
+
+def drop_indexes(engine, tables):
+    """Drop the secondary indexes of `tables` before a bulk load."""
+
+    with engine.begin() as connection:
+        for table in tables:
+            for index in table.indexes:
+                index.drop(connection)
+
+            if _is_postgres(engine) and table.name in POSTGRES_EXTRA_INDEXES:
+                names, _ = POSTGRES_EXTRA_INDEXES[table.name]
+                for name in names:
+                    connection.execute(f'DROP INDEX IF EXISTS {name}')
+
+
+def create_indexes(engine, tables):
+    """Rebuild the secondary indexes dropped by `drop_indexes`."""
+
+    with engine.begin() as connection:
+        for table in tables:
+            for index in table.indexes:
+                index.create(connection)
+
+            if _is_postgres(engine) and table.name in POSTGRES_EXTRA_INDEXES:
+                _, statements = POSTGRES_EXTRA_INDEXES[table.name]
+                for statement in statements:
+                    connection.execute(statement)
+
+
+def reset_sequences(engine, tables):
+    """Move id sequences past the largest loaded id (Postgres only).
+
+    Needed when the CSVs carry their own ids, so later inserts don't
+    collide with loaded rows.
+    """
+
+    if not _is_postgres(engine):
+        return
+
+    with engine.begin() as connection:
+        for table in tables:
+            # message ids come from snowflake.py, not a sequence
+            if 'id' not in table.c or table.c.id.default is not None:
+                continue
+
+            connection.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                f"coalesce(max(id), 0) + 1, false) FROM {table.name}"))
+
+
+def load_all(engine, data_dir, chunk_size=DEFAULT_CHUNK_SIZE, jobs=2,
+             progress=None):
+    """Load every CSV found in `data_dir` into an empty, migrated database.
+
+    Files missing from `data_dir` are skipped. Tables within a stage load
+    on up to `jobs` threads; SQLite allows a single writer, so there they
+    always load one at a time.
+    """
+
+    stages = [[(model, os.path.join(data_dir, name))
+               for model, name in stage
+               if os.path.exists(os.path.join(data_dir, name))]
+              for stage in LOAD_STAGES]
+
+    tables = [model.__table__ for stage in stages for model, _ in stage]
+
+    if not _is_postgres(engine):
+        jobs = 1
+
+    drop_indexes(engine, tables)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for stage in stages:
+            futures = [executor.submit(load_csv, engine, model, path,
+                                       chunk_size, progress)
+                       for model, path in stage]
+            for future in futures:
+                future.result()
+
+    create_indexes(engine, tables)
+    reset_sequences(engine, tables)
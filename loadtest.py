@@ -0,0 +1,137 @@
+"""Load test a running Warbler server.
+
+Run it like:
+
+    python loadtest.py --url http://127.0.0.1:8000 [--concurrency 50]
+                       [--duration 30] [--users 100] [--output run.json]
+
+Each of --concurrency client threads logs in as one of the first --users
+users and requests home timelines and profiles back to back for
+--duration seconds, then throughput and latency percentiles are printed
+(and written to --output as JSON, if given).
+
+Logins are made by signing a session cookie with the app's SECRET_KEY,
+so the server must share it, and the database must be seeded (see
+seed.py). See gunicorn.conf.py for comparing sync and gevent workers.
+"""
+
+import argparse
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from random import Random
+
+from bench import percentile
+
+
+def session_cookie(user_id):
+    """A session cookie logging in `user_id`, signed like the app's."""
+
+    from app import app, CURR_USER_KEY
+
+    serializer = app.session_interface.get_signing_serializer(app)
+    value = serializer.dumps({CURR_USER_KEY: user_id})
+    return f"{app.session_cookie_name}={value}"
+
+
+def pages(rng, users):
+    """Endless (kind, path) pairs: mostly timelines, some profiles."""
+
+    while True:
+        if rng.random() < 0.6:
+            yield 'timeline', '/'
+        else:
+            yield 'profile', f'/users/{rng.randint(1, users)}'
+
+
+def client(url, cookie, users, rng, deadline, results):
+    """Request pages with `cookie` until `deadline`, appending to results."""
+
+    for kind, path in pages(rng, users):
+        if time.monotonic() >= deadline:
+            return
+
+        request = urllib.request.Request(url + path,
+                                         headers={'Cookie': cookie})
+        started = time.perf_counter()
+
+        try:
+            with urllib.request.urlopen(request) as response:
+                response.read()
+                ok = response.status == 200
+        except (urllib.error.URLError, ConnectionError):
+            ok = False
+
+        results.append((kind, time.perf_counter() - started, ok))
+
+
+def summarize(results, duration):
+    """Throughput and latency percentiles (ms), overall and per kind."""
+
+    summary = {}
+
+    for kind in ['all'] + sorted({kind for kind, _, _ in results}):
+        samples = [(elapsed, ok) for found, elapsed, ok in results
+                   if kind in ('all', found)]
+        timings = sorted(elapsed * 1000 for elapsed, _ in samples)
+
+        summary[kind] = {
+            'requests': len(samples),
+            'errors': sum(not ok for _, ok in samples),
+            'per_second': round(len(samples) / duration, 1),
+            'p50_ms': round(percentile(timings, 50), 1),
+            'p95_ms': round(percentile(timings, 95), 1),
+            'p99_ms': round(percentile(timings, 99), 1),
+        }
+
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--concurrency', type=int, default=50,
+                        help='simultaneous clients')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='seconds to run for')
+    parser.add_argument('--users', type=int, default=100,
+                        help='log in as user ids 1 to this')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the summary here as JSON')
+    args = parser.parse_args()
+
+    cookies = [session_cookie(number % args.users + 1)
+               for number in range(args.concurrency)]
+
+    results = []
+    deadline = time.monotonic() + args.duration
+    threads = [threading.Thread(target=client,
+                                args=(args.url.rstrip('/'), cookie,
+                                      args.users,
+                                      Random(f"{args.seed}:{number}"),
+                                      deadline, results))
+               for number, cookie in enumerate(cookies)]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    summary = summarize(results, args.duration)
+
+    for kind, numbers in summary.items():
+        print(f"{kind:<10} {numbers['per_second']:>8.1f} req/s  "
+              f"p50 {numbers['p50_ms']:>7.1f} ms  "
+              f"p95 {numbers['p95_ms']:>7.1f} ms  "
+              f"p99 {numbers['p99_ms']:>7.1f} ms  "
+              f"{numbers['errors']} errors")
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(dict(vars(args), summary=summary), output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
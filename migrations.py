@@ -0,0 +1,388 @@
+"""Versioned schema migrations for Warbler.
+
+Each migration is a function taking a database connection, listed in
+MIGRATIONS in the order they apply. The versions already applied are
+recorded in the `schema_migrations` table, so `upgrade()` only runs the
+new ones, each in its own transaction.
+
+Migrations must also work on databases created before this module
+existed (by `db.create_all()`), so they check for what is already there
+instead of assuming an empty schema.
+
+Run them with:
+
+    flask migrate
+
+and check that the hot query paths use their indexes with:
+
+    flask check-indexes
+"""
+
+import json
+from datetime import datetime
+
+from sqlalchemy import (Column, DateTime, Index, Integer, MetaData, Table,
+                        Text, inspect)
+
+from models import db, AccountPurge, Follows, Likes, Message, TimelineEntry
+import search
+
+version_metadata = MetaData()
+
+schema_migrations = Table(
+    'schema_migrations', version_metadata,
+    Column('version', Integer, primary_key=True),
+    Column('name', Text, nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+
+##############################################################################
+# Helpers
+
+
+def _is_postgres(connection):
+    return connection.dialect.name == 'postgresql'
+
+
+def _add_column(connection, table, name, ddl):
+    """Add a column unless the table already has it."""
+
+    columns = {column['name']
+               for column in inspect(connection).get_columns(table)}
+    if name not in columns:
+        connection.execute(f'ALTER TABLE {table} ADD COLUMN {name} {ddl}')
+
+
+def _create_index(connection, index):
+    """Create a SQLAlchemy Index unless one with its name exists."""
+
+    existing = {found['name'] for found in
+                inspect(connection).get_indexes(index.table.name)}
+    if index.name not in existing:
+        index.create(connection)
+
+
+def _drop_column(connection, model, name):
+    """Drop a column of `model`'s table if the table has it.
+
+    SQLite only drops columns from 3.35 on, so there the table is rebuilt
+    from the model instead, keeping its rows.
+    """
+
+    table = model.__table__
+    columns = {column['name']
+               for column in inspect(connection).get_columns(table.name)}
+    if name not in columns:
+        return
+
+    if _is_postgres(connection):
+        connection.execute(f'ALTER TABLE {table.name} DROP COLUMN {name}')
+        return
+
+    old = f'{table.name}_old'
+    connection.execute(f'ALTER TABLE {table.name} RENAME TO {old}')
+
+    # its indexes keep their names; they'd clash with the new table's
+    for index in inspect(connection).get_indexes(old):
+        connection.execute(f'DROP INDEX {index["name"]}')
+
+    table.create(bind=connection)
+    kept = ', '.join(column.name for column in table.columns)
+    connection.execute(f'INSERT INTO {table.name} ({kept}) '
+                       f'SELECT {kept} FROM {old}')
+    connection.execute(f'DROP TABLE {old}')
+
+
+def _drop_index(connection, table, name):
+    """Drop an index of `table` if it exists."""
+
+    existing = {found['name'] for found in
+                inspect(connection).get_indexes(table)}
+    if name in existing:
+        connection.execute(f'DROP INDEX {name}')
+
+
+def _model_index(model, name):
+    """The Index called `name` declared on `model`."""
+
+    return next(index for index in model.__table__.indexes
+                if index.name == name)
+
+
+def _old_index(table, name, *columns):
+    """An Index on `table` that the models no longer declare.
+
+    Built on its own copy of the table, so the models' metadata (and
+    `db.create_all()`) never sees it.
+    """
+
+    old_table = Table(table, MetaData(),
+                      *(Column(column) for column in columns))
+    return Index(name, *(old_table.c[column] for column in columns))
+
+
+##############################################################################
+# Migrations
+
+
+def create_tables(connection):
+    """Create any missing tables from the current models."""
+
+    db.metadata.create_all(bind=connection)
+
+
+def add_timeline_counter_and_search_columns(connection):
+    """Add the columns and search indexes the app grew before migrations."""
+
+    false = 'false' if _is_postgres(connection) else '0'
+    _add_column(connection, 'users', 'is_pull_author',
+                f'BOOLEAN NOT NULL DEFAULT {false}')
+
+    for counter in ('messages_count', 'following_count',
+                    'followers_count', 'likes_count'):
+        _add_column(connection, 'users', counter,
+                    'INTEGER NOT NULL DEFAULT 0')
+
+    vector = 'tsvector' if _is_postgres(connection) else 'TEXT'
+    _add_column(connection, 'messages', 'search_vector', vector)
+
+    if _is_postgres(connection):
+        for statement in search.TRIGRAM_INDEX_DDL + [search.MESSAGE_INDEX_DDL]:
+            connection.execute(statement)
+
+
+def add_hot_path_indexes(connection):
+    """Index timeline, follow and like lookups; make likes unique.
+
+    Duplicate likes are removed first (keeping the oldest of each) so the
+    unique index can be built.
+    """
+
+    connection.execute("""
+        DELETE FROM likes
+        WHERE id NOT IN (SELECT min(id) FROM likes
+                         GROUP BY user_id, message_id)
+    """)
+
+    # as shipped; add_sortable_message_ids replaces it
+    _create_index(connection, _old_index(
+        'messages', 'ix_messages_user_id_timestamp_id',
+        'user_id', 'timestamp', 'id'))
+    _create_index(connection, _model_index(
+        Follows, 'ix_follows_user_following_id'))
+    _create_index(connection, _model_index(
+        Likes, 'ix_likes_user_id_message_id'))
+
+
+def add_version_columns(connection):
+    """Add the version stamps that cached fragments are keyed by."""
+
+    for table in ('users', 'messages'):
+        _add_column(connection, table, 'version',
+                    'INTEGER NOT NULL DEFAULT 0')
+
+
+def add_message_like_counts(connection):
+    """Count likes on each message; index likes for paging and counting."""
+
+    _add_column(connection, 'messages', 'likes_count',
+                'INTEGER NOT NULL DEFAULT 0')
+
+    _create_index(connection, _model_index(Likes, 'ix_likes_user_id_id'))
+    _create_index(connection, _model_index(Likes, 'ix_likes_message_id'))
+
+    connection.execute("""
+        UPDATE messages
+        SET likes_count = (SELECT count(*) FROM likes
+                           WHERE likes.message_id = messages.id)
+    """)
+
+
+def add_account_deactivation(connection):
+    """Flag deleted accounts; track the background purges of their rows."""
+
+    false = 'false' if _is_postgres(connection) else '0'
+    _add_column(connection, 'users', 'deactivated',
+                f'BOOLEAN NOT NULL DEFAULT {false}')
+
+    AccountPurge.__table__.create(bind=connection, checkfirst=True)
+
+
+def add_sortable_message_ids(connection):
+    """Make message ids 64-bit and time-ordered; order timelines on them.
+
+    New messages get snowflake ids (see snowflake.py) from the app rather
+    than from a sequence. Existing ids are all smaller than any of those,
+    so older messages still sort first, among themselves in the order
+    they were posted.
+
+    Timelines and profiles are then read in id order alone: messages are
+    indexed on (user_id, id), and timeline entries drop their copy of the
+    message timestamp and its index in favour of the primary key.
+    """
+
+    if _is_postgres(connection):
+        connection.execute('ALTER TABLE messages ALTER COLUMN id DROP DEFAULT')
+        for table, column in (('messages', 'id'),
+                              ('likes', 'message_id'),
+                              ('timeline_entries', 'message_id')):
+            connection.execute(
+                f'ALTER TABLE {table} ALTER COLUMN {column} TYPE BIGINT')
+
+    _create_index(connection, _model_index(Message, 'ix_messages_user_id_id'))
+
+    _drop_index(connection, 'messages', 'ix_messages_user_id_timestamp_id')
+    _drop_index(connection, 'timeline_entries',
+                'ix_timeline_entries_user_id_timestamp')
+    _drop_column(connection, TimelineEntry, 'timestamp')
+
+
+MIGRATIONS = [
+    (1, create_tables),
+    (2, add_timeline_counter_and_search_columns),
+    (3, add_hot_path_indexes),
+    (4, add_version_columns),
+    (5, add_message_like_counts),
+    (6, add_account_deactivation),
+    (7, add_sortable_message_ids),
+]
+
+
+##############################################################################
+# Running migrations
+
+
+def applied_versions(connection):
+    """Versions already applied to the database."""
+
+    version_metadata.create_all(bind=connection)
+    rows = connection.execute(schema_migrations.select())
+    return {row.version for row in rows}
+
+
+def upgrade(engine, progress=None):
+    """Apply every migration not yet recorded, in order.
+
+    `progress`, if given, is called with (version, name) before each one.
+    Returns the versions applied.
+    """
+
+    with engine.begin() as connection:
+        done = applied_versions(connection)
+
+    applied = []
+
+    for version, migration in MIGRATIONS:
+        if version in done:
+            continue
+
+        if progress:
+            progress(version, migration.__name__)
+
+        with engine.begin() as connection:
+            migration(connection)
+            connection.execute(schema_migrations.insert().values(
+                version=version,
+                name=migration.__name__,
+                applied_at=datetime.utcnow()))
+
+        applied.append(version)
+
+    return applied
+
+
+def reset(engine):
+    """Drop every table, including the migration history."""
+
+    db.metadata.drop_all(bind=engine)
+    version_metadata.drop_all(bind=engine)
+
+
+##############################################################################
+# Index checks
+
+
+def _hot_path_queries(user_id=1):
+    """(description, query, index it should use) for the hot query paths.
+
+    A table in place of an index name stands for its primary key.
+    """
+
+    return [
+        ("profile messages",
+         Message.query
+         .filter(Message.user_id == user_id)
+         .order_by(Message.id.desc())
+         .limit(100),
+         'ix_messages_user_id_id'),
+        ("home timeline",
+         TimelineEntry.query
+         .filter(TimelineEntry.user_id == user_id)
+         .order_by(TimelineEntry.message_id.desc())
+         .limit(100),
+         TimelineEntry.__table__),
+        ("followed users",
+         Follows.query
+         .filter(Follows.user_following_id == user_id),
+         'ix_follows_user_following_id'),
+        ("like lookup",
+         Likes.query
+         .filter(Likes.user_id == user_id, Likes.message_id == 1),
+         'ix_likes_user_id_message_id'),
+        ("liked messages",
+         Likes.query
+         .filter(Likes.user_id == user_id)
+         .order_by(Likes.id.desc())
+         .limit(100),
+         'ix_likes_user_id_id'),
+    ]
+
+
+def _primary_key_index(connection, table):
+    """The name of the index behind `table`'s primary key."""
+
+    if _is_postgres(connection):
+        return inspect(connection).get_pk_constraint(table.name)['name']
+
+    return f'sqlite_autoindex_{table.name}_1'
+
+
+def _plan_uses_index(connection, sql, index):
+    """Does the database's plan for `sql` read from `index`?"""
+
+    if _is_postgres(connection):
+        # tiny tables make sequential scans look cheapest; rule them out
+        # so the check is about whether the index *can* serve the query
+        connection.execute('SET LOCAL enable_seqscan = off')
+        plan = connection.execute(f'EXPLAIN (FORMAT JSON) {sql}').scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return f'"Index Name": "{index}"' in json.dumps(plan)
+
+    rows = connection.execute(f'EXPLAIN QUERY PLAN {sql}')
+    return any(f'INDEX {index}' in row[-1] for row in rows)
+
+
+def check_indexes():
+    """EXPLAIN each hot query path; return the ones missing their index.
+
+    Returns a list of (description, index) pairs, empty when every query
+    uses the index it was designed for.
+    """
+
+    missing = []
+
+    with db.engine.begin() as connection:
+        for description, query, index in _hot_path_queries():
+            if isinstance(index, Table):
+                index = _primary_key_index(connection, index)
+
+            sql = str(query.statement.compile(
+                dialect=db.engine.dialect,
+                compile_kwargs={'literal_binds': True}))
+
+            if not _plan_uses_index(connection, sql, index):
+                missing.append((description, index))
+
+    return missing
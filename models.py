@@ -2,11 +2,75 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import and_, event, exists, false, func, literal, select
+from sqlalchemy.dialects.postgresql import TSVECTOR, insert as pg_insert
+from sqlalchemy.orm import object_session
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from database import RoutingSQLAlchemy
+import passwords
+import snowflake
+
+db = RoutingSQLAlchemy()
+
+
+def _insert_new(table, **values):
+    """Insert a row of `values` unless one with the same values exists.
+
+    `values` must be the columns of a unique index on `table`. A single
+    statement that skips an existing row, even one inserted concurrently;
+    returns whether a row was inserted.
+    """
+
+    if db.session.get_bind().dialect.name == 'postgresql':
+        statement = (pg_insert(table)
+                     .values(**values)
+                     .on_conflict_do_nothing(index_elements=list(values)))
+    else:
+        already = (select([literal(1)])
+                   .select_from(table)
+                   .where(_matching(table, values)))
+        statement = table.insert().from_select(
+            list(values),
+            select([literal(value) for value in values.values()])
+            .where(~exists(already)))
+
+    return db.session.execute(statement).rowcount > 0
+
+
+def _delete(table, **values):
+    """Delete the rows of `table` with `values`; return whether there were."""
+
+    statement = table.delete().where(_matching(table, values))
+    return db.session.execute(statement).rowcount > 0
+
+
+def _matching(table, values):
+    return and_(*[table.c[column] == value
+                  for column, value in values.items()])
+
+
+class CounterMixin:
+    """A model with denormalized counter columns, such as likes_count."""
+
+    @classmethod
+    def adjust_counts(cls, ids, **deltas):
+        """Add `deltas` to the counters of the rows with `ids`.
+
+        `ids` is a single id, a list of ids or a select of ids; deltas are
+        keyword arguments such as `followers_count=1`. The update runs in
+        SQL, so concurrent changes don't overwrite each other.
+        """
+
+        if isinstance(ids, int):
+            ids = [ids]
+
+        values = {getattr(cls, name): getattr(cls, name) + delta
+                  for name, delta in deltas.items()}
+
+        (cls
+         .query
+         .filter(cls.id.in_(ids))
+         .update(values, synchronize_session=False))
 
 
 class Follows(db.Model):
@@ -26,6 +90,39 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # the primary key leads with user_being_followed_id, so it only
+    # serves "who follows X"; this serves "who does X follow"
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
+    @classmethod
+    def add(cls, follower_id, followed_id):
+        """Make `follower_id` follow `followed_id`; return whether it's new."""
+
+        return _insert_new(cls.__table__,
+                           user_being_followed_id=followed_id,
+                           user_following_id=follower_id)
+
+    @classmethod
+    def remove(cls, follower_id, followed_id):
+        """Stop `follower_id` following `followed_id`; return whether it was."""
+
+        return _delete(cls.__table__,
+                       user_being_followed_id=followed_id,
+                       user_following_id=follower_id)
+
+    @classmethod
+    def exists(cls, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`? One primary key lookup."""
+
+        return db.session.query(
+            cls.query
+            .filter(cls.user_being_followed_id == followed_id,
+                    cls.user_following_id == follower_id)
+            .exists()).scalar()
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
@@ -43,12 +140,35 @@ class Likes(db.Model):
     )
 
     message_id = db.Column(
-        db.Integer,
+        db.BigInteger,
         db.ForeignKey('messages.id', ondelete='cascade')
     )
 
+    # a message can only be liked once by each user; the other two serve
+    # a user's likes newest first and a message's likes
+    __table_args__ = (
+        db.Index('ix_likes_user_id_message_id',
+                 'user_id', 'message_id',
+                 unique=True),
+        db.Index('ix_likes_user_id_id', 'user_id', 'id'),
+        db.Index('ix_likes_message_id', 'message_id'),
+    )
+
+    @classmethod
+    def add(cls, user_id, message_id):
+        """Record that `user_id` likes `message_id`; return whether it's new."""
+
+        return _insert_new(cls.__table__,
+                           user_id=user_id, message_id=message_id)
+
+    @classmethod
+    def remove(cls, user_id, message_id):
+        """Remove `user_id`'s like of `message_id`; return whether it was."""
+
+        return _delete(cls.__table__, user_id=user_id, message_id=message_id)
+
 
-class User(db.Model):
+class User(CounterMixin, db.Model):
     """User in the system."""
 
     __tablename__ = 'users'
@@ -93,6 +213,64 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Authors with too many followers to fan out to; their messages are
+    # pulled into home timelines at read time instead (see timeline.py).
+    is_pull_author = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        server_default=false(),
+    )
+
+    # Set when the account is deleted: it's hidden at once, and its rows
+    # are removed in the background (see purge.py).
+    deactivated = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        server_default=false(),
+    )
+
+    # Denormalized counts shown on profile and home pages. Routes keep
+    # them up to date in the same transaction as the change they count;
+    # reconcile_counts() recomputes them from scratch.
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Bumped whenever the user is changed through the ORM (but not by the
+    # SQL counter updates); cached HTML of the user is keyed by it.
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     messages = db.relationship('Message', cascade="all,delete")
 
     followers = db.relationship(
@@ -120,14 +298,122 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.exists(other_user.id, self.id)
 
     def is_following(self, other_user):
-        """Is this user following `other_use`?"""
+        """Is this user following `other_user`?"""
+
+        return Follows.exists(self.id, other_user.id)
+
+    def following_ids(self, users):
+        """Return the set of ids among `users` that this user follows.
+
+        Answers for a whole page of users in one query, instead of calling
+        is_following for each of them.
+        """
+
+        ids = [user.id for user in users]
+        if not ids:
+            return set()
+
+        rows = (db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == self.id,
+                        Follows.user_being_followed_id.in_(ids)))
+
+        return {id for (id,) in rows}
+
+    def follower_ids(self, ids):
+        """Return the set of user ids among `ids` that follow this user.
+
+        The other half of following_ids, for relationship status, in one
+        query; takes ids so callers needn't load the users.
+        """
+
+        if not ids:
+            return set()
+
+        rows = (db.session
+                .query(Follows.user_following_id)
+                .filter(Follows.user_being_followed_id == self.id,
+                        Follows.user_following_id.in_(ids)))
+
+        return {id for (id,) in rows}
+
+    def liked_ids(self, messages):
+        """Return the set of ids among `messages` that this user likes.
+
+        One indexed lookup for a whole page of messages.
+        """
+
+        ids = [msg.id for msg in messages]
+        if not ids:
+            return set()
+
+        rows = (db.session
+                .query(Likes.message_id)
+                .filter(Likes.user_id == self.id,
+                        Likes.message_id.in_(ids)))
+
+        return {id for (id,) in rows}
+
+    def release_counts(self):
+        """Remove this user from everyone else's counters.
+
+        Call before deleting the user: the follows and likes that the
+        database cascade removes are subtracted from the users and messages
+        on the other end of them.
+        """
+
+        followers = (select([Follows.user_following_id])
+                     .where(Follows.user_being_followed_id == self.id))
+        User.adjust_counts(followers, following_count=-1)
+
+        followed = (select([Follows.user_being_followed_id])
+                    .where(Follows.user_following_id == self.id))
+        User.adjust_counts(followed, followers_count=-1)
+
+        liked_messages = Likes.__table__.join(Message.__table__)
+
+        likers = (select([Likes.user_id])
+                  .select_from(liked_messages)
+                  .where(Message.user_id == self.id))
+
+        likes_lost = (select([func.count()])
+                      .select_from(liked_messages)
+                      .where(and_(Likes.user_id == User.id,
+                                  Message.user_id == self.id))
+                      .as_scalar())
+
+        (User
+         .query
+         .filter(User.id.in_(likers))
+         .update({User.likes_count: User.likes_count - likes_lost},
+                 synchronize_session=False))
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        liked = select([Likes.message_id]).where(Likes.user_id == self.id)
+        Message.adjust_counts(liked, likes_count=-1)
+
+    @classmethod
+    def reconcile_counts(cls):
+        """Recompute every user's counters from the underlying tables."""
+
+        def count(table, column):
+            return (select([func.count()])
+                    .select_from(table)
+                    .where(column == cls.id)
+                    .as_scalar())
+
+        (cls
+         .query
+         .update({cls.messages_count: count(Message.__table__,
+                                            Message.user_id),
+                  cls.following_count: count(Follows.__table__,
+                                             Follows.user_following_id),
+                  cls.followers_count: count(Follows.__table__,
+                                             Follows.user_being_followed_id),
+                  cls.likes_count: count(Likes.__table__, Likes.user_id)},
+                 synchronize_session=False))
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -136,7 +422,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = passwords.hash_password(password)
 
         user = User(
             username=username,
@@ -157,26 +443,34 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        If the password was hashed with a different work factor than is
+        now configured, it is rehashed; the caller commits the change.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.query.filter_by(username=username,
+                                   deactivated=False).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = passwords.check_password(user.password, password)
             if is_auth:
+                if passwords.needs_rehash(user.password):
+                    user.password = passwords.hash_password(password)
                 return user
 
         return False
 
 
-class Message(db.Model):
+class Message(CounterMixin, db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = 'messages'
 
+    # time-ordered (see snowflake.py), so newest first is id order
     id = db.Column(
-        db.Integer,
+        db.BigInteger,
         primary_key=True,
+        default=snowflake.next_id,
     )
 
     text = db.Column(
@@ -187,7 +481,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -196,12 +490,117 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Full-text search document on Postgres, maintained by search.py.
+    # Deferred: only search uses it, and only in SQL, so loading messages
+    # shouldn't fetch it.
+    search_vector = db.deferred(db.Column(
+        db.Text().with_variant(TSVECTOR(), 'postgresql'),
+    ))
+
+    # Bumped whenever the message is changed through the ORM; cached HTML
+    # of the message is keyed by it.
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Denormalized count of likes, kept up to date in SQL like the user
+    # counters (see CounterMixin)
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # serves profile pages and timeline reads: newest messages by author
+    __table_args__ = (
+        db.Index('ix_messages_user_id_id', user_id, id),
+    )
+
     user = db.relationship('User')
 
+    @classmethod
+    def reconcile_counts(cls):
+        """Recompute every message's likes_count from the likes table."""
+
+        likes = (select([func.count()])
+                 .select_from(Likes.__table__)
+                 .where(Likes.message_id == cls.id)
+                 .as_scalar())
+
+        cls.query.update({cls.likes_count: likes},
+                         synchronize_session=False)
+
     def __repr__(self):
         return f"<Message #{self.id} by {self.user_id} on {self.timestamp}: {self.text}>"
 
 
+class TimelineEntry(db.Model):
+    """A message pushed into a user's precomputed home timeline."""
+
+    __tablename__ = 'timeline_entries'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # message ids are time-ordered, so the primary key alone serves a
+    # timeline newest first
+    message_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+
+class AccountPurge(db.Model):
+    """A deleted account whose rows are being removed (see purge.py)."""
+
+    __tablename__ = 'account_purges'
+
+    # no foreign key: the job outlives the user row it removes
+    user_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    requested_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    # the kind of rows being removed; 'done' once the user row is gone
+    stage = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    rows_deleted = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+
+@event.listens_for(User, 'before_update')
+@event.listens_for(Message, 'before_update')
+def bump_version(mapper, connection, target):
+    """Bump the version of a user or message whose columns changed."""
+
+    if object_session(target).is_modified(target, include_collections=False):
+        # in SQL, so it needn't be loaded and concurrent bumps both count
+        target.version = type(target).version + 1
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
@@ -0,0 +1,42 @@
+"""Keyset (cursor) pagination helpers for Warbler.
+
+Lists are paged with a `?before=` cursor naming the last row already
+shown, so every page is an indexed range read no matter how deep it is
+(no OFFSET scans). Messages and users are ordered on their ids (message
+ids are time-ordered, see snowflake.py), a user's likes on the like's
+id, and ranked search results on (score, id).
+"""
+
+
+def parse_id_cursor(value):
+    """Turn a message, user or like `?before=` value into an id, or None."""
+
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def split_page(rows, per_page):
+    """Split a fetch of `per_page + 1` rows into (page, has_more)."""
+
+    return rows[:per_page], len(rows) > per_page
+
+
+def score_cursor(score, id):
+    """Cursor pointing just past a (score, id) row in a best-first list."""
+
+    return f"{score!r}_{id}"
+
+
+def parse_score_cursor(value):
+    """Turn a ranked-results `?before=` value into (score, id), or None."""
+
+    if not value:
+        return None
+
+    try:
+        score, id = value.split('_')
+        return float(score), int(id)
+    except ValueError:
+        return None
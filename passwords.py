@@ -0,0 +1,178 @@
+"""Password hashing for Warbler.
+
+bcrypt is deliberately slow, so hashing and checking passwords run in a
+small process pool instead of on the request worker's own CPU time. The
+pool is bounded: once PASSWORD_HASH_MAX_PENDING operations are waiting,
+further ones fail fast with `HashingBusy` (answered with a 503) rather
+than piling up behind a login storm.
+
+The work factor comes from BCRYPT_LOG_ROUNDS. Hashes made with a
+different cost are upgraded the next time their owner logs in (see
+`needs_rehash`).
+"""
+
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+import bcrypt
+
+DEFAULT_LOG_ROUNDS = 12
+
+
+class HashingBusy(Exception):
+    """Raised when too many password operations are already waiting."""
+
+
+def _hash(password, rounds):
+    """Hash `password` (bytes) with bcrypt; runs in the pool."""
+
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds)).decode('UTF-8')
+
+
+def _check(pw_hash, password):
+    """Does `password` match `pw_hash` (both bytes)? Runs in the pool."""
+
+    try:
+        return bcrypt.checkpw(password, pw_hash)
+    except ValueError:
+        # not a bcrypt hash at all
+        return False
+
+
+class HashingPool:
+    """Bounded process pool for bcrypt, with simple usage counters."""
+
+    def __init__(self):
+        self.config = {}
+        self.lock = threading.Lock()
+        self.executor = None
+        self.pid = None
+        self.pending = 0
+        self.submitted = 0
+        self.completed = 0
+        self.timed_out = 0
+        self.rejected = 0
+
+    def _executor(self, workers):
+        """The process pool, recreated if we have been forked since."""
+
+        if self.executor is None or self.pid != os.getpid():
+            self.executor = ProcessPoolExecutor(max_workers=workers)
+            self.pid = os.getpid()
+
+        return self.executor
+
+    def run(self, fn, *args):
+        """Run `fn(*args)` in the pool and wait for the result.
+
+        Raises HashingBusy if PASSWORD_HASH_MAX_PENDING calls are already
+        waiting, or if the result takes longer than PASSWORD_HASH_TIMEOUT.
+        With PASSWORD_HASH_WORKERS set to 0, runs inline instead.
+
+        Only calls that return a result count as completed; one that
+        raises counts as neither completed nor timed out.
+        """
+
+        config = self.config
+        workers = config.get('PASSWORD_HASH_WORKERS', 0)
+
+        with self.lock:
+            if self.pending >= config.get('PASSWORD_HASH_MAX_PENDING', 8):
+                self.rejected += 1
+                raise HashingBusy()
+
+            self.pending += 1
+            self.submitted += 1
+            executor = self._executor(workers) if workers else None
+
+        if executor is None:
+            try:
+                result = fn(*args)
+            finally:
+                self._release()
+        else:
+            try:
+                future = executor.submit(fn, *args)
+            except BaseException:
+                self._release()
+                raise
+
+            # a job keeps its place until it's done, even if we stop
+            # waiting for it: cancel() can't stop one that has started
+            future.add_done_callback(self._release)
+
+            try:
+                result = future.result(
+                    timeout=config.get('PASSWORD_HASH_TIMEOUT', 5))
+            except TimeoutError:
+                future.cancel()
+                with self.lock:
+                    self.timed_out += 1
+                raise HashingBusy()
+
+        with self.lock:
+            self.completed += 1
+
+        return result
+
+    def _release(self, future=None):
+        """A job has finished (or been cancelled): free its place."""
+
+        with self.lock:
+            self.pending -= 1
+
+    def stats(self):
+        """Current counters, e.g. for a metrics endpoint."""
+
+        with self.lock:
+            return {
+                'pending': self.pending,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'timed_out': self.timed_out,
+                'rejected': self.rejected,
+            }
+
+
+pool = HashingPool()
+
+
+def init_app(app):
+    """Take hashing settings from `app`.
+
+    Like the database, this works outside an app context too, since models
+    hash passwords from scripts and tests.
+    """
+
+    pool.config = app.config
+
+
+def log_rounds():
+    """The configured bcrypt work factor."""
+
+    return pool.config.get('BCRYPT_LOG_ROUNDS', DEFAULT_LOG_ROUNDS)
+
+
+def hash_password(password):
+    """Return a bcrypt hash of `password` at the configured cost."""
+
+    if not password:
+        raise ValueError('Password must be non-empty.')
+
+    return pool.run(_hash, password.encode('UTF-8'), log_rounds())
+
+
+def check_password(pw_hash, password):
+    """Does `password` match the stored `pw_hash`?"""
+
+    return pool.run(_check, pw_hash.encode('UTF-8'), password.encode('UTF-8'))
+
+
+def needs_rehash(pw_hash):
+    """Was `pw_hash` made with a different cost than is now configured?"""
+
+    try:
+        return int(pw_hash.split('$')[2]) != log_rounds()
+    except (IndexError, ValueError):
+        return True
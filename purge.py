@@ -0,0 +1,128 @@
+"""Account deletion for Warbler.
+
+Deleting an account takes two steps, so the request that asks for it
+stays short however much the account posted:
+
+- `deactivate()`, in the request: hides the account and its messages
+  (users.deactivated; read paths skip deactivated authors),
+  takes it out of everyone else's counters and queues an AccountPurge.
+
+- `purge()`, in the background (`flask purge-accounts`, run by the
+  Procfile's worker): removes the account's rows in batches of
+  `batch_size`, one transaction each, so no statement holds locks on a
+  large part of the messages, likes or follows tables.
+
+A purge goes through STAGES in order. Deleting a batch of messages lets
+the database's ON DELETE CASCADE remove the likes and timeline entries
+that point at them. Every batch commits together with the job's stage
+and count of rows deleted, so after a crash the next `purge()` carries on
+from the same stage, and since a batch only deletes what is left,
+re-running one is harmless.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import or_, select, tuple_
+
+from models import (db, AccountPurge, Follows, Likes, Message, TimelineEntry,
+                    User)
+import author_cache
+import viewer_cache
+
+STAGES = ['likes', 'follows', 'messages', 'timeline', 'user']
+
+DONE = 'done'
+
+
+def deactivate(user):
+    """Hide `user` at once and queue the removal of their rows."""
+
+    user.release_counts()
+    user.deactivated = True
+    db.session.add(AccountPurge(user_id=user.id,
+                                requested_at=datetime.utcnow(),
+                                stage=STAGES[0]))
+    db.session.commit()
+    viewer_cache.invalidate(user.id)
+    author_cache.invalidate(user.id)
+
+
+def _batch_statement(stage, user_id, batch_size):
+    """A DELETE of up to `batch_size` of `user_id`'s rows for `stage`."""
+
+    if stage == 'likes':
+        ids = (select([Likes.id])
+               .where(Likes.user_id == user_id)
+               .limit(batch_size))
+        return Likes.__table__.delete().where(Likes.id.in_(ids))
+
+    if stage == 'follows':
+        key = tuple_(Follows.user_being_followed_id, Follows.user_following_id)
+        keys = (select([Follows.user_being_followed_id,
+                        Follows.user_following_id])
+                .where(or_(Follows.user_being_followed_id == user_id,
+                           Follows.user_following_id == user_id))
+                .limit(batch_size))
+        return Follows.__table__.delete().where(key.in_(keys))
+
+    if stage == 'messages':
+        ids = (select([Message.id])
+               .where(Message.user_id == user_id)
+               .limit(batch_size))
+        return Message.__table__.delete().where(Message.id.in_(ids))
+
+    if stage == 'timeline':
+        ids = (select([TimelineEntry.message_id])
+               .where(TimelineEntry.user_id == user_id)
+               .limit(batch_size))
+        return (TimelineEntry.__table__.delete()
+                .where(TimelineEntry.user_id == user_id)
+                .where(TimelineEntry.message_id.in_(ids)))
+
+    return User.__table__.delete().where(User.id == user_id)
+
+
+def _next_stage(stage):
+    position = STAGES.index(stage) + 1
+    return STAGES[position] if position < len(STAGES) else DONE
+
+
+def purge_account(job, batch_size=1000, progress=None):
+    """Remove the rows of `job`'s account, a batch per transaction.
+
+    `progress`, if given, is called with the job after each batch.
+    """
+
+    while job.stage != DONE:
+        deleted = db.session.execute(
+            _batch_statement(job.stage, job.user_id, batch_size)).rowcount
+
+        job.rows_deleted += deleted
+
+        # a short batch means nothing is left of this stage's rows
+        if deleted < batch_size:
+            job.stage = _next_stage(job.stage)
+            if job.stage == DONE:
+                job.finished_at = datetime.utcnow()
+
+        db.session.commit()
+
+        if progress:
+            progress(job)
+
+
+def purge(batch_size=1000, progress=None):
+    """Finish every queued or interrupted purge, oldest first.
+
+    Returns how many accounts were purged.
+    """
+
+    jobs = (AccountPurge.query
+            .filter(AccountPurge.finished_at.is_(None))
+            .order_by(AccountPurge.requested_at)
+            .all())
+
+    for job in jobs:
+        purge_account(job, batch_size, progress)
+
+    return len(jobs)
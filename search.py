@@ -0,0 +1,343 @@
+"""Search for Warbler.
+
+On Postgres, user search is backed by pg_trgm GIN indexes over username,
+bio and location: they serve `ILIKE '%term%'` without a sequential scan,
+and `similarity()` ranks the matches. Other databases (SQLite, in tests
+and development) get a portable LIKE query ranked in Python.
+
+Message search uses a tsvector column with a GIN index on Postgres,
+ranked with ts_rank. Elsewhere an in-process inverted index stands in
+for it; that index only sees writes made by its own process, so results
+are re-checked against the stored text before they are returned.
+"""
+
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+
+from flask import current_app
+from sqlalchemy import DDL, case, cast, event, func, or_, tuple_
+from sqlalchemy.dialects.postgresql import DOUBLE_PRECISION
+from sqlalchemy.orm import joinedload
+
+from models import db, Message, User
+
+USER_RESULTS_LIMIT = 50
+AUTOCOMPLETE_LIMIT = 10
+
+USER_SEARCH_COLUMNS = ('username', 'bio', 'location')
+
+
+TRIGRAM_INDEX_DDL = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+] + [
+    f'CREATE INDEX IF NOT EXISTS ix_users_{column}_trgm '
+    f'ON users USING gin ({column} gin_trgm_ops)'
+    for column in USER_SEARCH_COLUMNS
+]
+
+# create the trigram indexes along with the users table, on Postgres only
+for statement in TRIGRAM_INDEX_DDL:
+    event.listen(User.__table__,
+                 'after_create',
+                 DDL(statement).execute_if(dialect='postgresql'))
+
+TEXT_SEARCH_CONFIG = 'english'
+
+MESSAGE_INDEX_DDL = ('CREATE INDEX IF NOT EXISTS ix_messages_search_vector '
+                     'ON messages USING gin (search_vector)')
+
+event.listen(Message.__table__,
+             'after_create',
+             DDL(MESSAGE_INDEX_DDL).execute_if(dialect='postgresql'))
+
+
+def is_postgres():
+    """Is the app's database Postgres?"""
+
+    return db.engine.dialect.name == 'postgresql'
+
+
+def escape_like(term):
+    """Escape LIKE wildcards in user input (use with escape='\\\\')."""
+
+    return (term
+            .replace('\\', '\\\\')
+            .replace('%', '\\%')
+            .replace('_', '\\_'))
+
+
+def _contains(term):
+    """Criterion: `term` appears in username, bio or location."""
+
+    pattern = f"%{escape_like(term)}%"
+
+    return or_(*[getattr(User, column).ilike(pattern, escape='\\')
+                 for column in USER_SEARCH_COLUMNS])
+
+
+def _rank(user, term):
+    """Python ranking for the portable path: best matches sort first."""
+
+    term = term.lower()
+    username = user.username.lower()
+
+    return (not username.startswith(term),
+            term not in username,
+            len(username) - len(term),
+            user.id)
+
+
+def search_users(term, limit=USER_RESULTS_LIMIT):
+    """Users matching `term`, best matches first, at most `limit` of them.
+
+    Username prefix matches come first, then other username matches, then
+    users matching only on bio or location.
+    """
+
+    query = User.query.filter_by(deactivated=False).filter(_contains(term))
+
+    if not is_postgres():
+        return sorted(query.all(), key=lambda user: _rank(user, term))[:limit]
+
+    prefix = f"{escape_like(term)}%"
+
+    return (query
+            .order_by(case([(User.username.ilike(prefix, escape='\\'), 0)],
+                           else_=1),
+                      func.similarity(User.username, term).desc(),
+                      User.id)
+            .limit(limit)
+            .all())
+
+
+def autocomplete_users(prefix, limit=AUTOCOMPLETE_LIMIT):
+    """Users whose username starts with `prefix`, shortest names first."""
+
+    pattern = f"{escape_like(prefix)}%"
+
+    return (User
+            .query
+            .filter_by(deactivated=False)
+            .filter(User.username.ilike(pattern, escape='\\'))
+            .order_by(func.length(User.username), User.username)
+            .limit(limit)
+            .all())
+
+
+##############################################################################
+# Message search
+
+
+WORD_RE = re.compile(r"[\w']+")
+
+
+def tokenize(text):
+    """Lower-cased words of `text`, for the in-process index."""
+
+    return [word.strip("'") for word in WORD_RE.findall(text.lower())
+            if word.strip("'")]
+
+
+class InvertedIndex:
+    """In-process full-text index of messages, ranked with BM25."""
+
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self):
+        self.postings = defaultdict(dict)
+        self.lengths = {}
+        self.lock = threading.Lock()
+
+    def add(self, message_id, text):
+        """Index (or re-index) a message."""
+
+        tokens = tokenize(text)
+
+        with self.lock:
+            self.lengths[message_id] = len(tokens)
+            for token, count in Counter(tokens).items():
+                self.postings[token][message_id] = count
+
+    def remove(self, message_id, text):
+        """Drop a message from the index."""
+
+        with self.lock:
+            self.lengths.pop(message_id, None)
+            for token in set(tokenize(text)):
+                posting = self.postings.get(token, {})
+                posting.pop(message_id, None)
+                if not posting:
+                    self.postings.pop(token, None)
+
+    def search(self, term, limit, before=None):
+        """Return up to `limit` (score, message id) pairs matching `term`.
+
+        Every word of `term` must appear. Results are best first; `before`
+        is an optional (score, id) cursor from a previous page.
+        """
+
+        words = set(tokenize(term))
+        if not words:
+            return []
+
+        with self.lock:
+            postings = [self.postings.get(word, {}) for word in words]
+            postings.sort(key=len)
+            ids = set(postings[0]).intersection(*postings[1:])
+
+            total = len(self.lengths) or 1
+            average = sum(self.lengths.values()) / total or 1
+
+            results = []
+            for id in ids:
+                score = 0
+                norm = self.K1 * (1 - self.B +
+                                  self.B * self.lengths[id] / average)
+                for posting in postings:
+                    idf = math.log(1 + (total - len(posting) + 0.5) /
+                                   (len(posting) + 0.5))
+                    count = posting[id]
+                    score += idf * count * (self.K1 + 1) / (count + norm)
+                results.append((score, id))
+
+        if before:
+            results = [result for result in results if result < tuple(before)]
+
+        return sorted(results, reverse=True)[:limit]
+
+
+def _message_index():
+    """The in-process message index, built from the database on first use."""
+
+    index = current_app.extensions.get('message_index')
+
+    if index is None:
+        index = InvertedIndex()
+        rows = db.session.query(Message.id, Message.text).yield_per(1000)
+        for id, text in rows:
+            index.add(id, text)
+        current_app.extensions['message_index'] = index
+
+    return index
+
+
+def index_message(msg):
+    """Index a newly-added (and flushed) message for search."""
+
+    if is_postgres():
+        (Message
+         .query
+         .filter(Message.id == msg.id)
+         .update({Message.search_vector:
+                  func.to_tsvector(TEXT_SEARCH_CONFIG, Message.text)},
+                 synchronize_session=False))
+    else:
+        _message_index().add(msg.id, msg.text)
+
+
+def unindex_message(msg):
+    """Drop a message that is being deleted from search."""
+
+    # on Postgres the tsvector goes away with the row itself
+    if not is_postgres():
+        _message_index().remove(msg.id, msg.text)
+
+
+def reindex_messages(batch_size=10000, progress=None):
+    """Fill in the search document of every message not yet indexed.
+
+    On Postgres this updates `batch_size` messages per transaction;
+    elsewhere it rebuilds the in-process index. `progress`, if given, is
+    called with the number of messages indexed so far.
+    """
+
+    if not is_postgres():
+        current_app.extensions.pop('message_index', None)
+        _message_index()
+        return
+
+    done = 0
+    while True:
+        batch = (db.session
+                 .query(Message.id)
+                 .filter(Message.search_vector.is_(None))
+                 .limit(batch_size)
+                 .subquery())
+
+        updated = (Message
+                   .query
+                   .filter(Message.id.in_(batch))
+                   .update({Message.search_vector:
+                            func.to_tsvector(TEXT_SEARCH_CONFIG,
+                                             Message.text)},
+                           synchronize_session=False))
+        db.session.commit()
+
+        if not updated:
+            break
+
+        done += updated
+        if progress:
+            progress(done)
+
+
+def search_messages(term, limit, before=None):
+    """Messages matching `term` as (message, score) pairs, best first.
+
+    `before` is an optional (score, id) cursor from a previous page.
+    """
+
+    if is_postgres():
+        query = func.plainto_tsquery(TEXT_SEARCH_CONFIG, term)
+        # ts_rank is a real; as a double it compares exactly with the
+        # Python float in the cursor, so ties at a page break hold
+        rank = cast(func.ts_rank(Message.search_vector, query),
+                    DOUBLE_PRECISION)
+
+        results = (db.session
+                   .query(Message, rank)
+                   .join(User, User.id == Message.user_id)
+                   .filter(Message.search_vector.op('@@')(query),
+                           User.deactivated.is_(False)))
+
+        if before:
+            results = results.filter(tuple_(rank, Message.id) <
+                                     tuple_(*before))
+
+        return (results
+                .options(joinedload(Message.user))
+                .order_by(rank.desc(), Message.id.desc())
+                .limit(limit)
+                .all())
+
+    words = set(tokenize(term))
+    index = _message_index()
+    found = []
+
+    # hits by deactivated authors, or stale ones, are dropped after the
+    # index has applied the limit, so keep going until the page is full
+    while len(found) < limit:
+        hits = index.search(term, limit, before)
+        if not hits:
+            break
+
+        messages = (Message
+                    .query
+                    .join(User, User.id == Message.user_id)
+                    .filter(Message.id.in_([id for score, id in hits]),
+                            User.deactivated.is_(False))
+                    .options(joinedload(Message.user))
+                    .all())
+        by_id = {msg.id: msg for msg in messages
+                 if words <= set(tokenize(msg.text))}
+
+        found.extend((by_id[id], score) for score, id in hits if id in by_id)
+
+        if len(hits) < limit:
+            break
+        before = hits[-1]
+
+    return found[:limit]
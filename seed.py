@@ -1,20 +1,75 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
-from app import db
-from models import User, Message, Follows
+Run it like:
 
+    python seed.py [--data-dir generator] [--chunk-size 10000] [--jobs 2]
 
-db.drop_all()
-db.create_all()
+This wipes the database, migrates it, and bulk-loads users.csv,
+messages.csv, follows.csv and (if present) likes.csv from the data
+directory (see loader.py). Then it fills in the derived data: counters,
+home timelines and the message search index.
+"""
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+import argparse
+import time
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+from app import app, db
+from models import Message, User
+import loader
+import migrations
+import search
+import timeline
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
 
-db.session.commit()
+def seed(data_dir, chunk_size=loader.DEFAULT_CHUNK_SIZE, jobs=2, log=print):
+    """Wipe the database and load it from the CSVs in `data_dir`.
+
+    `log` is called with a line of progress at each step.
+    """
+
+    started = time.monotonic()
+
+    def progress(table, rows):
+        elapsed = time.monotonic() - started
+        log(f"{table}: {rows} rows ({elapsed:.1f}s)")
+
+    migrations.reset(db.engine)
+    migrations.upgrade(db.engine)
+
+    loader.load_all(db.engine, data_dir,
+                    chunk_size=chunk_size,
+                    jobs=jobs,
+                    progress=progress)
+
+    with app.app_context():
+        log("Counting...")
+        User.reconcile_counts()
+        Message.reconcile_counts()
+        db.session.commit()
+
+        log("Building timelines...")
+        timeline.rebuild()
+
+        log("Indexing messages...")
+        search.reindex_messages()
+
+    log(f"Done in {time.monotonic() - started:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--data-dir', default='generator',
+                        help='directory holding the CSV files')
+    parser.add_argument('--chunk-size', type=int,
+                        default=loader.DEFAULT_CHUNK_SIZE,
+                        help='rows loaded per batch')
+    parser.add_argument('--jobs', type=int, default=2,
+                        help='tables loaded in parallel (Postgres only)')
+    args = parser.parse_args()
+
+    seed(args.data_dir, args.chunk_size, args.jobs,
+         log=lambda line: print(line, flush=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""Time-ordered ("snowflake") message ids for Warbler.
+
+An id is a 63-bit integer made of, from the high bits down:
+
+- 41 bits: milliseconds since EPOCH (good until 2079)
+- 10 bits: the id of the process that made it
+- 12 bits: a sequence number within the millisecond
+
+so sorting ids sorts messages by when they were posted, and "newest
+first" is a plain descending range read of an index on the id. Each
+process makes its ids without talking to the database or to other
+processes.
+
+The worker id is SNOWFLAKE_WORKER_ID. Every process that posts messages
+must have a different one, or two of them can make the same id in the
+same millisecond; gunicorn.conf.py sets it for each web worker. Without
+it (scripts, the shell) the id is random, which is fine for a process
+or two but not for a fleet of workers; it's picked again in each forked
+child.
+
+If the clock steps backwards, or a process runs out of sequence numbers
+in one millisecond (after at least 2048 ids), ids carry on from the
+last millisecond used rather than waiting for the clock, so they never
+repeat or go backwards.
+"""
+
+import os
+import random
+import threading
+import time
+from datetime import datetime
+
+EPOCH = datetime(2010, 1, 1)
+
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+SEQUENCE_MASK = (1 << SEQUENCE_BITS) - 1
+
+# bits below the timestamp
+TIME_SHIFT = WORKER_BITS + SEQUENCE_BITS
+
+_EPOCH_SECONDS = (EPOCH - datetime(1970, 1, 1)).total_seconds()
+
+
+class _Generator:
+    """Makes the ids of one process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.worker_id = _worker_id()
+        self.last_ms = -1
+        self.sequence = 0
+
+    def next_id(self):
+        with self.lock:
+            now = _now_ms()
+
+            if now > self.last_ms:
+                self._start(now)
+            else:
+                self.sequence += 1
+                if self.sequence > SEQUENCE_MASK:
+                    # used up this millisecond: borrow the next one
+                    self._start(self.last_ms + 1)
+
+            return ((self.last_ms << TIME_SHIFT)
+                    | (self.worker_id << SEQUENCE_BITS)
+                    | self.sequence)
+
+    def _start(self, ms):
+        # a random start in the lower half keeps room for 2048+ more ids
+        self.last_ms = ms
+        self.sequence = random.getrandbits(SEQUENCE_BITS - 1)
+
+
+def _now_ms():
+    return int((time.time() - _EPOCH_SECONDS) * 1000)
+
+
+def _worker_id():
+    pinned = os.environ.get('SNOWFLAKE_WORKER_ID')
+    if pinned:
+        worker_id = int(pinned)
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f"SNOWFLAKE_WORKER_ID must be 0 to "
+                             f"{MAX_WORKER_ID}, not {worker_id}")
+        return worker_id
+
+    return random.SystemRandom().getrandbits(WORKER_BITS)
+
+
+_generator = _Generator()
+
+
+def reset():
+    """Start afresh, re-reading SNOWFLAKE_WORKER_ID."""
+
+    global _generator
+    _generator = _Generator()
+
+
+os.register_at_fork(after_in_child=reset)
+
+
+def next_id():
+    """A new id, greater than every id this process made before."""
+
+    return _generator.next_id()
+
+
+def make_id(timestamp, low_bits):
+    """The id of a message posted at `timestamp` (a naive UTC datetime).
+
+    For bulk loads: `low_bits`, say a row number, replaces the worker id
+    and sequence, and must be unique among rows in the same millisecond.
+    """
+
+    ms = int((timestamp - EPOCH).total_seconds() * 1000)
+    return (ms << TIME_SHIFT) | (low_bits & ((1 << TIME_SHIFT) - 1))
+
@@ -0,0 +1,78 @@
+"""Streamed page rendering for Warbler.
+
+With STREAM_PAGES on, `render()` sends a page while its template is
+still rendering, instead of building the whole string first: the first
+STREAM_FIRST_CHUNK_SIZE bytes (the <head> and nav, so the browser can
+start fetching stylesheets) go out at once, then the rest in chunks of
+about STREAM_CHUNK_SIZE bytes as the cards render. Views that can give
+the template a query instead of a list pass it through `rows()`, so
+cards render as rows come off the database cursor.
+
+Headers are sent before the body is rendered, so anything that changes
+them (the session, in particular) must happen before `render()` returns.
+Flashed messages are read up front for that reason.
+
+Off, `render()` is plain `render_template()`. Compression of both kinds
+of responses is in compression.py.
+"""
+
+from flask import (current_app, get_flashed_messages, render_template,
+                   stream_with_context)
+
+
+def enabled():
+    """Is page streaming turned on?"""
+
+    return current_app.config.get('STREAM_PAGES', False)
+
+
+def _chunks(pieces, first_size, size):
+    """Join the strings `pieces` into chunks, flushing the first early."""
+
+    buffered = []
+    length = 0
+    limit = first_size
+
+    for piece in pieces:
+        buffered.append(piece)
+        length += len(piece)
+
+        if length >= limit:
+            yield ''.join(buffered)
+            buffered = []
+            length = 0
+            limit = size
+
+    if buffered:
+        yield ''.join(buffered)
+
+
+def render(template_name, **context):
+    """Render a page: streamed if STREAM_PAGES is on, else all at once."""
+
+    if not enabled():
+        return render_template(template_name, **context)
+
+    # pops them from the session now, while it can still be saved; the
+    # template gets the same messages from the request
+    get_flashed_messages()
+
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+
+    chunks = _chunks(template.generate(context),
+                     app.config['STREAM_FIRST_CHUNK_SIZE'],
+                     app.config['STREAM_CHUNK_SIZE'])
+
+    return app.response_class(stream_with_context(chunks),
+                              mimetype='text/html')
+
+
+def rows(query):
+    """`query`, fetched in batches while streaming, else all at once."""
+
+    if not enabled():
+        return query.all()
+
+    return query.yield_per(current_app.config['STREAM_BATCH_SIZE'])
@@ -0,0 +1,153 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_api.py
+
+import os
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from unittest import TestCase
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Follows, Likes
+import viewer_cache
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.drop_all()
+db.create_all()
+
+
+class ApiTestCase(TestCase):
+    """Test the timeline, profile, like and follow endpoints."""
+
+    def setUp(self):
+        """An author with three messages and a reader."""
+
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        author = User.signup("author", "author@test.com", "password", None)
+        reader = User.signup("reader", "reader@test.com", "password", None)
+        db.session.commit()
+
+        for text in ("one", "two", "three"):
+            db.session.add(Message(text=text, user_id=author.id))
+        db.session.commit()
+
+        self.author_id = author.id
+        self.reader_id = reader.id
+        self.message_id = Message.query.filter_by(text="two").one().id
+
+        self.saved_page_size = app.config['MESSAGES_PER_PAGE']
+        app.extensions['viewer_cache'] = viewer_cache.make_cache(app.config)
+        self.client = app.test_client()
+
+    def tearDown(self):
+        """Clean up fouled transactions and restore config."""
+
+        db.session.rollback()
+        app.config['MESSAGES_PER_PAGE'] = self.saved_page_size
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_login_required(self):
+        """Timelines and toggles need a logged-in user"""
+
+        like_url = f'/api/v1/messages/{self.message_id}/like'
+        follow_url = f'/api/v1/users/{self.author_id}/follow'
+
+        for method, url in (('GET', '/api/v1/timeline'),
+                            ('POST', like_url),
+                            ('POST', follow_url)):
+            resp = self.client.open(url, method=method)
+
+            self.assertEqual(resp.status_code, 401)
+            self.assertIn('error', resp.get_json())
+
+    def test_follow_and_timeline(self):
+        """Following answers with the new state; the timeline pages"""
+
+        self.login(self.reader_id)
+        url = f'/api/v1/users/{self.author_id}/follow'
+
+        self.assertEqual(self.client.post(url).get_json(),
+                         {'following': True, 'followers': 1})
+        self.assertEqual(self.client.post(url).get_json(),
+                         {'following': True, 'followers': 1})
+
+        app.config['MESSAGES_PER_PAGE'] = 2
+        page = self.client.get('/api/v1/timeline').get_json()
+
+        self.assertEqual([msg['text'] for msg in page['messages']],
+                         ['three', 'two'])
+        self.assertEqual(list(page['users']), [str(self.author_id)])
+        self.assertTrue(page['users'][str(self.author_id)]['followed'])
+
+        page = self.client.get('/api/v1/timeline',
+                               query_string={'before': page['next']})
+        page = page.get_json()
+
+        self.assertEqual([msg['text'] for msg in page['messages']], ['one'])
+        self.assertIsNone(page['next'])
+
+        self.assertEqual(self.client.delete(url).get_json(),
+                         {'following': False, 'followers': 0})
+        self.assertEqual(Follows.query.count(), 0)
+
+    def test_relationships(self):
+        """Relationship status comes for a batch of users at once"""
+
+        Follows.add(self.author_id, self.reader_id)
+        db.session.commit()
+        self.login(self.reader_id)
+
+        resp = self.client.get('/api/v1/relationships', query_string={
+            'ids': f'{self.author_id},{self.reader_id}'})
+
+        self.assertEqual(resp.get_json(), {'relationships': {
+            str(self.author_id): {'following': False, 'followed_by': True},
+            str(self.reader_id): {'following': False, 'followed_by': False},
+        }})
+
+        resp = self.client.get('/api/v1/relationships',
+                               query_string={'ids': 'one,two'})
+        self.assertEqual(resp.status_code, 400)
+
+    def test_like(self):
+        """Liking answers with the new state and the message's likes"""
+
+        self.login(self.reader_id)
+        url = f'/api/v1/messages/{self.message_id}/like'
+
+        self.assertEqual(self.client.post(url).get_json(),
+                         {'liked': True, 'likes': 1})
+        self.assertEqual(self.client.post(url).get_json(),
+                         {'liked': True, 'likes': 1})
+        self.assertEqual(User.query.get(self.reader_id).likes_count, 1)
+
+        self.assertEqual(self.client.delete(url).get_json(),
+                         {'liked': False, 'likes': 0})
+        self.assertEqual(self.client.delete(url).get_json(),
+                         {'liked': False, 'likes': 0})
+        self.assertEqual(User.query.get(self.reader_id).likes_count, 0)
+
+    def test_user(self):
+        """A profile comes with a page of its messages"""
+
+        resp = self.client.get(f'/api/v1/users/{self.author_id}')
+        payload = resp.get_json()
+
+        self.assertEqual(payload['user']['username'], 'author')
+        self.assertEqual(payload['user']['messages'], 0)
+        self.assertEqual(len(payload['messages']), 3)
+        self.assertFalse(payload['messages'][0]['liked'])
+
+        resp = self.client.get('/api/v1/users/999999')
+        self.assertEqual(resp.status_code, 404)
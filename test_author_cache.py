@@ -0,0 +1,145 @@
+"""Pull-model timeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_author_cache.py
+
+import os
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Follows, Likes, TimelineEntry
+import author_cache
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.drop_all()
+db.create_all()
+
+
+class AuthorCacheTestCase(TestCase):
+    """Test merging home timelines from cached lists of recent messages."""
+
+    def setUp(self):
+        """Two authors followed by a reader; pull engine, empty cache."""
+
+        TimelineEntry.query.delete()
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        users = [User.signup(name, f"{name}@test.com", "password", None)
+                 for name in ("ann", "bob", "reader")]
+        db.session.commit()
+
+        self.ann, self.bob, self.reader = [user.id for user in users]
+        Follows.add(self.reader, self.ann)
+        Follows.add(self.reader, self.bob)
+        db.session.commit()
+
+        app.config['TIMELINE_ENGINE'] = 'pull'
+        app.config['AUTHOR_CACHE_LENGTH'] = 3
+        author_cache.init_app(app)
+
+        self.client = app.test_client()
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+    def tearDown(self):
+        """Clean up fouled transactions and restore config."""
+
+        db.session.rollback()
+        app.config['TIMELINE_ENGINE'] = 'push'
+        app.config['AUTHOR_CACHE_LENGTH'] = author_cache.DEFAULT_LENGTH
+        self.ctx.pop()
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def post(self, author_id, text):
+        """Add a message directly, oldest first, returning its id."""
+
+        msg = Message(text=text, user_id=author_id)
+        db.session.add(msg)
+        db.session.commit()
+        return msg.id
+
+    def test_merge(self):
+        """Authors' lists are merged newest first, stopping at the limit"""
+
+        ids = [self.post(author, f"msg {number}")
+               for number, author in enumerate([self.ann, self.bob,
+                                                self.bob, self.ann])]
+
+        timeline = author_cache.home_timeline([self.ann, self.bob], limit=3)
+
+        self.assertEqual([msg.id for msg in timeline], ids[::-1][:3])
+        self.assertEqual(author_cache.get_cache().get(str(self.bob))[1],
+                         [ids[2], ids[1]])
+
+    def test_deep_pages(self):
+        """Pages past the cached lists come from the database"""
+
+        ids = [self.post(self.ann, f"msg {number}") for number in range(6)]
+
+        first = author_cache.home_timeline([self.ann], limit=2)
+        self.assertEqual([msg.id for msg in first], [ids[5], ids[4]])
+
+        rest = author_cache.home_timeline([self.ann], limit=10,
+                                          before=ids[4])
+        self.assertEqual([msg.id for msg in rest], ids[3::-1])
+
+    def test_posting_and_deleting(self):
+        """Posting or deleting drops the author's list"""
+
+        self.login(self.ann)
+        self.client.post("/messages/new", data={"text": "first"})
+        first = Message.query.one().id
+        self.assertEqual(author_cache.recent_ids([self.ann]),
+                         {self.ann: [first]})
+
+        self.client.post("/messages/new", data={"text": "second"})
+        newest = (Message.query.filter_by(text="second").one().id)
+        self.assertEqual(author_cache.recent_ids([self.ann]),
+                         {self.ann: [newest, first]})
+
+        self.client.post(f"/messages/{newest}/delete")
+        self.assertEqual(author_cache.recent_ids([self.ann]),
+                         {self.ann: [first]})
+
+    def test_post_during_load(self):
+        """A post committed while its author's list loads isn't hidden"""
+
+        load_ids = author_cache._load_ids
+        posted = []
+
+        def load_then_post(author_ids, limit, before=None):
+            ids = load_ids(author_ids, limit, before)
+            posted.append(self.post(self.ann, "just missed"))
+            author_cache.add(Message.query.get(posted[0]))
+            return ids
+
+        with patch.object(author_cache, '_load_ids', load_then_post):
+            self.assertEqual(author_cache.recent_ids([self.ann]),
+                             {self.ann: []})
+
+        self.assertEqual(author_cache.recent_ids([self.ann]),
+                         {self.ann: posted})
+
+    def test_homepage(self):
+        """With the pull engine the homepage skips fan-out entirely"""
+
+        self.login(self.ann)
+        self.client.post("/messages/new", data={"text": "pulled in"})
+        self.assertEqual(TimelineEntry.query.count(), 0)
+
+        self.login(self.reader)
+        html = self.client.get("/").get_data(as_text=True)
+        self.assertIn("<p>pulled in</p>", html)
@@ -0,0 +1,165 @@
+"""Connection pooling and replica routing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_database.py
+
+import os
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Follows, Likes
+import database
+import viewer_cache
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.drop_all()
+db.create_all()
+
+
+class EngineOptionsTestCase(TestCase):
+    """Test the pool settings handed to SQLAlchemy."""
+
+    config = {
+        'SQLALCHEMY_DATABASE_URI': 'postgresql:///warbler',
+        'DB_POOL_SIZE': 3,
+        'DB_MAX_OVERFLOW': 2,
+        'DB_POOL_TIMEOUT': 1.5,
+        'DB_POOL_RECYCLE': 600,
+        'DB_POOL_PRE_PING': True,
+        'DB_STATEMENT_TIMEOUT_MS': 2000,
+    }
+
+    def test_postgres(self):
+        """Postgres gets a sized pool and a statement timeout"""
+
+        self.assertEqual(database.engine_options(self.config), {
+            'pool_size': 3,
+            'max_overflow': 2,
+            'pool_timeout': 1.5,
+            'pool_recycle': 600,
+            'pool_pre_ping': True,
+            'connect_args': {'options': '-c statement_timeout=2000'},
+        })
+
+    def test_no_statement_timeout(self):
+        """A zero timeout leaves the server's default alone"""
+
+        config = dict(self.config, DB_STATEMENT_TIMEOUT_MS=0)
+
+        self.assertNotIn('connect_args', database.engine_options(config))
+
+    def test_sqlite(self):
+        """SQLite doesn't use a queue pool, so takes no pool options"""
+
+        config = dict(self.config, SQLALCHEMY_DATABASE_URI='sqlite://')
+
+        self.assertEqual(database.engine_options(config), {})
+
+    def test_fork(self):
+        """A forked child gets new pools and never closes inherited ones"""
+
+        engine = db.engine
+        inherited = engine.pool
+
+        database._replace_inherited_pools()
+
+        self.assertIsNot(engine.pool, inherited)
+        self.assertIn(inherited, database._inherited_pools)
+
+
+class ReplicaTestCase(TestCase):
+    """Test sending read-only views to the replica."""
+
+    def setUp(self):
+        """Point the replica at the test database; add two users."""
+
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        author = User.signup("author", "author@test.com", "password", None)
+        reader = User.signup("reader", "reader@test.com", "password", None)
+        db.session.commit()
+
+        self.author_id = author.id
+        self.reader_id = reader.id
+
+        app.config['SQLALCHEMY_BINDS'][database.REPLICA] = (
+            app.config['SQLALCHEMY_DATABASE_URI'])
+        app.extensions['viewer_cache'] = viewer_cache.make_cache(app.config)
+
+        self.replica_statements = []
+        self.replica = db.get_engine(app, bind=database.REPLICA)
+        event.listen(self.replica, 'before_cursor_execute',
+                     self.record_statement)
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        """Clean up fouled transactions and stop using the replica."""
+
+        event.remove(self.replica, 'before_cursor_execute',
+                     self.record_statement)
+        del app.config['SQLALCHEMY_BINDS'][database.REPLICA]
+        db.session.rollback()
+
+    def record_statement(self, conn, cursor, statement, *args):
+        self.replica_statements.append(statement)
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_read_only_views(self):
+        """Read-only views query the replica; others the primary"""
+
+        resp = self.client.get(f"/users/{self.author_id}")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(self.replica_statements)
+
+        self.replica_statements.clear()
+        self.client.get("/login")
+
+        self.assertEqual(self.replica_statements, [])
+
+    def test_reads_after_writes(self):
+        """Someone who just wrote reads from the primary for a while"""
+
+        self.login(self.reader_id)
+        resp = self.client.post(f"/users/follow/{self.author_id}")
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(self.replica_statements, [])
+
+        resp = self.client.get(f"/users/{self.author_id}/followers")
+
+        self.assertIn("@reader", resp.get_data(as_text=True))
+        self.assertEqual(self.replica_statements, [])
+
+        with self.client.session_transaction() as sess:
+            sess[database.PRIMARY_UNTIL_KEY] = 0
+
+        self.client.get(f"/users/{self.author_id}/followers")
+        self.assertTrue(self.replica_statements)
+
+    def test_no_replica(self):
+        """Without a replica, read-only views use the primary"""
+
+        del app.config['SQLALCHEMY_BINDS'][database.REPLICA]
+        try:
+            self.client.get(f"/users/{self.author_id}")
+        finally:
+            app.config['SQLALCHEMY_BINDS'][database.REPLICA] = (
+                app.config['SQLALCHEMY_DATABASE_URI'])
+
+        self.assertEqual(self.replica_statements, [])
@@ -0,0 +1,124 @@
+"""Fragment cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_fragments.py
+
+import os
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from unittest import TestCase
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Follows, Likes
+from fragments import fragments
+import timeline
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.drop_all()
+db.create_all()
+
+
+class FragmentCacheTestCase(TestCase):
+    """Test caching message and user cards across requests and viewers."""
+
+    def setUp(self):
+        """Two users following each other; one has posted a message."""
+
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        author = User.signup("author", "author@test.com", "password", None)
+        reader = User.signup("reader", "reader@test.com", "password", None)
+        db.session.commit()
+
+        author.followers.append(reader)
+        reader.followers.append(author)
+        message = Message(text="Cache me", user_id=author.id)
+        db.session.add(message)
+        db.session.commit()
+
+        self.author_id = author.id
+        self.reader_id = reader.id
+        self.message_id = message.id
+
+        with app.app_context():
+            timeline.rebuild()
+
+        fragments.configure(app.config)
+        self.client = app.test_client()
+
+    def tearDown(self):
+        """Clean up fouled transactions."""
+
+        db.session.rollback()
+
+    def get_as(self, user_id, url):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+        return self.client.get(url).get_data(as_text=True)
+
+    def test_card_cached(self):
+        """A message card is rendered once, then served from the cache"""
+
+        self.get_as(self.reader_id, "/")
+        versions, html = fragments.cache.get(f"message:{self.message_id}")
+
+        self.assertIn("Cache me", html)
+
+        fragments.cache.set(f"message:{self.message_id}",
+                            (versions, html.replace("Cache me", "Cached")))
+        self.assertIn("Cached", self.get_as(self.reader_id, "/"))
+
+    def test_viewer_bits_not_cached(self):
+        """Like buttons reflect each viewer, around the same cached card"""
+
+        db.session.add(Likes(user_id=self.reader_id,
+                             message_id=self.message_id))
+        db.session.commit()
+
+        reader_html = self.get_as(self.reader_id,
+                                  f"/users/{self.author_id}")
+        author_html = self.get_as(self.author_id,
+                                  f"/users/{self.author_id}")
+
+        self.assertIn("btn-primary", reader_html)
+        self.assertIn("messages-like", reader_html)
+        self.assertNotIn("messages-like", author_html)
+        self.assertIn("Cache me", author_html)
+
+    def test_user_update_invalidates(self):
+        """Changing a user re-renders their cards; counters don't"""
+
+        self.get_as(self.reader_id, "/users")
+
+        User.adjust_counts(self.author_id, messages_count=1)
+        db.session.commit()
+        self.assertEqual(User.query.get(self.author_id).version, 0)
+
+        author = User.query.get(self.author_id)
+        author.username = "renamed"
+        db.session.commit()
+        self.assertEqual(author.version, 1)
+
+        html = self.get_as(self.reader_id, "/users")
+        self.assertIn("@renamed", html)
+        self.assertNotIn("@author", html)
+
+        html = self.get_as(self.reader_id, "/")
+        self.assertIn("@renamed", html)
+
+    def test_user_card_follow_buttons(self):
+        """Follow buttons are stitched into cached user cards"""
+
+        html = self.get_as(self.reader_id, f"/users/{self.reader_id}/following")
+
+        self.assertIn("@author", html)
+        self.assertIn(f'action="/users/stop-following/{self.author_id}"', html)
+        self.assertNotIn("<!-- viewer -->", html)
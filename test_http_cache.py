@@ -0,0 +1,204 @@
+"""HTTP caching tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_http_cache.py
+
+import os
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+import re
+from unittest import TestCase
+
+from flask import template_rendered
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Follows, Likes
+import http_cache
+import viewer_cache
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.drop_all()
+db.create_all()
+
+
+class StaticFilesTestCase(TestCase):
+    """Test content-hashed static URLs."""
+
+    def setUp(self):
+        self.client = app.test_client()
+
+    def test_hashed_url(self):
+        """Pages link to hashed names, which are cached for a year"""
+
+        html = self.client.get("/login").get_data(as_text=True)
+        url = re.search(r'/static/stylesheets/style\.[0-9a-f]{12}\.css',
+                        html).group(0)
+
+        resp = self.client.get(url)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("max-age=31536000", resp.headers['Cache-Control'])
+        self.assertIn("immutable", resp.headers['Cache-Control'])
+
+    def test_plain_and_stale_names(self):
+        """Plain and out of date names get the default max-age"""
+
+        for url in ("/static/stylesheets/style.css",
+                    "/static/stylesheets/style.000000000000.css"):
+            resp = self.client.get(url)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn("immutable", resp.headers['Cache-Control'])
+
+        resp = self.client.get("/static/stylesheets/missing.000000000000.css")
+        self.assertEqual(resp.status_code, 404)
+
+
+class ConditionalGetTestCase(TestCase):
+    """Test ETags and 304s on profile, message and home pages."""
+
+    def setUp(self):
+        """Two users; the author has posted a message."""
+
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        author = User.signup("author", "author@test.com", "password", None)
+        reader = User.signup("reader", "reader@test.com", "password", None)
+        db.session.commit()
+
+        message = Message(text="Hello", user_id=author.id)
+        db.session.add(message)
+        db.session.commit()
+
+        self.author_id = author.id
+        self.reader_id = reader.id
+        self.message_id = message.id
+
+        app.extensions['viewer_cache'] = viewer_cache.make_cache(app.config)
+        self.client = app.test_client()
+        self.rendered = []
+        template_rendered.connect(self.record_render, app)
+
+    def tearDown(self):
+        """Clean up fouled transactions and listeners."""
+
+        template_rendered.disconnect(self.record_render, app)
+        db.session.rollback()
+
+    def record_render(self, sender, template, context, **extra):
+        self.rendered.append(template.name)
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def revalidate(self, url, resp):
+        self.rendered.clear()
+        return self.client.get(
+            url, headers={'If-None-Match': resp.headers['ETag']})
+
+    def test_profile_not_modified(self):
+        """A profile whose stamps haven't changed gets a 304, unrendered"""
+
+        url = f"/users/{self.author_id}"
+        resp = self.client.get(url)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("public", resp.headers['Cache-Control'])
+
+        again = self.revalidate(url, resp)
+
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again.get_data(), b"")
+        self.assertEqual(self.rendered, [])
+
+    def test_profile_changes(self):
+        """New messages and profile edits change the ETag"""
+
+        url = f"/users/{self.author_id}"
+        resp = self.client.get(url)
+
+        db.session.add(Message(text="Again", user_id=self.author_id))
+        User.adjust_counts(self.author_id, messages_count=1)
+        db.session.commit()
+
+        resp2 = self.revalidate(url, resp)
+        self.assertEqual(resp2.status_code, 200)
+        self.assertIn("Again", resp2.get_data(as_text=True))
+
+        User.query.get(self.author_id).bio = "New bio"
+        db.session.commit()
+
+        self.assertEqual(self.revalidate(url, resp2).status_code, 200)
+
+    def test_viewer_changes(self):
+        """Pages for logged-in users are private and follow their state"""
+
+        self.login(self.reader_id)
+        url = f"/messages/{self.message_id}"
+        resp = self.client.get(url)
+
+        self.assertIn("private", resp.headers['Cache-Control'])
+        self.assertEqual(self.revalidate(url, resp).status_code, 304)
+
+        self.client.post(f"/users/follow/{self.author_id}")
+
+        resp2 = self.revalidate(url, resp)
+        self.assertEqual(resp2.status_code, 200)
+        self.assertIn("Unfollow", resp2.get_data(as_text=True))
+
+    def test_home_timeline(self):
+        """The home timeline validates against the messages it shows"""
+
+        self.login(self.reader_id)
+        self.client.post(f"/users/follow/{self.author_id}")
+
+        resp = self.client.get("/")
+        self.assertIn("private", resp.headers['Cache-Control'])
+        self.assertEqual(self.revalidate("/", resp).status_code, 304)
+
+        self.login(self.author_id)
+        self.client.post("/messages/new", data={"text": "Fresh"})
+        self.login(self.reader_id)
+
+        resp2 = self.revalidate("/", resp)
+        self.assertEqual(resp2.status_code, 200)
+        self.assertIn("Fresh", resp2.get_data(as_text=True))
+
+    def test_flashes_not_cached(self):
+        """A page showing a flashed message has no validator"""
+
+        with self.client.session_transaction() as sess:
+            sess['_flashes'] = [('success', 'Hi there')]
+
+        resp = self.client.get(f"/users/{self.author_id}")
+
+        self.assertIn("Hi there", resp.get_data(as_text=True))
+        self.assertEqual(resp.headers['Cache-Control'], 'no-store')
+        self.assertNotIn('ETag', resp.headers)
+
+    def test_default_policy(self):
+        """Other pages are revalidated on every use"""
+
+        resp = self.client.get("/users")
+
+        self.assertEqual(resp.headers['Cache-Control'], 'no-cache')
+
+    def test_etag_includes_templates(self):
+        """ETags change when the deployed templates do"""
+
+        with app.test_request_context():
+            before = http_cache.etag('same')
+            saved = app.extensions['http_cache']
+            app.extensions['http_cache'] = 'another deploy'
+            try:
+                self.assertNotEqual(http_cache.etag('same'), before)
+            finally:
+                app.extensions['http_cache'] = saved
@@ -0,0 +1,265 @@
+"""Image proxy tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_images.py
+
+import os
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+import functools
+import io
+import shutil
+import tempfile
+import threading
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+from unittest import TestCase, skipIf, skipUnless
+
+from app import app
+from models import db, User, Message, Follows, Likes
+import images
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.drop_all()
+db.create_all()
+
+STATIC_IMAGES = os.path.join(app.static_folder, 'images')
+
+
+class ImageProxyTestCase(TestCase):
+    """Test serving users' images resized from a local cache."""
+
+    def setUp(self):
+        """Users whose images are files in a scratch origin directory."""
+
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        self.origin = tempfile.mkdtemp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.config = {key: app.config[key] for key in
+                       ('IMAGE_CACHE_DIR', 'IMAGE_ORIGIN_SCHEMES')}
+
+        app.config['IMAGE_CACHE_DIR'] = self.cache_dir
+        app.config['IMAGE_ORIGIN_SCHEMES'] = {'file', 'http', 'https'}
+        images.init_app(app)
+
+        alice = User.signup("alice", "alice@test.com", "password",
+                            self.origin_url('default-pic.png'))
+        alice.header_image_url = self.origin_url('warbler-hero.jpg')
+        bob = User.signup("bob", "bob@test.com", "password",
+                          self.origin_url('default-pic.png'))
+        db.session.commit()
+
+        self.alice_id = alice.id
+        self.bob_id = bob.id
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        """Clean up fouled transactions, the scratch files and config."""
+
+        db.session.rollback()
+        app.config.update(self.config)
+        images.init_app(app)
+        shutil.rmtree(self.origin)
+        shutil.rmtree(self.cache_dir)
+
+    def origin_url(self, name, source=STATIC_IMAGES):
+        """Copy image `name` into the origin; returns its file:// URL."""
+
+        path = os.path.join(self.origin, name)
+        shutil.copy(os.path.join(source, name), path)
+        return 'file://' + path
+
+    def link(self, user_id, size):
+        with app.test_request_context():
+            return images.image_url(User.query.get(user_id), size)
+
+    def set_image(self, user_id, url):
+        User.query.get(user_id).image_url = url
+        db.session.commit()
+
+    def objects(self):
+        return os.listdir(os.path.join(self.cache_dir, 'objects'))
+
+    def test_card_links(self):
+        """User cards link resized images, not the originals"""
+
+        resp = self.client.get('/users')
+        html = resp.get_data(as_text=True)
+
+        self.assertIn(self.link(self.alice_id, 'avatar'), html)
+        self.assertIn(self.link(self.alice_id, 'header'), html)
+        self.assertNotIn('file://', html)
+
+    def test_fetched_once(self):
+        """An image is fetched once, then served from the cache"""
+
+        link = self.link(self.alice_id, 'avatar')
+        resp = self.client.get(link)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'image/png')
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+
+        os.remove(os.path.join(self.origin, 'default-pic.png'))
+        again = self.client.get(link)
+
+        self.assertEqual(again.status_code, 200)
+        self.assertEqual(again.data, resp.data)
+
+        etag = resp.headers['ETag']
+        revalidated = self.client.get(link, headers={'If-None-Match': etag})
+        self.assertEqual(revalidated.status_code, 304)
+
+    def test_shared(self):
+        """Users with the same image share one cached file"""
+
+        self.client.get(self.link(self.alice_id, 'avatar'))
+        self.client.get(self.link(self.bob_id, 'avatar'))
+
+        self.assertEqual(len(self.objects()), 1)
+
+    def test_changed_image(self):
+        """A new image gets a new link; the old one isn't kept long"""
+
+        old_link = self.link(self.alice_id, 'thumb')
+        self.set_image(self.alice_id, self.origin_url('warbler-logo.png'))
+
+        new_link = self.link(self.alice_id, 'thumb')
+        self.assertNotEqual(old_link, new_link)
+
+        resp = self.client.get(old_link)
+        self.assertEqual(resp.headers['Cache-Control'], 'public, no-cache')
+
+    def test_not_an_image(self):
+        """What isn't an image redirects to its URL and isn't cached"""
+
+        path = os.path.join(self.origin, 'notes.txt')
+        with open(path, 'w') as notes:
+            notes.write("not a picture")
+        self.set_image(self.bob_id, 'file://' + path)
+
+        resp = self.client.get(self.link(self.bob_id, 'avatar'))
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(resp.location, 'file://' + path)
+        self.assertEqual(self.objects(), [])
+
+    def test_unsupported_scheme(self):
+        """Only IMAGE_ORIGIN_SCHEMES URLs are fetched"""
+
+        app.config['IMAGE_ORIGIN_SCHEMES'] = {'http', 'https'}
+
+        resp = self.client.get(self.link(self.alice_id, 'avatar'))
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(self.objects(), [])
+
+    def test_private_host_refused(self):
+        """Images on loopback or private hosts aren't fetched"""
+
+        self.origin_url('default-pic.png')
+        requested = []
+
+        class Handler(SimpleHTTPRequestHandler):
+            def log_message(self, *args):
+                requested.append(self.path)
+
+        server = HTTPServer(('127.0.0.1', 0),
+                            functools.partial(Handler, directory=self.origin))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        try:
+            url = f'http://127.0.0.1:{server.server_port}/default-pic.png'
+            self.set_image(self.bob_id, url)
+            resp = self.client.get(self.link(self.bob_id, 'avatar'))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(requested, [])
+        self.assertEqual(self.objects(), [])
+
+        for url in ('http://10.0.0.1/a.png', 'http://169.254.169.254/',
+                    'http://[::1]/a.png', 'file:///etc/passwd'):
+            with self.assertRaises(images.ImageError):
+                images.check_public(url)
+
+    def test_private_redirect_refused(self):
+        """Redirects to private hosts aren't followed"""
+
+        handler = images._PublicRedirectHandler()
+
+        with self.assertRaises(images.ImageError):
+            handler.redirect_request(None, None, 302, 'Found', {},
+                                     'http://127.0.0.1/metrics')
+
+    def test_unknown_size(self):
+        """Only the listed sizes are served"""
+
+        resp = self.client.get(f'/img/huge/{self.alice_id}')
+        self.assertEqual(resp.status_code, 404)
+
+    @skipUnless(images.Image, "needs Pillow")
+    def test_resized(self):
+        """Images are cropped and scaled to their size"""
+
+        resp = self.client.get(self.link(self.alice_id, 'header'))
+
+        with images.Image.open(io.BytesIO(resp.data)) as image:
+            self.assertEqual(image.size, images.SIZES['header'][1:])
+
+    @skipIf(images.Image, "Pillow installed")
+    def test_unresized(self):
+        """Without Pillow, images are served as they are"""
+
+        resp = self.client.get(self.link(self.alice_id, 'header'))
+
+        with open(os.path.join(STATIC_IMAGES, 'warbler-hero.jpg'),
+                  'rb') as original:
+            self.assertEqual(resp.data, original.read())
+
+
+class ImageCacheTestCase(TestCase):
+    """Test the on-disk image cache's eviction."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = images.ImageCache(self.directory, max_bytes=250)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def age(self, path, seconds):
+        os.utime(path, (seconds, seconds))
+
+    def test_least_recently_used_evicted(self):
+        """Over max_bytes, the least recently used images go first"""
+
+        first = self.cache.put('first', b'1' * 100, '.png')
+        second = self.cache.put('second', b'2' * 100, '.png')
+        self.age(first, 1000)
+        self.age(second, 2000)
+
+        # using the first makes the second the least recently used
+        self.assertEqual(self.cache.get('first'), first)
+        self.cache.put('third', b'3' * 100, '.png')
+
+        self.assertEqual(self.cache.get('first'), first)
+        self.assertIsNone(self.cache.get('second'))
+        self.assertIsNotNone(self.cache.get('third'))
+
+    def test_oversized_kept(self):
+        """An image too big for the cache alone is still stored"""
+
+        path = self.cache.put('big', b'b' * 500, '.png')
+
+        self.assertEqual(self.cache.get('big'), path)
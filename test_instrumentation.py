@@ -0,0 +1,125 @@
+"""Request/SQL instrumentation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_instrumentation.py
+
+import os
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from unittest import TestCase
+
+from sqlalchemy import text
+
+from app import app
+from models import db, User, Message, Follows
+import instrumentation
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.drop_all()
+db.create_all()
+
+
+class InstrumentationTestCase(TestCase):
+    """Test per-route SQL counters, threshold logging and /metrics."""
+
+    def setUp(self):
+        """Start from an empty database and fresh counters."""
+
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        User.signup("testuser", "test@test.com", "testuser", None)
+        db.session.commit()
+        db.session.remove()
+
+        app.extensions['instrumentation'] = instrumentation.Metrics()
+        self.saved_config = {key: app.config[key] for key in
+                             ('SLOW_REQUEST_MS',
+                              'SLOW_REQUEST_QUERIES',
+                              'SQL_REPEATED_STATEMENT_LIMIT')}
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        """Clean up fouled transactions and restore config."""
+
+        db.session.rollback()
+        app.config.update(self.saved_config)
+
+    def test_statement_shape(self):
+        """Values and IN lists don't change a statement's shape"""
+
+        self.assertEqual(
+            instrumentation.statement_shape(
+                "SELECT * FROM users\n  WHERE id IN (?, ?, ?) LIMIT 10"),
+            instrumentation.statement_shape(
+                "SELECT * FROM users WHERE id IN (?) LIMIT 20"))
+        self.assertEqual(
+            instrumentation.statement_shape(
+                "SELECT * FROM users WHERE id = %(id_1)s"),
+            "SELECT * FROM users WHERE id = ?")
+
+    def test_route_counters(self):
+        """Requests add their statements and rows to their route"""
+
+        self.client.get("/users")
+        self.client.get("/users")
+
+        totals = app.extensions['instrumentation'].snapshot()['list_users']
+
+        self.assertEqual(totals.requests, 2)
+        self.assertGreaterEqual(totals.queries, 2)
+        self.assertEqual(totals.rows, 2)
+        self.assertTrue(totals.slowest)
+
+    def test_repeated_statements_logged(self):
+        """The same statement shape run too often looks like an N+1"""
+
+        app.config['SQL_REPEATED_STATEMENT_LIMIT'] = 2
+
+        with self.assertLogs(app.logger, 'WARNING') as logs:
+            with app.test_request_context('/users'):
+                app.preprocess_request()
+                for user_id in range(3):
+                    db.session.execute(
+                        text(f"SELECT * FROM users WHERE id = {user_id}"))
+
+        self.assertIn("Possible N+1 query", logs.output[0])
+        self.assertIn("SELECT * FROM users WHERE id = ?", logs.output[0])
+
+        totals = app.extensions['instrumentation'].snapshot()['list_users']
+        self.assertEqual(totals.repeated_statements, 1)
+
+    def test_slow_requests_logged(self):
+        """Requests over the statement limit get logged"""
+
+        app.config['SLOW_REQUEST_QUERIES'] = 0
+
+        with self.assertLogs(app.logger, 'WARNING') as logs:
+            self.client.get("/users")
+
+        self.assertIn("Slow request to list_users", logs.output[0])
+
+    def test_metrics(self):
+        """/metrics serves the counters in Prometheus text format"""
+
+        self.client.get("/users")
+        resp = self.client.get("/metrics")
+        body = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("# TYPE warbler_db_queries_total counter", body)
+        self.assertIn('warbler_requests_total{route="list_users"} 1', body)
+        self.assertIn("warbler_password_hash_pending 0", body)
+
+    def test_metrics_local_only(self):
+        """/metrics is hidden from other machines"""
+
+        resp = self.client.get("/metrics",
+                               environ_base={'REMOTE_ADDR': '10.0.0.1'})
+
+        self.assertEqual(resp.status_code, 404)
@@ -0,0 +1,115 @@
+"""Bulk loader tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_loader.py
+
+import os
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+import csv
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import inspect
+
+from app import app
+from models import db, User, Message, Follows, Likes
+import loader
+import migrations
+
+app.config['TESTING'] = True
+
+
+def write_csv(directory, name, header, rows):
+    """Write a CSV file with `header` and `rows` into `directory`."""
+
+    with open(os.path.join(directory, name), 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+class LoaderTestCase(TestCase):
+    """Test streaming CSVs into an empty database."""
+
+    def setUp(self):
+        """Migrate an empty database and write a small data set."""
+
+        db.session.remove()
+        migrations.reset(db.engine)
+        migrations.upgrade(db.engine)
+
+        self.data_dir = tempfile.TemporaryDirectory()
+        write_csv(self.data_dir.name, 'users.csv',
+                  ['email', 'username', 'password', 'bio'],
+                  [[f'user{i}@test.com', f'user{i}', 'HASHED', '']
+                   for i in range(5)])
+        write_csv(self.data_dir.name, 'messages.csv',
+                  ['id', 'text', 'timestamp', 'user_id'],
+                  [[i + 1, f'message {i}', '2020-01-01 10:00:00.123456',
+                    i % 5 + 1]
+                   for i in range(7)])
+        write_csv(self.data_dir.name, 'follows.csv',
+                  ['user_being_followed_id', 'user_following_id'],
+                  [[1, 2], [1, 3], [2, 1]])
+        write_csv(self.data_dir.name, 'likes.csv',
+                  ['user_id', 'message_id'],
+                  [[1, 2], [3, 4]])
+
+    def tearDown(self):
+        """Clean up fouled transactions and the data set."""
+
+        db.session.rollback()
+        self.data_dir.cleanup()
+
+    def test_load_all(self):
+        """Every CSV loads, in chunks, and indexes come back afterwards"""
+
+        loaded = []
+
+        loader.load_all(db.engine, self.data_dir.name, chunk_size=2,
+                        progress=lambda table, rows: loaded.append(
+                            (table, rows)))
+
+        self.assertEqual(User.query.count(), 5)
+        self.assertEqual(Message.query.count(), 7)
+        self.assertEqual(Follows.query.count(), 3)
+        self.assertEqual(Likes.query.count(), 2)
+
+        self.assertIn(('messages', 7), loaded)
+        self.assertIn(('messages', 2), loaded)
+        self.assertIsNone(User.query.get(1).bio)
+        self.assertFalse(User.query.get(1).is_pull_author)
+
+        index_names = {index['name'] for index in
+                       inspect(db.engine).get_indexes('messages')}
+        self.assertIn('ix_messages_user_id_id', index_names)
+        self.assertEqual(migrations.check_indexes(), [])
+
+    def test_ids_continue_after_load(self):
+        """New rows get ids after the loaded ones"""
+
+        loader.load_all(db.engine, self.data_dir.name)
+
+        user = User(email="new@test.com", username="new", password="HASHED")
+        db.session.add(user)
+        db.session.commit()
+
+        self.assertEqual(user.id, 6)
+
+    def test_message_ids_from_timestamps(self):
+        """Messages loaded without ids get ids in timestamp order"""
+
+        os.remove(os.path.join(self.data_dir.name, 'likes.csv'))
+        write_csv(self.data_dir.name, 'messages.csv',
+                  ['text', 'timestamp', 'user_id'],
+                  [['later', '2020-01-02 10:00:00', 1],
+                   ['earlier', '2020-01-01 10:00:00', 1],
+                   ['same time', '2020-01-01 10:00:00', 2]])
+
+        loader.load_all(db.engine, self.data_dir.name, chunk_size=2)
+
+        texts = [msg.text for msg in
+                 Message.query.order_by(Message.id.desc())]
+        self.assertEqual(texts, ['later', 'same time', 'earlier'])
@@ -7,7 +7,7 @@ from app import app
 from unittest import TestCase
 import sqlalchemy.exc
 
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, Likes
 
 
 db.drop_all()
@@ -20,6 +20,7 @@ class MessageModelTestCase(TestCase):
     def setUp(self):
         """Create test client, add sample data."""
 
+        Likes.query.delete()
         User.query.delete()
         Message.query.delete()
         Follows.query.delete()
@@ -82,4 +83,67 @@ class MessageModelTestCase(TestCase):
         with self.assertRaises(sqlalchemy.exc.IntegrityError):
             db.session.commit()
 
-        
\ No newline at end of file
+        
+
+    def test_like_add_remove(self):
+        """Likes are added and removed once, however often asked"""
+
+        self.assertTrue(Likes.add(self.u1_id, self.msg_id))
+        self.assertFalse(Likes.add(self.u1_id, self.msg_id))
+        db.session.commit()
+
+        self.assertEqual(Likes.query.count(), 1)
+
+        self.assertTrue(Likes.remove(self.u1_id, self.msg_id))
+        self.assertFalse(Likes.remove(self.u1_id, self.msg_id))
+        db.session.commit()
+
+        self.assertEqual(Likes.query.count(), 0)
+
+    def test_liked_ids(self):
+        """liked_ids picks the liked messages out of a page"""
+
+        other = Message(text="Not liked", user_id=self.u1_id)
+        db.session.add(other)
+        Likes.add(self.u1_id, self.msg_id)
+        db.session.commit()
+
+        messages = [Message.query.get(self.msg_id), other]
+
+        self.assertEqual(self.u1.liked_ids(messages), {self.msg_id})
+        self.assertEqual(self.u1.liked_ids([]), set())
+
+    def test_reconcile_counts(self):
+        """Message.reconcile_counts recomputes likes_count"""
+
+        Likes.add(self.u1_id, self.msg_id)
+        db.session.commit()
+
+        self.assertEqual(Message.query.get(self.msg_id).likes_count, 0)
+
+        Message.reconcile_counts()
+        db.session.commit()
+
+        self.assertEqual(Message.query.get(self.msg_id).likes_count, 1)
+
+    def test_ids_and_timestamps(self):
+        """New messages get later ids, and their own timestamps"""
+
+        first = Message(text="First", user_id=self.u1_id)
+        db.session.add(first)
+        db.session.commit()
+
+        second = Message(text="Second", user_id=self.u1_id)
+        db.session.add(second)
+        db.session.commit()
+
+        self.assertGreater(second.id, first.id)
+        self.assertGreater(second.timestamp, first.timestamp)
+
+    def test_search_vector_deferred(self):
+        """Loading a message doesn't load its search document"""
+
+        db.session.expunge_all()
+        msg = Message.query.get(self.msg_id)
+
+        self.assertIn('search_vector', sqlalchemy.inspect(msg).unloaded)
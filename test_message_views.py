@@ -8,8 +8,11 @@
 import os
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 from unittest import TestCase
-from models import db, connect_db, Message, User
+from sqlalchemy import event
+from models import (db, connect_db, Follows, Likes, Message, TimelineEntry,
+                    User)
 from app import app, CURR_USER_KEY
+import search
 
 db.create_all()
 
@@ -22,8 +25,13 @@ class MessageViewTestCase(TestCase):
     def setUp(self):
         """Create test client, add sample data."""
 
-        User.query.delete()
+        # children first, so no likes or follows leak from one test into
+        # the next whether or not the database cascades the deletes
+        TimelineEntry.query.delete()
+        Likes.query.delete()
         Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
 
         self.client = app.test_client()
 
@@ -67,6 +75,33 @@ class MessageViewTestCase(TestCase):
             msg = Message.query.one()
             self.assertEqual(msg.text, "Hello")
 
+    def test_add_message_loads_no_history(self):
+        """Posting doesn't load the author's earlier messages"""
+
+        for number in range(5):
+            db.session.add(Message(text=f"old {number}",
+                                   user_id=self.testuser.id))
+        db.session.commit()
+
+        loaded = []
+
+        def on_load(target, context):
+            loaded.append(target)
+
+        event.listen(Message, 'load', on_load)
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+
+                resp = c.post("/messages/new", data={"text": "Hello"})
+        finally:
+            event.remove(Message, 'load', on_load)
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(loaded, [])
+        self.assertEqual(Message.query.count(), 6)
+
     def test_invalid_add_message(self):
         """Can use add a message if you're not logged in?"""
 
@@ -137,4 +172,103 @@ class MessageViewTestCase(TestCase):
             # Make sure it redirects (follow redirect)
             self.assertEqual(resp.status_code, 200)
             self.assertEqual(resp_likes.status_code, 200)
-            self.assertIn('<p>this works</p>', str(resp_likes.data))
\ No newline at end of file
+            self.assertIn('<p>this works</p>', str(resp_likes.data))
+
+    def test_search_messages(self):
+        """Can search messages by text, best matches first, page by page?"""
+
+        app.config['MESSAGES_PER_PAGE'] = 1
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "warbling birds"})
+            c.post("/messages/new", data={"text": "birds birds birds"})
+            c.post("/messages/new", data={"text": "something else"})
+
+            try:
+                html = c.get("/messages/search?q=birds").get_data(as_text=True)
+                self.assertIn('<p>birds birds birds</p>', html)
+                self.assertNotIn('<p>warbling birds</p>', html)
+                self.assertNotIn('<p>something else</p>', html)
+
+                cursor = html.split('before=')[1].split('"')[0]
+                html = c.get(f"/messages/search?q=birds&before={cursor}"
+                             ).get_data(as_text=True)
+                self.assertIn('<p>warbling birds</p>', html)
+                self.assertNotIn('Load more', html)
+            finally:
+                app.config['MESSAGES_PER_PAGE'] = 100
+
+            msg = Message.query.filter_by(text="warbling birds").one()
+            c.post(f"/messages/{msg.id}/delete")
+
+            html = c.get("/messages/search?q=warbling").get_data(as_text=True)
+            self.assertIn('Sorry, no warbles found', html)
+
+    def test_search_equal_ranks(self):
+        """Paging through equally ranked results shows each one once"""
+
+        texts = ["birds one", "birds two", "birds six"]
+        for text in texts:
+            db.session.add(Message(text=text, user_id=self.testuser.id))
+        db.session.commit()
+
+        with app.app_context():
+            search.reindex_messages()
+
+        app.config['MESSAGES_PER_PAGE'] = 1
+        seen = []
+
+        try:
+            url = "/messages/search?q=birds"
+            # bounded, so a cursor that repeats a page can't loop forever
+            for _ in range(len(texts) + 1):
+                html = self.client.get(url).get_data(as_text=True)
+                seen.extend(text for text in texts
+                            if f'<p>{text}</p>' in html)
+                if 'Load more' not in html:
+                    break
+                cursor = html.split('before=')[1].split('"')[0]
+                url = f"/messages/search?q=birds&before={cursor}"
+        finally:
+            app.config['MESSAGES_PER_PAGE'] = 100
+
+        self.assertEqual(sorted(seen), sorted(texts))
+
+    def test_like_toggle_and_pages(self):
+        """Liking toggles, counts likes and pages the liked messages"""
+
+        for id, text in ((16, "first liked"), (17, "second liked")):
+            db.session.add(Message(id=id, text=text,
+                                   user_id=self.testuser2.id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post('/messages/16/like')
+            c.post('/messages/17/like')
+            c.post('/messages/17/like')
+            c.post('/messages/17/like')
+
+            self.assertEqual(Message.query.get(16).likes_count, 1)
+            self.assertEqual(Message.query.get(17).likes_count, 1)
+            self.assertEqual(User.query.get(100).likes_count, 2)
+
+            app.config['MESSAGES_PER_PAGE'] = 1
+            try:
+                html = c.get('/users/100/likes').get_data(as_text=True)
+                self.assertIn('<p>second liked</p>', html)
+                self.assertNotIn('<p>first liked</p>', html)
+                self.assertIn('btn-primary', html)
+
+                cursor = html.split('before=')[1].split('"')[0]
+                html = c.get(f'/users/100/likes?before={cursor}'
+                             ).get_data(as_text=True)
+                self.assertIn('<p>first liked</p>', html)
+                self.assertNotIn('Load more', html)
+            finally:
+                app.config['MESSAGES_PER_PAGE'] = 100
@@ -0,0 +1,117 @@
+"""Schema migration tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_migrations.py
+
+import os
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from unittest import TestCase
+
+from sqlalchemy import inspect, text
+import sqlalchemy.exc
+
+from app import app
+from models import db, User, Message, Likes, TimelineEntry
+import migrations
+
+app.config['TESTING'] = True
+
+
+class MigrationsTestCase(TestCase):
+    """Test upgrading the schema and the index checks."""
+
+    def setUp(self):
+        """Start every test from an empty, fully-migrated database."""
+
+        db.session.remove()
+        migrations.reset(db.engine)
+        self.applied = migrations.upgrade(db.engine)
+
+    def tearDown(self):
+        """Clean up fouled transactions."""
+
+        db.session.rollback()
+
+    def test_upgrade(self):
+        """Every migration runs once, in order"""
+
+        self.assertEqual(self.applied,
+                         [version for version, _ in migrations.MIGRATIONS])
+        self.assertEqual(migrations.upgrade(db.engine), [])
+
+        tables = inspect(db.engine).get_table_names()
+        self.assertIn('timeline_entries', tables)
+        self.assertIn('schema_migrations', tables)
+
+    def test_message_index_swapped(self):
+        """Migration 3's messages index is replaced by migration 7's"""
+
+        names = {index['name']
+                 for index in inspect(db.engine).get_indexes('messages')}
+
+        self.assertIn('ix_messages_user_id_id', names)
+        self.assertNotIn('ix_messages_user_id_timestamp_id', names)
+        self.assertNotIn('ix_messages_user_id_timestamp_id',
+                         {index.name for index in Message.__table__.indexes})
+
+    def test_timeline_timestamp_dropped(self):
+        """Migration 7 drops timeline entries' timestamps, keeping the rows"""
+
+        user = User(username="reader", email="reader@test.com",
+                    password="HASHED_PASSWORD")
+        db.session.add(user)
+        db.session.flush()
+        msg = Message(text="kept", user_id=user.id)
+        db.session.add(msg)
+        db.session.commit()
+
+        # timeline_entries as migration 6 left it
+        with db.engine.begin() as connection:
+            connection.execute('DROP TABLE timeline_entries')
+            connection.execute("""
+                CREATE TABLE timeline_entries (
+                    user_id INTEGER NOT NULL
+                        REFERENCES users (id) ON DELETE CASCADE,
+                    message_id BIGINT NOT NULL
+                        REFERENCES messages (id) ON DELETE CASCADE,
+                    timestamp TIMESTAMP NOT NULL,
+                    PRIMARY KEY (user_id, message_id))""")
+            connection.execute(
+                'CREATE INDEX ix_timeline_entries_user_id_timestamp '
+                'ON timeline_entries (user_id, timestamp)')
+            connection.execute(
+                text('INSERT INTO timeline_entries '
+                     'VALUES (:user_id, :message_id, :timestamp)'),
+                user_id=user.id, message_id=msg.id, timestamp=msg.timestamp)
+
+            migrations.add_sortable_message_ids(connection)
+
+        columns = {column['name'] for column in
+                   inspect(db.engine).get_columns('timeline_entries')}
+        self.assertEqual(columns, {'user_id', 'message_id'})
+        self.assertEqual(TimelineEntry.query.one().message_id, msg.id)
+
+    def test_hot_paths_use_indexes(self):
+        """EXPLAIN shows each hot query path using its index"""
+
+        self.assertEqual(migrations.check_indexes(), [])
+
+    def test_likes_are_unique(self):
+        """The same like can't be stored twice"""
+
+        user = User(username="liker", email="liker@test.com",
+                    password="HASHED_PASSWORD")
+        db.session.add(user)
+        db.session.flush()
+
+        msg = Message(text="liked", user_id=user.id)
+        db.session.add(msg)
+        db.session.flush()
+
+        db.session.add(Likes(user_id=user.id, message_id=msg.id))
+        db.session.add(Likes(user_id=user.id, message_id=msg.id))
+
+        with self.assertRaises(sqlalchemy.exc.IntegrityError):
+            db.session.commit()
@@ -0,0 +1,115 @@
+"""Password hashing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_passwords.py
+
+import os
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+import time
+from unittest import TestCase
+
+from app import app
+from models import db, User, Message, Follows
+import passwords
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.drop_all()
+db.create_all()
+
+
+class PasswordsTestCase(TestCase):
+    """Test the hashing pool, its backpressure and rehash on login."""
+
+    def setUp(self):
+        """Use a cheap work factor and start from an empty database."""
+
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        self.saved_config = {key: app.config[key] for key in
+                             ('BCRYPT_LOG_ROUNDS',
+                              'PASSWORD_HASH_WORKERS',
+                              'PASSWORD_HASH_MAX_PENDING',
+                              'PASSWORD_HASH_TIMEOUT')}
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        """Clean up fouled transactions and restore config."""
+
+        db.session.rollback()
+        app.config.update(self.saved_config)
+
+    def test_hash_in_pool(self):
+        """Hashes made in worker processes check out"""
+
+        app.config['PASSWORD_HASH_WORKERS'] = 1
+
+        pw_hash = passwords.hash_password("password")
+
+        self.assertTrue(pw_hash.startswith("$2b$04$"))
+        self.assertTrue(passwords.check_password(pw_hash, "password"))
+        self.assertFalse(passwords.check_password(pw_hash, "wrong"))
+        self.assertFalse(passwords.check_password("not a hash", "password"))
+
+    def test_saturated_pool_sheds_load(self):
+        """A full queue answers logins with a fast 503"""
+
+        User.signup("busy", "busy@test.com", "password", None)
+        db.session.commit()
+
+        app.config['PASSWORD_HASH_MAX_PENDING'] = 0
+        rejected = passwords.pool.stats()['rejected']
+
+        resp = self.client.post('/login', data={"username": "busy",
+                                                "password": "password"})
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers['Retry-After'], '1')
+        self.assertEqual(passwords.pool.stats()['rejected'], rejected + 1)
+
+    def test_timed_out_hash_keeps_its_place(self):
+        """A hash we stop waiting for still counts as pending until done"""
+
+        app.config['PASSWORD_HASH_WORKERS'] = 1
+        app.config['PASSWORD_HASH_TIMEOUT'] = 0.001
+        before = passwords.pool.stats()
+
+        with self.assertRaises(passwords.HashingBusy):
+            passwords.pool.run(passwords._hash, b"password", 12)
+
+        stats = passwords.pool.stats()
+        self.assertEqual(stats['pending'], before['pending'] + 1)
+        self.assertEqual(stats['timed_out'], before['timed_out'] + 1)
+        self.assertEqual(stats['completed'], before['completed'])
+
+        deadline = time.monotonic() + 30
+        while (passwords.pool.stats()['pending'] > before['pending']
+               and time.monotonic() < deadline):
+            time.sleep(0.05)
+
+        stats = passwords.pool.stats()
+        self.assertEqual(stats['pending'], before['pending'])
+        self.assertEqual(stats['completed'], before['completed'])
+
+    def test_rehash_on_login(self):
+        """Logging in upgrades a hash made with an old work factor"""
+
+        User.signup("oldhash", "old@test.com", "password", None)
+        db.session.commit()
+
+        app.config['BCRYPT_LOG_ROUNDS'] = 5
+        self.client.post('/login', data={"username": "oldhash",
+                                         "password": "password"})
+
+        db.session.expire_all()
+        user = User.query.filter_by(username="oldhash").one()
+        self.assertTrue(user.password.startswith("$2b$05$"))
+        self.assertTrue(User.authenticate("oldhash", "password"))
@@ -0,0 +1,222 @@
+"""Account deletion tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_purge.py
+
+import os
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from unittest import TestCase
+
+from app import app, CURR_USER_KEY
+from models import (db, AccountPurge, Follows, Likes, Message, TimelineEntry,
+                    User)
+import author_cache
+import purge
+import timeline
+import viewer_cache
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.drop_all()
+db.create_all()
+
+
+class PurgeTestCase(TestCase):
+    """Test deactivating accounts and purging them in batches."""
+
+    def setUp(self):
+        """An author with five messages who follows, and is followed by,
+        a reader who likes one of them.
+        """
+
+        AccountPurge.query.delete()
+        TimelineEntry.query.delete()
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        author = User.signup("author", "author@test.com", "password", None)
+        reader = User.signup("reader", "reader@test.com", "password", None)
+        db.session.commit()
+
+        for number in range(5):
+            db.session.add(Message(text=f"message {number}",
+                                   user_id=author.id))
+        Follows.add(author.id, reader.id)
+        Follows.add(reader.id, author.id)
+        User.adjust_counts(author.id, following_count=1, followers_count=1)
+        User.adjust_counts(reader.id, following_count=1, followers_count=1)
+        db.session.commit()
+
+        Likes.add(reader.id, Message.query.first().id)
+        db.session.commit()
+
+        self.author_id = author.id
+        self.reader_id = reader.id
+
+        with app.app_context():
+            timeline.rebuild()
+
+        app.extensions['viewer_cache'] = viewer_cache.make_cache(app.config)
+        app.extensions['author_cache'] = author_cache.make_cache(app.config)
+        app.extensions.pop('message_index', None)
+        self.client = app.test_client()
+
+    def tearDown(self):
+        """Clean up fouled transactions and restore config."""
+
+        db.session.rollback()
+        app.config['TIMELINE_ENGINE'] = timeline.DEFAULT_ENGINE
+
+    def delete_author(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.author_id
+
+        return self.client.post('/users/delete')
+
+    def test_deactivate(self):
+        """Deleting an account hides it at once and queues its purge"""
+
+        resp = self.delete_author()
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertTrue(User.query.get(self.author_id).deactivated)
+        self.assertEqual(Message.query.count(), 5)
+        self.assertEqual(AccountPurge.query.get(self.author_id).stage,
+                         purge.STAGES[0])
+
+        reader = User.query.get(self.reader_id)
+        self.assertEqual((reader.following_count, reader.followers_count),
+                         (0, 0))
+
+        self.assertEqual(
+            self.client.get(f"/users/{self.author_id}").status_code, 404)
+        self.assertFalse(User.authenticate("author", "password"))
+
+        html = self.client.get("/users").get_data(as_text=True)
+        self.assertNotIn("@author", html)
+
+    def test_messages_hidden(self):
+        """A deleted account's messages disappear before it's purged"""
+
+        pages = ["/", f"/users/{self.reader_id}/likes",
+                 "/messages/search?q=message"]
+
+        for engine in ('push', 'pull'):
+            app.config['TIMELINE_ENGINE'] = engine
+
+            with self.client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.reader_id
+
+            for url in pages:
+                html = self.client.get(url).get_data(as_text=True)
+                self.assertIn("message 0", html, url)
+
+        self.delete_author()
+        self.assertEqual(Message.query.count(), 5)
+
+        for engine in ('push', 'pull'):
+            app.config['TIMELINE_ENGINE'] = engine
+
+            with self.client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.reader_id
+
+            for url in pages:
+                html = self.client.get(url).get_data(as_text=True)
+                for number in range(5):
+                    self.assertNotIn(f"message {number}", html, url)
+
+    def test_search_pages_full(self):
+        """A deleted account's hits don't crowd others off a search page"""
+
+        db.session.add(Message(text="a message from the reader",
+                               user_id=self.reader_id))
+        db.session.commit()
+        app.extensions.pop('message_index', None)
+
+        self.delete_author()
+        app.config['MESSAGES_PER_PAGE'] = 2
+
+        try:
+            html = self.client.get("/messages/search?q=message"
+                                   ).get_data(as_text=True)
+        finally:
+            app.config['MESSAGES_PER_PAGE'] = 100
+
+        self.assertIn("a message from the reader", html)
+
+    def test_no_changes_after_delete(self):
+        """A deleted account can't be unfollowed, nor its messages liked"""
+
+        liked_id = Likes.query.one().message_id
+        self.delete_author()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.reader_id
+
+        reader = User.query.get(self.reader_id)
+        counts = (reader.following_count, reader.likes_count)
+
+        for method, url in (
+                ('post', f"/users/stop-following/{self.author_id}"),
+                ('post', f"/messages/{liked_id}/like"),
+                ('delete', f"/api/v1/messages/{liked_id}/like"),
+                ('post', f"/api/v1/messages/{liked_id}/like")):
+            resp = getattr(self.client, method)(url)
+            self.assertEqual(resp.status_code, 404, url)
+
+        db.session.expire_all()
+        reader = User.query.get(self.reader_id)
+        self.assertEqual((reader.following_count, reader.likes_count), counts)
+        self.assertEqual(Likes.query.count(), 1)
+
+    def test_purge_in_batches(self):
+        """A purge removes the account's rows a batch at a time"""
+
+        self.delete_author()
+        batches = []
+
+        purged = purge.purge(batch_size=2,
+                             progress=lambda job: batches.append(job.stage))
+
+        self.assertEqual(purged, 1)
+        self.assertIsNone(User.query.get(self.author_id))
+        self.assertEqual(Message.query.filter_by(user_id=self.author_id)
+                         .count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+
+        # 2 follows, then 5 messages two at a time, then the user
+        job = AccountPurge.query.get(self.author_id)
+        self.assertEqual(job.stage, purge.DONE)
+        self.assertEqual(job.rows_deleted, 8)
+        self.assertIsNotNone(job.finished_at)
+        self.assertGreater(batches.count('messages'), 1)
+
+        self.assertEqual(purge.purge(), 0)
+
+    def test_resume(self):
+        """An interrupted purge carries on from where it stopped"""
+
+        self.delete_author()
+
+        def crash(job):
+            if job.stage == 'messages' and job.rows_deleted > 2:
+                raise RuntimeError("worker died")
+
+        with self.assertRaises(RuntimeError):
+            purge.purge(batch_size=1, progress=crash)
+
+        db.session.rollback()
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertGreater(Message.query.count(), 0)
+
+        self.assertEqual(purge.purge(batch_size=1), 1)
+
+        job = AccountPurge.query.get(self.author_id)
+        self.assertEqual((job.stage, job.rows_deleted), (purge.DONE, 8))
+        self.assertIsNone(User.query.get(self.author_id))
@@ -0,0 +1,110 @@
+"""Time-ordered id tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_snowflake.py
+
+import importlib.util
+import os
+from datetime import datetime
+from types import SimpleNamespace
+from unittest import TestCase
+from unittest.mock import patch
+
+import snowflake
+
+
+class SnowflakeTestCase(TestCase):
+    """Test making ids that sort by time without coordination."""
+
+    def setUp(self):
+        """A fresh generator, as a newly forked worker gets."""
+
+        self.generator = snowflake._Generator()
+
+    def ids_at(self, ms, count):
+        with patch('snowflake._now_ms', return_value=ms):
+            return [self.generator.next_id() for _ in range(count)]
+
+    def test_layout(self):
+        """An id holds its time, then the worker id, then a sequence"""
+
+        id, = self.ids_at(1000, 1)
+
+        self.assertEqual(id >> snowflake.TIME_SHIFT, 1000)
+        self.assertEqual((id >> snowflake.SEQUENCE_BITS)
+                         & snowflake.MAX_WORKER_ID,
+                         self.generator.worker_id)
+
+    def test_increasing(self):
+        """Ids only ever grow, within and across milliseconds"""
+
+        ids = self.ids_at(1000, 50) + self.ids_at(1001, 50)
+
+        self.assertEqual(ids, sorted(set(ids)))
+
+    def test_sequence_exhausted(self):
+        """Out of sequence numbers, ids move on to the next millisecond"""
+
+        ids = self.ids_at(1000, snowflake.SEQUENCE_MASK + 2)
+
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertEqual(ids[-1] >> snowflake.TIME_SHIFT, 1001)
+
+    def test_clock_goes_back(self):
+        """A clock stepping backwards doesn't make ids go backwards"""
+
+        before = self.ids_at(5000, 3)
+        after = self.ids_at(4000, 3)
+
+        self.assertEqual(before + after, sorted(set(before + after)))
+
+    def test_pinned_worker_id(self):
+        """SNOWFLAKE_WORKER_ID sets the worker id"""
+
+        with patch.dict('os.environ', {'SNOWFLAKE_WORKER_ID': '7'}):
+            self.assertEqual(snowflake._Generator().worker_id, 7)
+
+    def test_worker_id_out_of_range(self):
+        """A SNOWFLAKE_WORKER_ID that doesn't fit isn't silently wrapped"""
+
+        with patch.dict('os.environ', {'SNOWFLAKE_WORKER_ID': '1024'}):
+            with self.assertRaises(ValueError):
+                snowflake._Generator()
+
+    def test_gunicorn_worker_ids(self):
+        """Each gunicorn worker gets its own worker id, reused on restart"""
+
+        path = os.path.join(os.path.dirname(snowflake.__file__),
+                            'gunicorn.conf.py')
+        spec = importlib.util.spec_from_file_location('gunicorn_conf', path)
+        conf = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(conf)
+
+        server = SimpleNamespace(WORKERS={})
+        for pid in range(3):
+            worker = SimpleNamespace()
+            conf.pre_fork(server, worker)
+            server.WORKERS[pid] = worker
+
+        # worker 1 died; its replacement takes its slot
+        del server.WORKERS[1]
+        replacement = SimpleNamespace()
+        conf.pre_fork(server, replacement)
+
+        with patch.dict('os.environ'):
+            conf.post_fork(server, replacement)
+            self.assertEqual(os.environ['SNOWFLAKE_WORKER_ID'], '1')
+
+        self.assertEqual(sorted(worker.slot
+                                for worker in server.WORKERS.values()),
+                         [0, 2])
+
+    def test_make_id(self):
+        """Ids made for bulk loads sort by timestamp"""
+
+        early = snowflake.make_id(datetime(2020, 1, 1), 2)
+        late = snowflake.make_id(datetime(2020, 1, 1, 0, 0, 0, 1000), 1)
+
+        self.assertLess(early, late)
+        self.assertLess(late, 1 << 63)
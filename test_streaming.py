@@ -0,0 +1,180 @@
+"""Streamed page and response compression tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_streaming.py
+
+import os
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+import gzip
+from unittest import TestCase, skipUnless
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Follows, Likes, TimelineEntry
+import compression
+import streaming
+import timeline
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.drop_all()
+db.create_all()
+
+
+class StreamingTestCase(TestCase):
+    """Test streamed timelines, profiles and follow lists."""
+
+    def setUp(self):
+        """A reader following an author with a page of messages."""
+
+        TimelineEntry.query.delete()
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        author = User.signup("author", "author@test.com", "password", None)
+        reader = User.signup("reader", "reader@test.com", "password", None)
+        db.session.commit()
+
+        Follows.add(reader.id, author.id)
+        for number in range(30):
+            db.session.add(Message(text=f"message {number}",
+                                   user_id=author.id))
+        db.session.commit()
+
+        self.author_id = author.id
+        self.reader_id = reader.id
+
+        with app.app_context():
+            timeline.rebuild()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.reader_id
+
+    def tearDown(self):
+        """Clean up fouled transactions and restore config."""
+
+        db.session.rollback()
+        app.config['STREAM_PAGES'] = False
+
+    def get(self, url, stream):
+        app.config['STREAM_PAGES'] = stream
+        return self.client.get(url)
+
+    def test_same_pages(self):
+        """Streamed pages are the same as rendered ones"""
+
+        for url in ("/", f"/users/{self.author_id}",
+                    f"/users/{self.author_id}/followers",
+                    f"/users/{self.reader_id}/following"):
+            rendered = self.get(url, False)
+            streamed = self.get(url, True)
+
+            # a streamed body's length isn't known when headers go out
+            self.assertIn('Content-Length', rendered.headers)
+            self.assertNotIn('Content-Length', streamed.headers)
+            self.assertEqual(streamed.get_data(as_text=True),
+                             rendered.get_data(as_text=True))
+
+        self.assertIn("message 29",
+                      self.get("/", True).get_data(as_text=True))
+
+    def test_compressed(self):
+        """Streamed pages are compressed chunk by chunk, and validate"""
+
+        rendered = self.get("/", False)
+
+        app.config['STREAM_PAGES'] = True
+        resp = self.client.get("/", headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(resp.get_data()),
+                         rendered.get_data())
+
+        tag, weak = resp.get_etag()
+        self.assertTrue(weak)
+
+        resp = self.client.get("/", headers={'Accept-Encoding': 'gzip',
+                                             'If-None-Match': f'W/"{tag}"'})
+        self.assertEqual(resp.status_code, 304)
+
+    def test_chunks(self):
+        """The head goes out first, then the rest in bigger chunks"""
+
+        pieces = ['x' * 100] * 50
+        chunks = list(streaming._chunks(iter(pieces), 250, 1000))
+
+        self.assertEqual(len(chunks[0]), 300)
+        self.assertEqual([len(chunk) for chunk in chunks[1:-1]],
+                         [1000] * 4)
+        self.assertEqual(''.join(chunks), ''.join(pieces))
+
+    def test_flashes_shown_once(self):
+        """A flash on a streamed page is cleared before headers go out"""
+
+        with self.client.session_transaction() as sess:
+            sess['_flashes'] = [('success', 'Shown once')]
+
+        self.assertIn("Shown once",
+                      self.get(f"/users/{self.author_id}/followers", True)
+                      .get_data(as_text=True))
+        self.assertNotIn("Shown once",
+                         self.get(f"/users/{self.author_id}/followers", True)
+                         .get_data(as_text=True))
+
+
+class CompressionTestCase(TestCase):
+    """Test compressing responses."""
+
+    def setUp(self):
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.config['COMPRESS_MIN_SIZE'] = 1024
+
+    def test_gzip(self):
+        """Large enough pages are gzipped for clients that accept it"""
+
+        plain = self.client.get("/signup")
+        resp = self.client.get("/signup",
+                               headers={'Accept-Encoding': 'gzip'})
+
+        self.assertIsNone(plain.headers.get('Content-Encoding'))
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertEqual(gzip.decompress(resp.get_data()), plain.get_data())
+        self.assertLess(len(resp.get_data()), len(plain.get_data()))
+
+    def test_min_size(self):
+        """Small responses are sent as they are"""
+
+        app.config['COMPRESS_MIN_SIZE'] = 10 ** 6
+        resp = self.client.get("/signup",
+                               headers={'Accept-Encoding': 'gzip'})
+
+        self.assertIsNone(resp.headers.get('Content-Encoding'))
+
+    def test_not_images(self):
+        """Already compressed files are left alone"""
+
+        resp = self.client.get("/static/images/warbler-logo.png",
+                               headers={'Accept-Encoding': 'gzip'})
+
+        self.assertIsNone(resp.headers.get('Content-Encoding'))
+
+    @skipUnless(compression.brotli, "brotli is not installed")
+    def test_brotli(self):
+        """Brotli is preferred where the client accepts it"""
+
+        plain = self.client.get("/signup")
+        resp = self.client.get("/signup",
+                               headers={'Accept-Encoding': 'gzip, br'})
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'br')
+        self.assertEqual(compression.brotli.decompress(resp.get_data()),
+                         plain.get_data())
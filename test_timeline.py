@@ -0,0 +1,169 @@
+"""Home timeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timeline.py
+
+import os
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Follows, TimelineEntry
+import timeline
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.drop_all()
+db.create_all()
+
+
+class TimelineTestCase(TestCase):
+    """Test fan-out, pull authors and rebuilding of home timelines."""
+
+    def setUp(self):
+        """Create three users: u2 and u3 both follow u1."""
+
+        TimelineEntry.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        self.u1 = User.signup("author", "author@test.com", "password", None)
+        self.u2 = User.signup("reader", "reader@test.com", "password", None)
+        self.u3 = User.signup("other", "other@test.com", "password", None)
+        db.session.commit()
+
+        self.u2.following.append(self.u1)
+        self.u3.following.append(self.u1)
+        User.reconcile_counts()
+        db.session.commit()
+
+        self.client = app.test_client()
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+    def tearDown(self):
+        """Clean up fouled transactions and restore config."""
+
+        db.session.rollback()
+        app.config['TIMELINE_FANOUT_LIMIT'] = timeline.DEFAULT_FANOUT_LIMIT
+        app.config['TIMELINE_MAX_LENGTH'] = timeline.DEFAULT_MAX_LENGTH
+        self.ctx.pop()
+
+    def post(self, user, text, timestamp=None):
+        """Add a message as `user` the way messages_add does."""
+
+        msg = Message(text=text, user_id=user.id,
+                      timestamp=timestamp or datetime.utcnow())
+        db.session.add(msg)
+        db.session.flush()
+        timeline.fan_out(msg)
+        db.session.commit()
+        return msg
+
+    def test_fan_out(self):
+        """Posting pushes the message to the author and every follower."""
+
+        msg = self.post(self.u1, "hello")
+
+        owners = {entry.user_id for entry in
+                  TimelineEntry.query.filter_by(message_id=msg.id)}
+        self.assertEqual(owners, {self.u1.id, self.u2.id, self.u3.id})
+        self.assertEqual(timeline.home_timeline(self.u2.id), [msg])
+
+    def test_pull_author(self):
+        """Authors over the fan-out limit are merged in at read time."""
+
+        app.config['TIMELINE_FANOUT_LIMIT'] = 1
+        msg = self.post(self.u1, "hello")
+
+        self.assertTrue(User.query.get(self.u1.id).is_pull_author)
+        self.assertEqual(
+            TimelineEntry.query.filter_by(user_id=self.u2.id).count(), 0)
+        self.assertEqual(timeline.home_timeline(self.u2.id), [msg])
+
+    def test_order_and_trim(self):
+        """Timelines are newest-first and bounded by TIMELINE_MAX_LENGTH."""
+
+        app.config['TIMELINE_MAX_LENGTH'] = 2
+        now = datetime.utcnow()
+        msgs = [self.post(self.u1, f"msg {i}", now + timedelta(minutes=i))
+                for i in range(4)]
+
+        # reading doesn't write; the periodic trim bounds timelines
+        self.assertEqual(timeline.home_timeline(self.u2.id, limit=10),
+                         msgs[::-1])
+
+        self.assertEqual(timeline.trim_all(batch_size=1), 6)
+        self.assertEqual(timeline.home_timeline(self.u2.id, limit=10),
+                         [msgs[3], msgs[2]])
+        self.assertEqual(
+            TimelineEntry.query.filter_by(user_id=self.u2.id).count(), 2)
+
+    def test_follow_and_unfollow(self):
+        """Following backfills an author's messages; unfollowing drops them."""
+
+        msg = self.post(self.u2, "from reader")
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u3.id
+
+            c.post(f"/users/follow/{self.u2.id}")
+            self.assertEqual(timeline.home_timeline(self.u3.id), [msg])
+
+            c.post(f"/users/stop-following/{self.u2.id}")
+            self.assertEqual(timeline.home_timeline(self.u3.id), [])
+
+    def test_home_pagination(self):
+        """Older homepage messages are reached through the 'before' cursor."""
+
+        app.config['MESSAGES_PER_PAGE'] = 1
+        now = datetime.utcnow()
+        self.post(self.u1, "older", now)
+        newer = self.post(self.u1, "newer", now + timedelta(minutes=1))
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u2.id
+
+                html = c.get("/").get_data(as_text=True)
+                self.assertIn("<p>newer</p>", html)
+                self.assertNotIn("<p>older</p>", html)
+
+                html = c.get(f"/?before={newer.id}").get_data(as_text=True)
+                self.assertIn("<p>older</p>", html)
+                self.assertNotIn("Load more", html)
+        finally:
+            app.config['MESSAGES_PER_PAGE'] = 100
+
+    def test_rebuild(self):
+        """Rebuilding recreates timelines from messages and follows."""
+
+        msg = Message(text="seeded", user_id=self.u1.id)
+        db.session.add(msg)
+        db.session.commit()
+
+        timeline.rebuild(batch_size=2)
+
+        self.assertEqual(timeline.home_timeline(self.u1.id), [msg])
+        self.assertEqual(timeline.home_timeline(self.u3.id), [msg])
+
+    def test_homepage(self):
+        """The homepage renders messages from the precomputed timeline."""
+
+        self.post(self.u1, "on the homepage")
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2.id
+
+            resp = c.get("/")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("<p>on the homepage</p>", resp.get_data(as_text=True))
@@ -112,6 +112,36 @@ class UserModelTestCase(TestCase):
         self.assertEqual(self.u2.is_followed_by(self.u1), True)
         self.assertEqual(self.u1.is_followed_by(self.u2), False)
 
+    def test_follows_add_remove(self):
+        """Following is added and removed once, however often asked"""
+
+        self.assertTrue(Follows.add(self.u1.id, self.u2.id))
+        self.assertFalse(Follows.add(self.u1.id, self.u2.id))
+        db.session.commit()
+
+        self.assertTrue(self.u1.is_following(self.u2))
+        self.assertTrue(self.u2.is_followed_by(self.u1))
+        self.assertEqual(Follows.query.count(), 1)
+
+        self.assertTrue(Follows.remove(self.u1.id, self.u2.id))
+        self.assertFalse(Follows.remove(self.u1.id, self.u2.id))
+        db.session.commit()
+
+        self.assertFalse(self.u1.is_following(self.u2))
+
+    def test_relationship_ids(self):
+        """following_ids and follower_ids answer for a page of users"""
+
+        Follows.add(self.u1.id, self.u2.id)
+        db.session.commit()
+
+        users = [self.u1, self.u2]
+
+        self.assertEqual(self.u1.following_ids(users), {self.u2.id})
+        self.assertEqual(self.u1.follower_ids([u.id for u in users]), set())
+        self.assertEqual(self.u2.follower_ids([u.id for u in users]),
+                         {self.u1.id})
+
     def test_user_signup(self):
         """ Does User.signup work successfully? """
 
@@ -7,6 +7,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 from app import app, CURR_USER_KEY
 from unittest import TestCase
 import sqlalchemy.exc
+from sqlalchemy import event
 
 
 from models import db, User, Message, Follows
@@ -167,6 +168,39 @@ class UserViewTests(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('<p>@testuser</p>', html)
 
+    def test_follow_pages_paginate(self):
+        """Followers and following pages are paged, newest accounts first"""
+
+        user3 = User.signup("testuser3", "test@test3.com", "HASHED_PASSWORD3",
+                            "image3")
+        db.session.commit()
+
+        for follower in (self.user2, user3):
+            Follows.add(follower.id, self.user.id)
+            Follows.add(self.user.id, follower.id)
+        db.session.commit()
+
+        app.config['USERS_PER_PAGE'] = 1
+
+        try:
+            with self.client as client:
+                with client.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user.id
+
+                for page in ('followers', 'following'):
+                    url = f'/users/{self.user.id}/{page}'
+                    html = client.get(url).get_data(as_text=True)
+                    self.assertIn('<p>@testuser3</p>', html)
+                    self.assertNotIn('<p>@testuser2</p>', html)
+
+                    cursor = html.split('before=')[1].split('"')[0]
+                    html = client.get(f'{url}?before={cursor}'
+                                      ).get_data(as_text=True)
+                    self.assertIn('<p>@testuser2</p>', html)
+                    self.assertNotIn('Load more', html)
+        finally:
+            app.config['USERS_PER_PAGE'] = 60
+
     def test_following_page_signed_out(self):
         """Test the following page"""
 
@@ -187,4 +221,146 @@ class UserViewTests(TestCase):
         self.assertEqual(resp.status_code, 200)
         self.assertIn('<div class="alert alert-danger">Access unauthorized.</div>', html)
 
-    
\ No newline at end of file
+    def test_users_pagination(self):
+        """/users is paged newest-first with a 'before' cursor"""
+
+        app.config['USERS_PER_PAGE'] = 1
+
+        try:
+            with self.client as client:
+                resp = client.get('/users')
+                html = resp.get_data(as_text=True)
+
+                self.assertIn('<p>@testuser2</p>', html)
+                self.assertNotIn('<p>@testuser</p>', html)
+                self.assertIn(f'/users?before={self.user2.id}', html)
+
+                resp = client.get(f'/users?before={self.user2.id}')
+                html = resp.get_data(as_text=True)
+
+                self.assertIn('<p>@testuser</p>', html)
+                self.assertNotIn('Load more', html)
+        finally:
+            app.config['USERS_PER_PAGE'] = 60
+
+    def count_queries(self, client, url):
+        """Count the SQL statements run while GETting `url`."""
+
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            client.get(url)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        return len(statements)
+
+    def test_list_pages_constant_queries(self):
+        """List pages cost the same number of queries however many rows"""
+
+        user_id = self.user.id
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            few = self.count_queries(client, '/users')
+            few_followers = self.count_queries(
+                client, f'/users/{user_id}/followers')
+
+            for i in range(5):
+                other = User(username=f"other{i}",
+                             email=f"other{i}@test.com",
+                             password="HASHED_PASSWORD")
+                db.session.add(other)
+                db.session.flush()
+                db.session.add(Follows(user_being_followed_id=user_id,
+                                       user_following_id=other.id))
+            db.session.commit()
+
+            self.assertEqual(self.count_queries(client, '/users'), few)
+            self.assertEqual(
+                self.count_queries(client, f'/users/{user_id}/followers'),
+                few_followers)
+
+    def test_counters(self):
+        """Follow, like, message and delete routes keep counters in sync"""
+
+        user_id = self.user.id
+        user2_id = self.user2.id
+
+        msg = Message(text="likeable", user_id=user2_id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id = msg.id
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            client.post(f'/users/follow/{user2_id}')
+            client.post(f'/messages/{msg_id}/like')
+            client.post('/messages/new', data={"text": "hi"})
+
+            user = User.query.get(user_id)
+            self.assertEqual((user.following_count, user.likes_count,
+                              user.messages_count), (1, 1, 1))
+            self.assertEqual(User.query.get(user2_id).followers_count, 1)
+
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user2_id
+
+            client.post('/users/delete')
+
+            db.session.expire_all()
+            user = User.query.get(user_id)
+            self.assertEqual((user.following_count, user.likes_count,
+                              user.messages_count), (0, 0, 1))
+
+    def test_reconcile_counts(self):
+        """User.reconcile_counts recomputes counters from the tables"""
+
+        self.user.followers.append(self.user2)
+        db.session.add(Message(text="counted", user_id=self.user.id))
+        db.session.commit()
+
+        User.reconcile_counts()
+        db.session.commit()
+
+        self.assertEqual(self.user.followers_count, 1)
+        self.assertEqual(self.user.messages_count, 1)
+        self.assertEqual(self.user2.following_count, 1)
+
+    def test_search_users(self):
+        """/users?q= matches username, bio and location, best first"""
+
+        self.user2.bio = "likes testing"
+        db.session.add(User(username="other", email="other@test.com",
+                            password="HASHED_PASSWORD", location="testville"))
+        db.session.commit()
+
+        resp = self.client.get('/users?q=testuser2')
+        html = resp.get_data(as_text=True)
+        self.assertIn('<p>@testuser2</p>', html)
+        self.assertNotIn('<p>@testuser</p>', html)
+
+        html = self.client.get('/users?q=test').get_data(as_text=True)
+        self.assertIn('<p>@other</p>', html)
+        self.assertLess(html.index('<p>@testuser</p>'),
+                        html.index('<p>@other</p>'))
+
+        html = self.client.get('/users?q=%25').get_data(as_text=True)
+        self.assertIn('Sorry, no users found', html)
+
+    def test_autocomplete_users(self):
+        """/users/autocomplete returns username prefix matches as JSON"""
+
+        resp = self.client.get('/users/autocomplete?q=TESTUSER')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([user['username'] for user in resp.get_json()],
+                         ['testuser', 'testuser2'])
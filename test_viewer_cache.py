@@ -0,0 +1,195 @@
+"""Viewer cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_viewer_cache.py
+
+import os
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+import threading
+import time
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Follows
+import viewer_cache
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.drop_all()
+db.create_all()
+
+
+class FakeClock:
+    """Clock the tests can move forward by hand."""
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class CacheBackendTestCase(TestCase):
+    """Test the LRU and shared cache backends."""
+
+    def test_lru_evicts_least_recently_used(self):
+        cache = viewer_cache.LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_lru_ttl(self):
+        clock = FakeClock()
+        cache = viewer_cache.LRUCache(ttl=10, clock=clock)
+        cache.set('a', 1)
+
+        clock.now = 9
+        self.assertEqual(cache.get('a'), 1)
+        clock.now = 10
+        self.assertIsNone(cache.get('a'))
+
+    def test_lru_threads(self):
+        """Threads expiring the same entries at once don't trip over it"""
+
+        def clock():
+            time.sleep(0.0001)  # let other threads in between lookups
+            return time.monotonic()
+
+        cache = viewer_cache.LRUCache(max_size=2, ttl=0, clock=clock)
+        errors = []
+
+        def hammer():
+            try:
+                for number in range(200):
+                    cache.set(number % 3, number)
+                    cache.get(number % 3)
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=hammer) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+
+    def test_shared_cache(self):
+        clock = FakeClock()
+        cache = viewer_cache.SharedCache(viewer_cache.MemoryClient(clock),
+                                         ttl=10)
+        cache.set('a', {'ids': [1, 2]})
+
+        self.assertEqual(cache.get('a'), {'ids': [1, 2]})
+        cache.delete('a')
+        self.assertIsNone(cache.get('a'))
+
+        cache.set('a', {'ids': []})
+        clock.now = 10
+        self.assertIsNone(cache.get('a'))
+
+    def test_get_many(self):
+        lru = viewer_cache.LRUCache()
+        shared = viewer_cache.SharedCache(viewer_cache.MemoryClient())
+
+        for cache in (lru, shared):
+            cache.set('a', [1])
+            self.assertEqual(cache.get_many(['a', 'b']), [[1], None])
+
+
+class ViewerCacheTestCase(TestCase):
+    """Test caching the logged-in user in add_user_to_g."""
+
+    def setUp(self):
+        """Create two users and start from an empty cache."""
+
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        self.u1 = User.signup("viewer", "viewer@test.com", "password", None)
+        self.u2 = User.signup("followed", "followed@test.com", "password", None)
+        db.session.commit()
+
+        self.u1_id = self.u1.id
+        self.u2_id = self.u2.id
+
+        self.saved_cache = app.extensions['viewer_cache']
+        app.extensions['viewer_cache'] = viewer_cache.SharedCache(
+            viewer_cache.MemoryClient())
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        """Clean up fouled transactions and restore the app's cache."""
+
+        db.session.rollback()
+        app.extensions['viewer_cache'] = self.saved_cache
+
+    def count_queries(self, client, url):
+        """Count the SQL statements run while GETting `url`."""
+
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            client.get(url)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        return len(statements)
+
+    def test_cached_viewer_skips_queries(self):
+        """A warm cache saves the queries add_user_to_g used to make"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            cold = self.count_queries(c, '/messages/new')
+            warm = self.count_queries(c, '/messages/new')
+
+            self.assertEqual(warm, 0)
+            self.assertLess(warm, cold)
+
+    def test_follow_invalidates(self):
+        """Following someone refreshes the cached following ids"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.get('/users')
+            c.post(f'/users/follow/{self.u2_id}')
+
+            html = c.get('/users').get_data(as_text=True)
+            self.assertIn(f'action="/users/stop-following/{self.u2_id}"', html)
+
+    def test_profile_edit_invalidates(self):
+        """Editing the profile refreshes the cached user"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.get('/')
+            c.post('/users/profile', data={"username": "renamed",
+                                           "email": "viewer@test.com",
+                                           "password": "password"})
+
+            html = c.get('/').get_data(as_text=True)
+            self.assertIn('<p>@renamed</p>', html)
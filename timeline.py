@@ -0,0 +1,301 @@
+"""Precomputed home timelines for Warbler.
+
+Each user has a bounded list of message ids in `timeline_entries`.
+Message ids are time-ordered (see snowflake.py), so a timeline is read
+newest first straight off the table's primary key. Posting a message
+pushes it into the author's own timeline and into the timeline of every
+follower ("fan-out on write"), so the homepage is a single indexed read
+instead of an `IN (...)` over every followed user.
+
+Timelines are cut back to TIMELINE_MAX_LENGTH entries by a periodic job
+(`flask trim-timelines`, see the Procfile), so reading one never writes.
+
+Authors with more than TIMELINE_FANOUT_LIMIT followers are flagged as
+pull authors: their messages are not fanned out, and are merged into the
+timeline when it is read instead.
+
+All of this is the 'push' TIMELINE_ENGINE. With 'pull', every timeline is
+merged at read time (see author_cache.py) and none of these tables are
+kept up to date; run `flask rebuild-timelines` when switching back.
+"""
+
+from flask import current_app
+from sqlalchemy import and_, func, literal, not_, select, text
+from sqlalchemy.orm import joinedload
+
+from models import db, Follows, Message, TimelineEntry, User
+
+DEFAULT_ENGINE = 'push'
+DEFAULT_MAX_LENGTH = 800
+DEFAULT_FANOUT_LIMIT = 10000
+
+
+def engine():
+    """'push' (fan-out on write) or 'pull' (merge on read)."""
+
+    return current_app.config.get('TIMELINE_ENGINE', DEFAULT_ENGINE)
+
+
+def max_length():
+    """Number of entries kept in each home timeline."""
+
+    return current_app.config.get('TIMELINE_MAX_LENGTH', DEFAULT_MAX_LENGTH)
+
+
+def fanout_limit():
+    """Follower count above which an author switches to the pull path."""
+
+    return current_app.config.get('TIMELINE_FANOUT_LIMIT',
+                                  DEFAULT_FANOUT_LIMIT)
+
+
+def fan_out(msg):
+    """Push a newly-added message into the relevant home timelines.
+
+    The message must already be flushed so it has an id; nothing is
+    committed here, so the entries land in the same transaction as the
+    message itself.
+    """
+
+    author = User.query.get(msg.user_id)
+
+    db.session.add(TimelineEntry(user_id=author.id, message_id=msg.id))
+
+    if author.is_pull_author:
+        return
+
+    if author.followers_count > fanout_limit():
+        author.is_pull_author = True
+        return
+
+    followers = (select([Follows.user_following_id,
+                         literal(msg.id, type_=db.BigInteger)])
+                 .where(Follows.user_being_followed_id == author.id))
+
+    db.session.execute(
+        TimelineEntry.__table__.insert().from_select(
+            ['user_id', 'message_id'], followers))
+
+
+def add_author(user_id, author_id):
+    """Backfill `author_id`'s recent messages after `user_id` follows them."""
+
+    author = User.query.get(author_id)
+    if author.is_pull_author:
+        return
+
+    existing = (select([TimelineEntry.message_id])
+                .where(TimelineEntry.user_id == user_id))
+
+    recent = (select([literal(user_id), Message.id])
+              .where(and_(Message.user_id == author_id,
+                          not_(Message.id.in_(existing))))
+              .order_by(Message.id.desc())
+              .limit(max_length()))
+
+    db.session.execute(
+        TimelineEntry.__table__.insert().from_select(
+            ['user_id', 'message_id'], recent))
+
+    trim(user_id)
+
+
+def remove_author(user_id, author_id):
+    """Drop `author_id`'s messages after `user_id` stops following them."""
+
+    authored = (select([Message.id])
+                .where(Message.user_id == author_id))
+
+    (TimelineEntry
+     .query
+     .filter(TimelineEntry.user_id == user_id,
+             TimelineEntry.message_id.in_(authored))
+     .delete(synchronize_session=False))
+
+
+def trim(user_id):
+    """Delete entries past the timeline length for `user_id`.
+
+    Returns the number of rows removed.
+    """
+
+    cutoff = (db.session
+              .query(TimelineEntry.message_id)
+              .filter(TimelineEntry.user_id == user_id)
+              .order_by(TimelineEntry.message_id.desc())
+              .offset(max_length())
+              .limit(1)
+              .scalar())
+
+    if cutoff is None:
+        return 0
+
+    return (TimelineEntry
+            .query
+            .filter(TimelineEntry.user_id == user_id,
+                    TimelineEntry.message_id <= cutoff)
+            .delete(synchronize_session=False))
+
+
+def _pushed_ids(user_id, limit, before):
+    """Newest message ids pushed to `user_id`.
+
+    Skips messages by deactivated authors, which stay in timelines until
+    the author's purge (see purge.py) deletes them.
+    """
+
+    query = (db.session
+             .query(TimelineEntry.message_id)
+             .join(Message, Message.id == TimelineEntry.message_id)
+             .join(User, User.id == Message.user_id)
+             .filter(TimelineEntry.user_id == user_id,
+                     User.deactivated.is_(False)))
+
+    if before:
+        query = query.filter(TimelineEntry.message_id < before)
+
+    return [id for (id,) in (query
+                             .order_by(TimelineEntry.message_id.desc())
+                             .limit(limit))]
+
+
+def _pulled_ids(user_id, limit, before):
+    """Newest ids of messages by pull authors `user_id` follows."""
+
+    query = (db.session
+             .query(Message.id)
+             .join(Follows, Follows.user_being_followed_id == Message.user_id)
+             .join(User, User.id == Message.user_id)
+             .filter(Follows.user_following_id == user_id,
+                     User.is_pull_author.is_(True),
+                     User.deactivated.is_(False)))
+
+    if before:
+        query = query.filter(Message.id < before)
+
+    return [id for (id,) in query.order_by(Message.id.desc()).limit(limit)]
+
+
+def home_timeline(user_id, limit=100, before=None):
+    """Return the newest `limit` messages for `user_id`'s homepage.
+
+    `before` is an optional message id; only messages older than it are
+    returned. Paging stops at the end of the stored timeline, about
+    TIMELINE_MAX_LENGTH messages (see `trim_all()`). Read-only.
+    """
+
+    ids = sorted(set(_pushed_ids(user_id, limit, before) +
+                     _pulled_ids(user_id, limit, before)),
+                 reverse=True)[:limit]
+    if not ids:
+        return []
+
+    messages = (Message
+                .query
+                .filter(Message.id.in_(ids))
+                .options(joinedload(Message.user))
+                .all())
+    by_id = {msg.id: msg for msg in messages}
+
+    # ids whose message was deleted after fan-out simply drop out here
+    return [by_id[id] for id in ids if id in by_id]
+
+
+REBUILD_SQL = text("""
+    INSERT INTO timeline_entries (user_id, message_id)
+    SELECT owner_id, message_id
+    FROM (
+        SELECT owner_id, message_id,
+               row_number() OVER (PARTITION BY owner_id
+                                  ORDER BY message_id DESC)
+                   AS position
+        FROM (
+            SELECT m.user_id AS owner_id, m.id AS message_id
+            FROM messages m
+            WHERE m.user_id >= :first AND m.user_id < :last
+            UNION ALL
+            SELECT f.user_following_id, m.id
+            FROM follows f
+            JOIN users u ON u.id = f.user_being_followed_id
+            JOIN messages m ON m.user_id = f.user_being_followed_id
+            WHERE f.user_following_id >= :first
+              AND f.user_following_id < :last
+              AND NOT u.is_pull_author
+        ) candidates
+    ) ranked
+    WHERE position <= :max_length
+""")
+
+
+TRIM_SQL = text("""
+    DELETE FROM timeline_entries
+    WHERE user_id >= :first AND user_id < :last
+      AND (user_id, message_id) IN (
+        SELECT user_id, message_id
+        FROM (
+            SELECT user_id, message_id,
+                   row_number() OVER (PARTITION BY user_id
+                                      ORDER BY message_id DESC)
+                       AS position
+            FROM timeline_entries
+            WHERE user_id >= :first AND user_id < :last
+        ) ranked
+        WHERE position > :max_length
+      )
+""")
+
+
+def trim_all(batch_size=1000):
+    """Cut every home timeline back to TIMELINE_MAX_LENGTH entries.
+
+    Fan-out only ever adds entries, and trimming each follower's timeline
+    as a message is posted would cost a query per follower, so this runs
+    periodically instead (`flask trim-timelines`), `batch_size` users per
+    transaction. Returns the number of entries removed.
+    """
+
+    last_id = db.session.query(func.max(User.id)).scalar() or 0
+    removed = 0
+
+    for first in range(0, last_id + 1, batch_size):
+        removed += db.session.execute(TRIM_SQL, {
+            'first': first,
+            'last': first + batch_size,
+            'max_length': max_length(),
+        }).rowcount
+        db.session.commit()
+
+    return removed
+
+
+def rebuild(batch_size=1000, progress=None):
+    """Recompute every home timeline from `messages` and `follows`.
+
+    Pull authors are re-flagged from current follower counts first, then
+    timelines are rebuilt `batch_size` users at a time, committing after
+    each batch. `progress`, if given, is called with (done, total) user
+    counts.
+    """
+
+    follower_counts = (select([func.count()])
+                       .where(Follows.user_being_followed_id == User.id)
+                       .as_scalar())
+
+    (User
+     .query
+     .update({User.is_pull_author: follower_counts > fanout_limit()},
+             synchronize_session=False))
+
+    TimelineEntry.query.delete(synchronize_session=False)
+    db.session.commit()
+
+    last_id = db.session.query(func.max(User.id)).scalar() or 0
+
+    for first in range(0, last_id + 1, batch_size):
+        db.session.execute(REBUILD_SQL, {'first': first,
+                                         'last': first + batch_size,
+                                         'max_length': max_length()})
+        db.session.commit()
+
+        if progress:
+            progress(min(first + batch_size, last_id + 1), last_id + 1)
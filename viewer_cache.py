@@ -0,0 +1,249 @@
+"""Cache of the logged-in viewer for Warbler.
+
+Every request from a logged-in user needs the user's row, and most pages
+also need the ids of the users they follow. Those are cached per user id,
+with a TTL, so `add_user_to_g` can set up `g.user` and `g.following_ids`
+without going to the database. Routes that change any of them call
+`invalidate()`.
+
+Liked messages are not cached, since a user can like any number of them;
+pages look up which of their messages are liked (`User.liked_ids`).
+Instead the id of the viewer's latest like is kept, as `g.last_like_id`:
+like ids only grow, so together with the likes count it changes whenever
+the set of liked messages does, which is what HTTP validators need.
+
+Two backends are available, chosen by VIEWER_CACHE_BACKEND:
+
+- 'local': an in-process LRU (the default)
+- 'redis': a cache shared by all workers, at VIEWER_CACHE_URL
+
+Tests, or anything else that wants a shared cache without a server, can
+pass `MemoryClient()` to `SharedCache` instead of a redis client.
+"""
+
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+from sqlalchemy import func
+from sqlalchemy.orm import make_transient_to_detached
+
+from models import db, Follows, Likes, User
+
+# The password hash is deliberately left out: it is loaded from the
+# database on the rare occasions it is needed.
+CACHED_COLUMNS = [column.key for column in User.__table__.columns
+                  if column.key != 'password']
+
+
+class LRUCache:
+    """In-process least-recently-used cache with a per-entry TTL.
+
+    Safe to share between a worker's threads.
+    """
+
+    def __init__(self, max_size=1024, ttl=60, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return the value for `key`, or None if missing or expired."""
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            expires, value = entry
+            if expires <= self.clock():
+                self.entries.pop(key, None)
+                return None
+
+            self.entries.move_to_end(key)
+            return value
+
+    def get_many(self, keys):
+        """Return a list of the values (or None) for `keys`."""
+
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value):
+        """Store `value` under `key`, evicting the oldest entry if full."""
+
+        with self.lock:
+            self.entries[key] = (self.clock() + self.ttl, value)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        """Forget `key`."""
+
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        """Forget everything."""
+
+        with self.lock:
+            self.entries.clear()
+
+
+class SharedCache:
+    """Cache kept in a key-value server shared between workers.
+
+    `client` needs redis-style `get(key)`, `mget(keys)`,
+    `set(key, value, ex=seconds)` and `delete(key)` methods. Values are
+    stored as JSON.
+    """
+
+    def __init__(self, client, ttl=60, prefix='warbler:viewer:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        """Return the value for `key`, or None if missing or expired."""
+
+        raw = self.client.get(self.prefix + key)
+        if raw is None:
+            return None
+
+        return json.loads(raw)
+
+    def get_many(self, keys):
+        """Return a list of the values (or None) for `keys`, in one trip."""
+
+        if not keys:
+            return []
+
+        raws = self.client.mget([self.prefix + key for key in keys])
+        return [None if raw is None else json.loads(raw) for raw in raws]
+
+    def set(self, key, value):
+        """Store `value` under `key` for `ttl` seconds."""
+
+        self.client.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+
+    def delete(self, key):
+        """Forget `key`."""
+
+        self.client.delete(self.prefix + key)
+
+
+class MemoryClient:
+    """Local stand-in for a redis client, for tests and development."""
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.values = {}
+
+    def get(self, key):
+        value, expires = self.values.get(key, (None, None))
+        if expires is not None and expires <= self.clock():
+            del self.values[key]
+            return None
+
+        return value
+
+    def mget(self, keys):
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value, ex=None):
+        expires = self.clock() + ex if ex else None
+        self.values[key] = (value, expires)
+
+    def delete(self, key):
+        self.values.pop(key, None)
+
+
+def make_cache(config):
+    """Build the cache described by the app's VIEWER_CACHE_* settings."""
+
+    backend = config.get('VIEWER_CACHE_BACKEND', 'local')
+    ttl = config.get('VIEWER_CACHE_TTL', 60)
+
+    if backend == 'redis':
+        # only needed for the shared backend, so not a hard requirement
+        import redis
+
+        client = redis.Redis.from_url(config['VIEWER_CACHE_URL'])
+        return SharedCache(client, ttl=ttl)
+
+    if backend == 'local':
+        return LRUCache(max_size=config.get('VIEWER_CACHE_SIZE', 1024),
+                        ttl=ttl)
+
+    raise ValueError(f"Unknown VIEWER_CACHE_BACKEND: {backend}")
+
+
+def init_app(app):
+    """Attach a viewer cache to `app`."""
+
+    app.extensions['viewer_cache'] = make_cache(app.config)
+
+
+def get_cache():
+    """The viewer cache of the current app."""
+
+    return current_app.extensions['viewer_cache']
+
+
+def _build_entry(user):
+    """Collect everything cached about `user` into a JSON-able dict."""
+
+    following_ids = (db.session
+                     .query(Follows.user_being_followed_id)
+                     .filter(Follows.user_following_id == user.id))
+
+    last_like_id = (db.session
+                    .query(func.max(Likes.id))
+                    .filter(Likes.user_id == user.id)
+                    .scalar())
+
+    return {
+        'user': {column: getattr(user, column) for column in CACHED_COLUMNS},
+        'following_ids': [id for (id,) in following_ids],
+        'last_like_id': last_like_id,
+    }
+
+
+def load_viewer(user_id):
+    """Return (user, following ids, latest like id) for `user_id`.
+
+    The user is attached to the current session, so relationships and
+    the uncached password still load on demand. Returns None if there is
+    no such user, or it was deleted.
+    """
+
+    cache = get_cache()
+    entry = cache.get(str(user_id))
+
+    if entry is None:
+        user = User.query.get(user_id)
+        if user is None or user.deactivated:
+            return None
+
+        entry = _build_entry(user)
+        cache.set(str(user_id), entry)
+
+    else:
+        user = User(**entry['user'])
+        make_transient_to_detached(user)
+        user = db.session.merge(user, load=False)
+
+    return user, set(entry['following_ids']), entry['last_like_id']
+
+
+def invalidate(*user_ids):
+    """Drop cached data for `user_ids` after it has changed."""
+
+    cache = get_cache()
+    for user_id in user_ids:
+        cache.delete(str(user_id))